@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+#
+# Description: offline benchmark of the gru pipeline. Generates synthetic multi-organism references and simulated 2D
+# reads (minimal fast5 files, optionally packed into a tar.gz archive), runs gru.py on them with the local stand-ins of
+# bwa, samtools, poretools and plot-bamstats (standins.py) and reports the throughput of every stage from
+# log/profile.jsonl. Results can be stored as baseline and later runs compared against it to flag regressions.
+# Usage: ./gru_benchmark.py [--organisms 4] [--reads 2000] [--archive] [--baseline baseline.json] [--save-baseline]
+#
+
+import os, sys, subprocess
+import yaml
+import shutil
+import time
+import json
+import tarfile
+import gzip
+import argparse
+import h5py
+import numpy
+
+###################################################################################
+##                                                                               ##
+##              USAGE: ./gru_benchmark.py [options] (see --help)                 ##
+##                                                                               ##
+###################################################################################
+
+benchmark_folder = os.path.dirname(os.path.abspath(__file__)) + "/"
+gru_folder = os.path.dirname(benchmark_folder.rstrip("/")) + "/"
+# tools replaced by standins.py (tool name, config section, key)
+standin_tools = [("bwa", "software_general", "bwa"), ("samtools", "software_general", "samtools"),
+                 ("poretools", "software_general", "poretools"), ("plot-bamstats", "software_general", "plot_bamstats"),
+                 ("R", "software_general", "r"), ("bgzip", "software_general", "bgzip"),
+                 ("quast", "software_general", "quast"), ("minimap", "software_assembler", "minimap"),
+                 ("miniasm", "software_assembler", "miniasm"), ("nanopolish", "software_assembler", "nanopolish"),
+                 ("sbatch", None, None), ("squeue", None, None)]
+# throughput units of the stages: stage name -> list of (unit, workload key)
+stage_units = {"poretools": [("files/s", "fast5_files"), ("reads/s", "reads"), ("MB/s", "fast5_mb")],
+               "bwa-index": [("MB/s", "reference_mb")],
+               "mapping": [("reads/s", "reads"), ("MB/s", "fastq_mb")],
+               "illumina": [("reads/s", "illumina_reads")],
+               "miniasm": [("reads/s", "reads")],
+               "split": [("reads/s", "reads")],
+               "sort": [("reads/s", "reads")],
+               "index": [("reads/s", "reads")],
+               "bamstats": [("reads/s", "reads")],
+               "stats": [("reads/s", "reads")],
+               "flagstat": [("reads/s", "reads")],
+               "plot-bamstats": [("reads/s", "reads")]}
+
+
+##########################################
+#    BEGIN SECTION  GENERATORS           #
+##########################################
+
+# writes one reference fasta per organism and returns the file_mapping of the job configuration and the contig
+# sequences by their name in the concatenated gru reference (<prefix>_contig_<n>)
+def generate_references(folder, organisms, contigs, contig_length, rng):
+    file_mapping, sequences = {}, {}
+    for o in range(organisms):
+        prefix = "organism" + str(o)
+        with open(folder + prefix + ".fasta", "w") as fasta:
+            for c in range(contigs):
+                sequence = "".join(rng.choice(list("ACGT"), contig_length))
+                fasta.write(">" + prefix + "_original_" + str(c) + "\n")
+                for start in range(0, len(sequence), 80):
+                    fasta.write(sequence[start:start + 80] + "\n")
+                sequences[prefix + "_contig_" + str(c)] = sequence
+        file_mapping[prefix] = {"prefix": prefix, "reference": prefix + ".fasta"}
+    return file_mapping, sequences
+
+
+# yields simulated 2D reads as (name, sequence, qualities). The origin is encoded in the name
+# (read<n>|<contig>|<position>|<strand>|<mismatches>), which the bwa stand-in uses as mapping. A fraction of the reads
+# are random sequences which stay unmapped.
+def simulate_reads(sequences, count, mean_length, error_rate, unmapped_fraction, rng):
+    contigs = sorted(sequences)
+    complement = {"A": "T", "C": "G", "G": "C", "T": "A"}
+    for r in range(count):
+        contig = contigs[rng.randint(len(contigs))]
+        length = int(min(max(100, rng.lognormal(numpy.log(mean_length), 0.5)), len(sequences[contig])))
+        if rng.random_sample() < unmapped_fraction:
+            sequence = "".join(rng.choice(list("ACGT"), length))
+            name = "read" + str(r)
+        else:
+            position = rng.randint(len(sequences[contig]) - length + 1)
+            bases = list(sequences[contig][position:position + length])
+            errors = rng.random_sample(length) < error_rate
+            for i in numpy.nonzero(errors)[0]:
+                bases[i] = "ACGT"[("ACGT".index(bases[i]) + 1 + rng.randint(3)) % 4]
+            sequence = "".join(bases)
+            strand = "+" if rng.random_sample() < 0.5 else "-"
+            if strand == "-":
+                sequence = "".join(complement[b] for b in reversed(sequence))
+            name = "read" + str(r) + "|" + contig + "|" + str(position) + "|" + strand + "|" + str(int(errors.sum()))
+        qualities = "".join(chr(33 + q) for q in rng.randint(5, 30, length))
+        yield name, sequence, qualities
+
+
+# writes gzipped paired Illumina reads (R1/R2, pairs of read_length bases from fragments of fragment_length bases) of
+# every organism into folder and adds them to its file_mapping. The origin is encoded in the read names like for the
+# 2D reads.
+def generate_illumina_reads(folder, file_mapping, sequences, pairs, read_length, fragment_length, rng):
+    complement = {"A": "T", "C": "G", "G": "C", "T": "A"}
+    for prefix in sorted(file_mapping):
+        contigs = sorted(contig for contig in sequences if contig.startswith(prefix + "_contig_"))
+        mates = [folder + prefix + "_R1.fastq.gz", folder + prefix + "_R2.fastq.gz"]
+        outputs = [gzip.open(mate, "wb") for mate in mates]
+        for p in range(pairs):
+            contig = contigs[rng.randint(len(contigs))]
+            start = rng.randint(len(sequences[contig]) - fragment_length + 1)
+            end = start + fragment_length
+            forward = sequences[contig][start:start + read_length]
+            reverse = "".join(complement[b] for b in reversed(sequences[contig][end - read_length:end]))
+            for output, sequence, position, strand in [(outputs[0], forward, start, "+"),
+                                                       (outputs[1], reverse, end - read_length, "-")]:
+                qualities = "".join(chr(33 + q) for q in rng.randint(30, 41, read_length))
+                output.write("@pair" + str(p) + "|" + contig + "|" + str(position) + "|" + strand + "|0\n" +
+                             sequence + "\n+\n" + qualities + "\n")
+        for output in outputs:
+            output.close()
+        file_mapping[prefix]["illumina"] = [os.path.basename(mate) for mate in mates]
+
+
+# writes a minimal fast5 (hdf5) file containing the 2D basecall of one read
+def write_fast5(path, name, sequence, qualities):
+    fast5 = h5py.File(path, "w")
+    fastq = "@" + name + "\n" + sequence + "\n+\n" + qualities + "\n"
+    fast5.create_dataset("Analyses/Basecall_2D_000/BaseCalled_2D/Fastq", data=numpy.string_(fastq))
+    fast5.close()
+
+
+# writes the fast5 files of the simulated reads into folder and optionally packs them into a tar.gz archive.
+# Returns the nanopore input of the job configuration.
+def generate_fast5_input(folder, reads, archive):
+    fast5_folder = folder + "fast5/"
+    os.makedirs(fast5_folder)
+    for i, (name, sequence, qualities) in enumerate(reads):
+        write_fast5(fast5_folder + "read_" + str(i) + ".fast5", name, sequence, qualities)
+    if not archive:
+        return fast5_folder
+    with tarfile.open(folder + "fast5.tar.gz", "w:gz") as tar:
+        tar.add(fast5_folder, arcname="fast5")
+    shutil.rmtree(fast5_folder)
+    return folder + "fast5.tar.gz"
+
+
+# creates one executable wrapper per stand-in tool in folder and returns the software sections (section -> key -> path)
+def generate_standins(folder):
+    software = {}
+    for tool, section, key in standin_tools:
+        with open(folder + tool, "w") as wrapper:
+            wrapper.write("#!/bin/sh\nexec '" + sys.executable + "' '" + benchmark_folder + "standins.py' " + tool +
+                          " \"$@\"\n")
+        os.chmod(folder + tool, 0o755)
+        if section is not None:
+            software.setdefault(section, {})[key] = folder + tool
+    return software
+
+
+# writes the job configuration of a benchmark run, settings overrides the generated values
+# (list of (section, key, value))
+def generate_job(path, project_folder, nanopore_input, reference_folder, file_mapping, software, threads, settings,
+                 illumina_folder=None):
+    job = yaml.safe_load(open(gru_folder + "sample_configuration/job.yml"))
+    job["project_settings"].update({"project_folder": project_folder, "overwrite_folder": True, "resume": False})
+    job["nanopore_input"] = nanopore_input
+    job["illumina_reads"] = {"enable_illumina": illumina_folder is not None, "folder": illumina_folder}
+    job["references"] = {"enable_references": True, "folder": reference_folder}
+    job["file_mapping"] = file_mapping
+    for section in software:
+        job[section].update(software[section])
+    job["software_settings"].update({"gru_debug": False, "mapping_threads": threads, "stage_threads": threads,
+                                     "extraction_processes": threads, "extraction_queue_size": 2 * threads,
+                                     "index_cache_folder": None,
+                                     # executor: queue submits to the fake scheduler of standins.py
+                                     "queue_submit": os.path.dirname(software["software_general"]["bwa"]) +
+                                                     "/sbatch --parsable -c {threads} -o {log}",
+                                     "queue_status": os.path.dirname(software["software_general"]["bwa"]) +
+                                                     "/squeue -h -j {job}",
+                                     "queue_poll_seconds": 0.2})
+    for section, key, value in settings:
+        job.setdefault(section, {})[key] = value
+    with open(path, "w") as job_file:
+        yaml.safe_dump(job, job_file, default_flow_style=False)
+
+
+##########################################
+#    END SECTION  GENERATORS             #
+##########################################
+
+##########################################
+#    BEGIN SECTION  MEASUREMENT          #
+##########################################
+
+# returns the size of a file or of all files of a folder in MB
+def size_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1048576.0
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files) / 1048576.0
+
+
+# sums the wall clock and cpu time of the stage records of profile.jsonl per stage kind (the part of the name before
+# ":", so the per-organism stages are added up) and computes their throughput for the given workload
+def summarize_profile(profile, workload):
+    stages = {}
+    for record in profile:
+        if record["type"] != "stage" or record.get("skipped"):
+            continue
+        kind = record["name"].split(":")[0]
+        stage = stages.setdefault(kind, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "max_rss_kb": 0, "count": 0})
+        stage["wall_seconds"] += record["wall_seconds"]
+        stage["cpu_seconds"] += record["user_seconds"] + record["system_seconds"] + \
+            record["children_user_seconds"] + record["children_system_seconds"]
+        stage["max_rss_kb"] = max(stage["max_rss_kb"], record["max_rss_kb"])
+        stage["count"] += 1
+    for kind, stage in stages.items():
+        stage["throughput"] = dict((unit, workload[key] / max(stage["wall_seconds"], 1e-6))
+                                   for unit, key in stage_units.get(kind, []))
+    return stages
+
+
+# compares the stage wall clock times with a baseline and returns the list of (stage, baseline seconds, seconds) which
+# are slower than the baseline by more than tolerance (fraction). Stages below min_seconds are too noisy to compare.
+def find_regressions(stages, baseline, tolerance, min_seconds):
+    regressions = []
+    for kind in sorted(baseline["stages"]):
+        if kind not in stages:
+            continue
+        before, after = baseline["stages"][kind]["wall_seconds"], stages[kind]["wall_seconds"]
+        if max(before, after) >= min_seconds and after > before * (1.0 + tolerance):
+            regressions.append((kind, before, after))
+    return regressions
+
+
+# prints the stage table of a benchmark result and the change against the baseline
+def print_result(result, baseline):
+    print("%-16s %6s %10s %10s %10s  %s" % ("stage", "runs", "wall [s]", "cpu [s]", "vs base", "throughput"))
+    for kind in sorted(result["stages"], key=lambda k: result["stages"][k]["wall_seconds"], reverse=True):
+        stage = result["stages"][kind]
+        change = ""
+        if baseline is not None and kind in baseline["stages"] and baseline["stages"][kind]["wall_seconds"] > 0:
+            change = "%+.1f%%" % (100.0 * (stage["wall_seconds"] / baseline["stages"][kind]["wall_seconds"] - 1.0))
+        throughput = ", ".join("%.1f %s" % (value, unit) for unit, value in sorted(stage["throughput"].items()))
+        print("%-16s %6d %10.2f %10.2f %10s  %s" % (kind, stage["count"], stage["wall_seconds"], stage["cpu_seconds"],
+                                                   change, throughput))
+    print("%-16s %6s %10.2f" % ("total", "", result["total_seconds"]))
+
+
+##########################################
+#    END SECTION  MEASUREMENT            #
+##########################################
+
+##########################################
+#    BEGIN SECTION  MAIN_ROUTINE         #
+##########################################
+
+# parses "section.key=value" overrides of the job configuration (value is parsed as yaml)
+def parse_setting(setting):
+    name, value = setting.split("=", 1)
+    section, key = name.split(".", 1)
+    return section, key, yaml.safe_load(value)
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the gru pipeline with synthetic data.")
+    parser.add_argument("--work-folder", default="/tmp/gru_benchmark/", help="folder of the generated data and run")
+    parser.add_argument("--organisms", type=int, default=4, help="number of reference organisms")
+    parser.add_argument("--contigs", type=int, default=3, help="contigs per organism")
+    parser.add_argument("--contig-length", type=int, default=50000, help="length of every contig")
+    parser.add_argument("--reads", type=int, default=2000, help="number of simulated reads (one fast5 file each)")
+    parser.add_argument("--read-length", type=int, default=5000, help="mean read length")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="substitution rate of the mapped reads")
+    parser.add_argument("--unmapped", type=float, default=0.1, help="fraction of random (unmapped) reads")
+    parser.add_argument("--archive", action="store_true", help="pack the fast5 files into a tar.gz archive")
+    parser.add_argument("--illumina", type=int, default=0, help="simulated Illumina read pairs per organism")
+    parser.add_argument("--threads", type=int, default=4, help="mapping, stage and extraction threads")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the generators")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE",
+                        help="override a job setting, e.g. software_settings.mapping_shards=4")
+    parser.add_argument("--baseline", default=benchmark_folder + "baseline.json", help="stored benchmark result")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--min-seconds", type=float, default=0.5, help="stages faster than this are not compared")
+    options = parser.parse_args(arguments)
+
+    work_folder = os.path.abspath(options.work_folder) + "/"
+    if os.path.exists(work_folder):
+        shutil.rmtree(work_folder)
+    for folder in ["references/", "input/", "illumina/", "bin/"]:
+        os.makedirs(work_folder + folder)
+    rng = numpy.random.RandomState(options.seed)
+
+    print("Generating " + str(options.organisms) + " references and " + str(options.reads) + " reads in " +
+          work_folder)
+    file_mapping, sequences = generate_references(work_folder + "references/", options.organisms, options.contigs,
+                                                  options.contig_length, rng)
+    reads = simulate_reads(sequences, options.reads, options.read_length, options.error_rate, options.unmapped, rng)
+    nanopore_input = generate_fast5_input(work_folder + "input/", reads, options.archive)
+    if options.illumina > 0:
+        generate_illumina_reads(work_folder + "illumina/", file_mapping, sequences, options.illumina, 150, 400, rng)
+    software = generate_standins(work_folder + "bin/")
+    job_file = work_folder + "job.yml"
+    generate_job(job_file, work_folder + "project/", nanopore_input, work_folder + "references/", file_mapping,
+                 software, options.threads, [parse_setting(setting) for setting in options.set],
+                 work_folder + "illumina/" if options.illumina > 0 else None)
+
+    print("Running gru")
+    started = time.time()
+    with open(work_folder + "gru.log", "w") as log:
+        exit_code = subprocess.call([sys.executable, gru_folder + "gru.py", job_file], cwd=gru_folder, stdout=log,
+                                    stderr=subprocess.STDOUT)
+    total_seconds = time.time() - started
+    if exit_code != 0:
+        sys.stderr.write("gru failed with exit code " + str(exit_code) + " (see " + work_folder + "gru.log)\n")
+        return 2
+
+    workload = {"reads": options.reads, "fast5_files": options.reads, "fast5_mb": size_mb(nanopore_input),
+                "reference_mb": size_mb(work_folder + "references/"),
+                "fastq_mb": size_mb(work_folder + "project/reads/_reads.fastq"),
+                "illumina_reads": 2 * options.illumina * options.organisms}
+    with open(work_folder + "project/log/profile.jsonl") as profile_file:
+        profile = [json.loads(line) for line in profile_file]
+    result = {"options": vars(options), "workload": workload, "total_seconds": total_seconds,
+              "stages": summarize_profile(profile, workload)}
+    with open(work_folder + "result.json", "w") as result_file:
+        json.dump(result, result_file, indent=1, sort_keys=True)
+
+    baseline = None
+    if os.path.isfile(options.baseline) and not options.save_baseline:
+        baseline = json.load(open(options.baseline))
+    print_result(result, baseline)
+    if options.save_baseline:
+        shutil.copy(work_folder + "result.json", options.baseline)
+        print("Stored baseline " + options.baseline)
+        return 0
+    if baseline is None:
+        return 0
+    if baseline["workload"] != workload:
+        print("Warning: the workload differs from the baseline, the comparison is not meaningful")
+    regressions = find_regressions(result["stages"], baseline, options.tolerance, options.min_seconds)
+    for kind, before, after in regressions:
+        print("REGRESSION: " + kind + " took %.2fs (baseline %.2fs)" % (after, before))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
+
+##########################################
+#    END SECTION  MAIN_ROUTINE           #
+##########################################
@@ -0,0 +1,591 @@
+#!/usr/bin/python
+
+#
+# Description: lightweight local stand-ins for the external tools gru runs (bwa, samtools, poretools, plot-bamstats, R,
+# bgzip, minimap, miniasm, nanopolish, quast) and a local fake batch queue (sbatch, squeue) for the queue executor.
+# Cram files are written as bam.
+# They implement just enough of each command line to let gru run end to end on synthetic benchmark data, so the
+# orchestration overhead of every stage can be timed without the real toolchain.
+# Usage: standins.py <tool> <arguments...> (gru_benchmark.py creates one wrapper script per tool)
+#
+
+import os, sys, subprocess
+import re
+import struct
+import zlib
+import gzip
+import io
+
+###################################################################################
+##                                                                               ##
+##                  USAGE: ./standins.py <tool> <arguments...>                   ##
+##                                                                               ##
+###################################################################################
+
+# 4 bit encoding of bam sequences
+bam_bases = "=ACMGRSVTWYHKDBN"
+# cigar operations in bam order
+bam_cigar_ops = "MIDNSHP=X"
+# maximum uncompressed size of a bgzf block
+bgzf_block_size = 65280
+# empty bgzf block which marks the end of a bam file
+bgzf_eof = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+# smallest valid png (1x1 pixel), used for the plot-bamstats charts
+empty_png = ("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+             "1f15c4890000000d49444154789c6360000002000005000178fe9ba00000000049454e44ae426082").decode("hex")
+# charts written by plot-bamstats
+plot_bamstats_charts = ["gc-content", "coverage", "quals", "quals2", "quals3", "quals-hm", "acgt-cycles", "gc-depth",
+                        "indel-cycles", "indel-dist"]
+
+
+##########################################
+#    BEGIN SECTION  FORMATS              #
+##########################################
+
+# opens a plain or gzip compressed file, "-" is stdin (buffered, readline on sys.stdin is slow on pipes). Pipes (e.g.
+# bash process substitutions) are read as plain text.
+def open_input(path):
+    if path == "-":
+        return io.open(sys.stdin.fileno(), "rb", buffering=1024 * 1024, closefd=False)
+    if not os.path.isfile(path):
+        return open(path, "rb")
+    with open(path, "rb") as handle:
+        magic = handle.read(2)
+    if magic == "\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+# yields (name, sequence) of a fasta file
+def read_fasta(path):
+    name, sequence = None, []
+    for line in open_input(path):
+        if line.startswith(">"):
+            if name is not None:
+                yield name, "".join(sequence)
+            name, sequence = line[1:].split()[0], []
+        else:
+            sequence.append(line.strip())
+    if name is not None:
+        yield name, "".join(sequence)
+
+
+# yields (name, sequence, qualities) of a fastq file
+def read_fastq(path):
+    handle = open_input(path)
+    while True:
+        header = handle.readline()
+        if header == "":
+            break
+        sequence = handle.readline().strip()
+        handle.readline()
+        qualities = handle.readline().strip()
+        yield header[1:].split()[0], sequence, qualities
+
+
+# parses sam text into the header lines and records (list of fields)
+def parse_sam(lines):
+    header, records = [], []
+    for line in lines:
+        if line.startswith("@"):
+            header.append(line.rstrip("\n"))
+        elif line.strip() != "":
+            records.append(line.rstrip("\n").split("\t"))
+    return header, records
+
+
+# returns the reference names and lengths of sam header lines
+def sam_references(header):
+    references = []
+    for line in header:
+        if line.startswith("@SQ"):
+            fields = dict(field.split(":", 1) for field in line.split("\t")[1:])
+            references.append((fields["SN"], int(fields["LN"])))
+    return references
+
+
+# computes the bai bin of an alignment (see the sam specification)
+def reg2bin(begin, end):
+    end -= 1
+    if begin >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (begin >> 14)
+    if begin >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (begin >> 17)
+    if begin >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (begin >> 20)
+    if begin >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (begin >> 23)
+    if begin >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (begin >> 26)
+    return 0
+
+
+# encodes a sam record (list of fields) as bam record
+def encode_bam_record(fields, reference_index):
+    name, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual = fields[:11]
+    ops = [(int(length), bam_cigar_ops.index(op)) for length, op in re.findall(r"(\d+)([MIDNSHP=X])", cigar)]
+    ref_length = sum(length for length, op in ops if op in (0, 2, 3, 7, 8)) or 1
+    ref_id = reference_index.get(rname, -1)
+    pos = int(pos) - 1
+    next_id = ref_id if rnext == "=" else reference_index.get(rnext, -1)
+    seq = "" if seq == "*" else seq
+    packed = "".join(chr((bam_bases.index(seq[i]) << 4) | (bam_bases.index(seq[i + 1]) if i + 1 < len(seq) else 0))
+                     for i in range(0, len(seq), 2))
+    quals = "\xff" * len(seq) if qual == "*" else "".join(chr(ord(q) - 33) for q in qual)
+    tags = ""
+    for tag in fields[11:]:
+        key, tag_type, value = tag.split(":", 2)
+        if tag_type == "i":
+            tags += key + "i" + struct.pack("<i", int(value))
+        elif tag_type == "A":
+            tags += key + "A" + value
+        else:
+            tags += key + "Z" + value + "\x00"
+    body = struct.pack("<iiBBHHHiiii", ref_id, pos, len(name) + 1, int(mapq),
+                       reg2bin(max(pos, 0), max(pos, 0) + ref_length), len(ops), int(flag), len(seq), next_id,
+                       int(pnext) - 1, int(tlen)) + name + "\x00" + \
+        "".join(struct.pack("<I", length << 4 | op) for length, op in ops) + packed + quals + tags
+    return struct.pack("<i", len(body)) + body
+
+
+# compresses data into bgzf blocks
+def bgzf_compress(data, level=6):
+    blocks = []
+    for start in range(0, len(data), bgzf_block_size):
+        chunk = data[start:start + bgzf_block_size]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        blocks.append("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" +
+                      struct.pack("<H", len(compressed) + 25) + compressed +
+                      struct.pack("<II", zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return "".join(blocks) + bgzf_eof
+
+
+# writes sam header lines and records as bam file
+def write_bam(path, header, records, level=6):
+    references = sam_references(header)
+    reference_index = dict((name, i) for i, (name, length) in enumerate(references))
+    text = "\n".join(header) + "\n" if header else ""
+    data = ["BAM\x01", struct.pack("<i", len(text)), text, struct.pack("<i", len(references))]
+    for name, length in references:
+        data.append(struct.pack("<i", len(name) + 1) + name + "\x00" + struct.pack("<i", length))
+    for record in records:
+        data.append(encode_bam_record(record, reference_index))
+    output = sys.stdout if path in ("-", None) else open(path, "wb")
+    output.write(bgzf_compress("".join(data), level))
+    if output is not sys.stdout:
+        output.close()
+
+
+# decompresses all bgzf blocks of a file
+def bgzf_decompress(handle):
+    data = []
+    while True:
+        header = handle.read(18)
+        if len(header) < 18:
+            break
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        data.append(zlib.decompress(handle.read(block_size - 18)[:-8], -15))
+    return "".join(data)
+
+
+# reads a bam file into sam header lines and records (list of fields)
+def read_bam(path):
+    return decode_bam(bgzf_decompress(open_raw(path)))
+
+
+# decodes uncompressed bam data into sam header lines and records
+def decode_bam(data):
+    text_length = struct.unpack_from("<i", data, 4)[0]
+    header = [line for line in data[8:8 + text_length].split("\n") if line != ""]
+    offset = 8 + text_length
+    references = []
+    for i in range(struct.unpack_from("<i", data, offset)[0]):
+        name_length = struct.unpack_from("<i", data, offset + 4)[0]
+        references.append(data[offset + 8:offset + 7 + name_length])
+        offset += 8 + name_length
+    offset += 4
+    records = []
+    while offset < len(data):
+        size = struct.unpack_from("<i", data, offset)[0]
+        ref_id, pos, name_length, mapq, bin, cigar_length, flag, seq_length, next_id, next_pos, tlen = \
+            struct.unpack_from("<iiBBHHHiiii", data, offset + 4)
+        cursor = offset + 36
+        name = data[cursor:cursor + name_length - 1]
+        cursor += name_length
+        cigar = "".join(str(op >> 4) + bam_cigar_ops[op & 0xf]
+                        for op in struct.unpack_from("<%dI" % cigar_length, data, cursor)) or "*"
+        cursor += 4 * cigar_length
+        packed = data[cursor:cursor + (seq_length + 1) // 2]
+        seq = "".join(bam_bases[ord(b) >> 4] + bam_bases[ord(b) & 0xf] for b in packed)[:seq_length] or "*"
+        cursor += (seq_length + 1) // 2
+        quals = data[cursor:cursor + seq_length]
+        qual = "*" if seq_length == 0 or quals[0] == "\xff" else "".join(chr(ord(q) + 33) for q in quals)
+        cursor += seq_length
+        tags = []
+        while cursor < offset + 4 + size:
+            key, tag_type = data[cursor:cursor + 2], data[cursor + 2]
+            cursor += 3
+            if tag_type == "i":
+                tags.append(key + ":i:" + str(struct.unpack_from("<i", data, cursor)[0]))
+                cursor += 4
+            elif tag_type == "A":
+                tags.append(key + ":A:" + data[cursor])
+                cursor += 1
+            else:
+                end = data.index("\x00", cursor)
+                tags.append(key + ":Z:" + data[cursor:end])
+                cursor = end + 1
+        records.append([name, str(flag), references[ref_id] if ref_id >= 0 else "*", str(pos + 1), str(mapq), cigar,
+                        "*" if next_id < 0 else ("=" if next_id == ref_id else references[next_id]), str(next_pos + 1),
+                        str(tlen), seq, qual] + tags)
+        offset += 4 + size
+    return header, records
+
+
+# opens a file or stdin for binary reading
+def open_raw(path):
+    return sys.stdin if path == "-" else open(path, "rb")
+
+
+# reads sam, bgzip compressed sam or bam input (detected by the gzip magic of bgzf and the bam magic)
+def read_alignments(path):
+    data = open_raw(path).read()
+    if data[:2] == "\x1f\x8b":
+        data = bgzf_decompress(io.BytesIO(data))
+        if data[:4] == "BAM\x01":
+            return decode_bam(data)
+    return parse_sam(data.split("\n"))
+
+
+# sorts records by reference (unmapped last) and position
+def sort_records(header, records):
+    order = dict((name, i) for i, (name, length) in enumerate(sam_references(header)))
+    return sorted(records, key=lambda r: (order.get(r[2], len(order)), int(r[3])))
+
+
+# returns the option values and positional arguments of a command line. options_with_value lists the options which
+# take a value.
+def parse_arguments(arguments, options_with_value):
+    options, positional = {}, []
+    i = 0
+    while i < len(arguments):
+        if arguments[i] in options_with_value:
+            options[arguments[i]] = arguments[i + 1]
+            i += 2
+        elif arguments[i].startswith("-") and arguments[i] != "-":
+            options[arguments[i]] = True
+            i += 1
+        else:
+            positional.append(arguments[i])
+            i += 1
+    return options, positional
+
+
+##########################################
+#    END SECTION  FORMATS                #
+##########################################
+
+##########################################
+#    BEGIN SECTION  TOOLS                #
+##########################################
+
+# bwa: index writes the index files, mem "maps" reads to the contig and position encoded in their names
+# (read<n>|<contig>|<position>|<strand>|<mismatches>); other reads are reported unmapped
+def run_bwa(arguments):
+    if len(arguments) == 0:
+        sys.stderr.write("\nProgram: bwa (stand-in)\nVersion: 0.7.13-standin\n\n")
+        return 1
+    if arguments[0] == "index":
+        for extension in [".amb", ".ann", ".bwt", ".pac", ".sa"]:
+            with open(arguments[-1] + extension, "wb") as index_file:
+                index_file.write("stand-in\n")
+        return 0
+    if arguments[0] == "mem":
+        options, positional = parse_arguments(arguments[1:], ["-x", "-t", "-R"])
+        reference, reads = positional[0], positional[1:]
+        contigs = dict((name, len(sequence)) for name, sequence in read_fasta(reference))
+        out = sys.stdout
+        for name in sorted(contigs):
+            out.write("@SQ\tSN:" + name + "\tLN:" + str(contigs[name]) + "\n")
+        out.write("@PG\tID:bwa\tPN:bwa\tVN:0.7.13-standin\n")
+        for reads_file in reads:
+            for name, sequence, qualities in read_fastq(reads_file):
+                origin = name.split("|")
+                if len(origin) == 5 and origin[1] in contigs:
+                    flag = "16" if origin[3] == "-" else "0"
+                    out.write("\t".join([name, flag, origin[1], str(int(origin[2]) + 1), "60", str(len(sequence)) + "M",
+                                         "*", "0", "0", sequence, qualities, "NM:i:" + origin[4]]) + "\n")
+                else:
+                    out.write("\t".join([name, "4", "*", "0", "0", "*", "*", "0", "0", sequence, qualities]) + "\n")
+        return 0
+    return 1
+
+
+# samtools: sort, merge, index, view, stats, flagstat, faidx and fastq on small files
+def run_samtools(arguments):
+    if len(arguments) == 0 or arguments[0] == "--version":
+        sys.stdout.write("samtools 1.3-standin\n")
+        return 0
+    command, arguments = arguments[0], arguments[1:]
+    if command == "sort":
+        options, positional = parse_arguments(arguments, ["-@", "-T", "-o", "-O", "-m", "--reference"])
+        header, records = read_alignments(positional[0] if positional else "-")
+        write_bam(options.get("-o", "-"), header, sort_records(header, records))
+    elif command == "merge":
+        options, positional = parse_arguments(arguments, ["-@", "-O", "--reference"])
+        header, records = None, []
+        for input_file in positional[1:]:
+            input_header, input_records = read_bam(input_file)
+            header = header or input_header
+            records.extend(input_records)
+        write_bam(positional[0], header or [], sort_records(header or [], records))
+    elif command == "index":
+        with open(arguments[-1] + (".crai" if arguments[-1].endswith(".cram") else ".bai"), "wb") as index_file:
+            index_file.write("BAI\x01")
+    elif command == "view":
+        options, positional = parse_arguments(arguments, ["-@", "-o", "-O", "-T", "-F", "-f", "-q", "--reference"])
+        header, records = read_alignments(positional[0] if positional else "-")
+        if "-b" in options or "-u" in options or "-buh" in options or "-O" in options:
+            write_bam(options.get("-o", "-"), header, records, 0 if "-u" in options else 6)
+        else:
+            out = open(options["-o"], "wb") if "-o" in options else sys.stdout
+            if "-h" in options:
+                out.write("".join(line + "\n" for line in header))
+            for record in records:
+                out.write("\t".join(record) + "\n")
+    elif command in ("stats", "flagstat"):
+        header, records = read_bam(arguments[-1])
+        primary = [r for r in records if not int(r[1]) & 0x900]
+        mapped = [r for r in primary if not int(r[1]) & 0x4]
+        total_length = sum(len(r[9]) for r in primary if r[9] != "*")
+        if command == "flagstat":
+            sys.stdout.write("%d + 0 in total\n%d + 0 mapped\n" % (len(records), len(mapped)))
+        else:
+            sys.stdout.write("SN\traw total sequences:\t%d\nSN\treads mapped:\t%d\nSN\ttotal length:\t%d\n"
+                             "SN\taverage length:\t%d\n" % (len(primary), len(mapped), total_length,
+                                                           total_length // max(1, len(primary))))
+    elif command == "faidx":
+        with open(arguments[-1] + ".fai", "w") as index_file:
+            for name, sequence in read_fasta(arguments[-1]):
+                index_file.write(name + "\t" + str(len(sequence)) + "\n")
+    elif command == "fastq":
+        options, positional = parse_arguments(arguments, ["-@", "-F", "-f", "-0", "--reference"])
+        header, records = read_alignments(positional[0])
+        exclude = int(options.get("-F", "0x900"), 0)
+        out = open(options["-0"], "wb") if "-0" in options else sys.stdout
+        for record in records:
+            if not int(record[1]) & exclude and record[9] != "*":
+                out.write("@" + record[0] + "\n" + record[9] + "\n+\n" + record[10] + "\n")
+    else:
+        return 1
+    return 0
+
+
+# poretools: fasta/fastq of one fast5 file
+def run_poretools(arguments):
+    if len(arguments) < 2:
+        sys.stderr.write("usage: poretools (stand-in)\n")
+        return 1
+    import h5py
+    fast5 = h5py.File(arguments[1], "r")
+    for group in sorted(fast5.get("Analyses", {}).keys()):
+        if group.startswith("Basecall_2D") and "BaseCalled_2D/Fastq" in fast5["Analyses"][group]:
+            lines = bytes(fast5["Analyses"][group]["BaseCalled_2D/Fastq"][()]).strip().split("\n")
+            name = lines[0][1:] + " " + arguments[1]
+            if arguments[0] == "fasta":
+                sys.stdout.write(">" + name + "\n" + lines[1] + "\n")
+            else:
+                sys.stdout.write("@" + name + "\n" + lines[1] + "\n+\n" + lines[3] + "\n")
+            break
+    fast5.close()
+    return 0
+
+
+# plot-bamstats: writes index.html with the tables gru scrapes and empty charts
+def run_plot_bamstats(arguments):
+    options, positional = parse_arguments(arguments, ["-p"])
+    stats = {}
+    for line in open(positional[0]):
+        if line.startswith("SN"):
+            key, value = line.split("\t")[1:3]
+            stats[key.rstrip(":")] = int(value)
+    output_folder = options["-p"]
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    total, mapped = stats.get("raw total sequences", 0), stats.get("reads mapped", 0)
+    percent = "(%.1f%%)" % (100.0 * mapped / total if total else 0.0)
+    rows = [("total", total, ""), ("filtered", 0, "(0%)"), ("non-primary", 0, "(0%)"), ("duplicated", 0, "(0%)"),
+            ("mapped", mapped, percent), ("zero MQ", 0, "(0%)"), ("avg read length", stats.get("average length", 0), "")]
+    bases = [("total", stats.get("total length", 0), "(100%)"), ("mapped", stats.get("total length", 0), ""),
+             ("error rate", 0, "")]
+    with open(output_folder + "index.html", "w") as html:
+        html.write('<html><body><table class="nums"><tr><th>Reads</th></tr><tr><td><table>')
+        html.write("".join("<tr><td>%s</td><td>%s</td><td>%s</td></tr>" % row for row in rows))
+        html.write('</table></td></tr><tr><th>Bases</th></tr><tr><td><table>')
+        html.write("".join("<tr><td>%s</td><td>%s</td><td>%s</td></tr>" % row for row in bases))
+        html.write("</table></td></tr></table></body></html>")
+    for chart in plot_bamstats_charts:
+        with open(output_folder + chart + ".png", "wb") as png:
+            png.write(empty_png)
+    return 0
+
+
+# bgzip: -c compresses stdin to stdout, -d -c decompresses a file to stdout
+def run_bgzip(arguments):
+    options, positional = parse_arguments(arguments, ["-@"])
+    if "-h" in options:
+        sys.stderr.write("Version: 1.3-standin\nUsage:   bgzip [OPTIONS] [FILE] ...\n")
+        return 1
+    if "-d" in options:
+        sys.stdout.write(bgzf_decompress(open_raw(positional[0] if positional else "-")))
+        return 0
+    while True:
+        data = sys.stdin.read(64 * bgzf_block_size)
+        if data == "":
+            break
+        sys.stdout.write(bgzf_compress(data)[:-len(bgzf_eof)])
+    sys.stdout.write(bgzf_eof)
+    return 0
+
+
+# returns the origins (contig, start, end, strand, name, sequence) of simulated reads sorted by contig and start, reads
+# without origin (random reads) are left out
+def read_origins(path):
+    origins = []
+    for name, sequence, qualities in read_fastq(path):
+        origin = name.split("|")
+        if len(origin) == 5:
+            origins.append((origin[1], int(origin[2]), int(origin[2]) + len(sequence), origin[3], name, sequence))
+    return sorted(origins)
+
+
+# minimap: all-vs-all overlaps (paf) of the simulated reads, taken from the origins in their names
+def run_minimap(arguments):
+    options, positional = parse_arguments(arguments, [])
+    if len(positional) < 2:
+        sys.stderr.write("Usage: minimap [options] <target.fa> <query.fa> (stand-in)\n")
+        return 1
+    origins = read_origins(positional[1])
+    for i, (contig, start, end, strand, name, sequence) in enumerate(origins):
+        for other_contig, other_start, other_end, other_strand, other_name, other_sequence in origins[i + 1:]:
+            if other_contig != contig or other_start >= end:
+                break
+            overlap = min(end, other_end) - other_start
+            sys.stdout.write("\t".join([name, str(end - start), str(other_start - start), str(other_start - start + overlap),
+                                        "+" if strand == other_strand else "-", other_name,
+                                        str(other_end - other_start), "0", str(overlap), str(overlap), str(overlap),
+                                        "255"]) + "\n")
+    return 0
+
+
+# miniasm: lays out the overlapping simulated reads of every contig at their origins and writes one unitig per
+# stretch covered by at least two reads as gfa segment
+def run_miniasm(arguments):
+    options, positional = parse_arguments(arguments, ["-f"])
+    if "-f" not in options:
+        sys.stderr.write("Usage: miniasm [options] <in.paf> (stand-in)\n")
+        return 1
+    complement = {"A": "T", "C": "G", "G": "C", "T": "A"}
+    sys.stdout.write("H\tVN:Z:1.0\n")
+    unitigs, layout = 0, None
+    for contig, start, end, strand, name, sequence in read_origins(options["-f"]) + [(None, 0, 0, "+", None, "")]:
+        if layout is not None and (contig != layout["contig"] or start >= layout["end"]):
+            if layout["reads"] > 1:
+                unitigs += 1
+                sys.stdout.write("S\tutg%06dl\t%s\tLN:i:%d\n" % (unitigs, "".join(layout["bases"]), len(layout["bases"])))
+            layout = None
+        if contig is None:
+            break
+        if strand == "-":
+            sequence = "".join(complement.get(b, "N") for b in reversed(sequence))
+        if layout is None:
+            layout = {"contig": contig, "start": start, "end": start, "bases": [], "reads": 0}
+        layout["bases"].extend(sequence[layout["end"] - start:])
+        layout["end"] = max(layout["end"], end)
+        layout["reads"] += 1
+    return 0
+
+
+# nanopolish: index writes the read index, variants --consensus writes the draft as consensus
+def run_nanopolish(arguments):
+    if len(arguments) == 0:
+        sys.stderr.write("usage: nanopolish [command] [options] (stand-in)\n")
+        return 1
+    options, positional = parse_arguments(arguments[1:], ["-d", "--consensus", "-r", "-b", "-g", "-t", "-w"])
+    if arguments[0] == "index":
+        with open(positional[0] + ".index", "w") as index_file:
+            index_file.write(options["-d"] + "\n")
+        return 0
+    if arguments[0] == "variants":
+        with open(options["-g"], "rb") as draft, open(options["--consensus"], "wb") as consensus:
+            consensus.write(draft.read())
+        return 0
+    return 1
+
+
+# quast: writes report.tsv with the size statistics of the assembly and the length of the reference
+def run_quast(arguments):
+    options, positional = parse_arguments(arguments, ["-o", "-R", "-t", "-l"])
+    lengths = sorted((len(sequence) for name, sequence in read_fasta(positional[0])), reverse=True)
+    reference_length = sum(len(sequence) for name, sequence in read_fasta(options["-R"]))
+    n50, covered = 0, 0
+    for length in lengths:
+        covered += length
+        if 2 * covered >= sum(lengths):
+            n50 = length
+            break
+    if not os.path.exists(options["-o"]):
+        os.makedirs(options["-o"])
+    with open(os.path.join(options["-o"], "report.tsv"), "w") as report:
+        report.write("Assembly\t" + options.get("-l", "assembly") + "\n# contigs\t%d\nLargest contig\t%d\n"
+                     "Total length\t%d\nReference length\t%d\nN50\t%d\nGenome fraction (%%)\t%.3f\n"
+                     % (len(lengths), lengths[0] if lengths else 0, sum(lengths), reference_length, n50,
+                        min(100.0, 100.0 * sum(lengths) / max(1, reference_length))))
+    return 0
+
+
+# R: only the version check of gru
+def run_r(arguments):
+    sys.stdout.write("R version 3.3.0 (stand-in)\n")
+    return 0
+
+
+# sbatch: local fake scheduler, runs the job script detached on this host. The job id is the process id.
+def run_sbatch(arguments):
+    options, positional = parse_arguments(arguments, ["-c", "-o", "-e", "-p", "-J", "--mem", "-t"])
+    log = open(options.get("-o", os.devnull), "ab")
+    job = subprocess.Popen(["/bin/sh", positional[0]], stdin=open(os.devnull), stdout=log, stderr=log,
+                           preexec_fn=os.setsid)
+    sys.stdout.write(str(job.pid) + "\n" if "--parsable" in options else "Submitted batch job " + str(job.pid) + "\n")
+    return 0
+
+
+# squeue -h -j <id>: lists the job while its process is running
+def run_squeue(arguments):
+    options, positional = parse_arguments(arguments, ["-j"])
+    try:
+        os.kill(int(options["-j"]), 0)
+    except OSError:
+        return 0
+    with open("/proc/" + options["-j"] + "/stat") as stat:
+        if stat.read().split(")")[-1].split()[0] == "Z":
+            return 0  # finished, waiting to be reaped
+    sys.stdout.write(options["-j"] + " R\n")
+    return 0
+
+
+##########################################
+#    END SECTION  TOOLS                  #
+##########################################
+
+# stand-in commands by tool name
+tools = {"bwa": run_bwa, "samtools": run_samtools, "poretools": run_poretools, "plot-bamstats": run_plot_bamstats,
+         "R": run_r, "bgzip": run_bgzip, "sbatch": run_sbatch, "squeue": run_squeue, "minimap": run_minimap,
+         "miniasm": run_miniasm, "nanopolish": run_nanopolish, "quast": run_quast}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in tools:
+        sys.stderr.write("Usage: standins.py <" + "|".join(sorted(tools)) + "> <arguments...>\n")
+        sys.exit(1)
+    sys.exit(tools[sys.argv[1]](sys.argv[2:]))
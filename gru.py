@@ -13,13 +13,36 @@ import yaml
 import tarfile
 import shutil
 import time
+import threading
 import base64
 from lxml import etree
 from pprint import pprint
 import re
+
+try:
+    import h5py
+except ImportError:
+    h5py = None  # fast5 files are converted by poretools then
+import hashlib
+import json
+import multiprocessing
+import collections
+import io
+import struct
+import zlib
+import math
+import numpy
+import resource
+import signal
+import tempfile
+import shlex
+import pipes
+import fcntl
+import Queue
+import mmap
 ###################################################################################
 ##                                                                               ##
-##                        USAGE: ./gru.py job.yml                                ##
+##                   USAGE: ./gru.py [--watch] job.yml                           ##
 ##                                                                               ##
 ###################################################################################
 
@@ -32,16 +55,107 @@ debug_enabled = False
 # default usage mesaaage
 msg_usage = "Gru v0.1\n" \
             "Description: pipleine to map nanopore/minion 2D reads to the reference genomes and calulate statisical data\n" \
-            "Usage: gru.py <config-file>\n"
+            "Usage: gru.py [--watch] <config-file>\n" \
+            "       gru.py batch [--cores <n>] [--memory-gb <n>] [--jobs <n>] <config-file>...\n" \
+            "       gru.py coverage <config-file> <prefix> <contig>[:<start>-<end>]\n" \
+            "       gru.py reads <config-file> <prefix>|unmapped [<output-fastq>]\n" \
+            "       gru.py read-metrics [--min-length <n>] [--min-quality <q>] <read-metrics-file>|<config-file>...\n"
 
 # param vars
 defaults = {}
 params = {}
+config_path = ""
 
 # folder vars
 project_folder = ""
 temp_folder = ""
 log_folder = ""
+# node local folder of this job inside of the scratch_folder setting (None if no scratch folder is used)
+scratch_folder = None
+
+# name of the job in batch mode, prefixes the messages
+job_name = None
+# cores shared by the jobs of a batch (set by run_batch, None for a single job)
+core_budget = None
+# index cache shared by the jobs of a batch which do not configure index_cache_folder
+batch_index_cache_folder = None
+# seconds between two checks for free cores of a stage waiting in a batch
+core_poll_interval = 0.5
+
+# buffer size for reading and writing sam streams (bytes)
+demultiplex_buffer_size = 4 * 1024 * 1024
+# fastq records written to a shard at once when compressed reads are split
+shard_chunk_records = 4096
+
+# files written by bwa index next to the indexed fasta file
+bwa_index_extensions = [".amb", ".ann", ".bwt", ".pac", ".sa"]
+# chunk size for hashing reference files (bytes)
+index_cache_chunk_size = 1024 * 1024
+# chunk size for copying the (decompressed) reference files into the concatenated references (bytes)
+reference_chunk_size = 4 * 1024 * 1024
+# file of the index folder which maps the contig names of the concatenated references to the organisms, the original
+# contig names and the contig lengths
+contig_map_name = "contig_map.tsv"
+
+# dataset of a Basecall_2D_<n> group which holds the 2D reads in fastq format
+fast5_2d_fastq = "BaseCalled_2D/Fastq"
+# number of fast5 files handed to an extraction worker at once
+extraction_chunk_size = 16
+# counters of the read filter and number of fastq records filtered at once
+read_filter_counters = ["reads_total", "reads_passed", "reads_too_short", "reads_low_quality", "bases_total",
+                        "bases_passed", "bases_trimmed"]
+read_filter_batch_size = 10000
+# name of an Illumina read file with the mate number (group 2) of a pair, e.g. <name>_R1_001.fastq.gz or <name>_2.fq
+illumina_mate_pattern = re.compile(r"^(.*[._-]R?)([12])((?:[._-]\d+)?\.f(?:ast)?q(?:\.gz)?)$")
+# bytes read at once when reads are extracted from compressed reads files through the read index
+read_index_skip_size = 4 * 1024 * 1024
+
+# counters and histograms of the native bam statistics (reads_filtered counts the reads dropped by filter options like
+# samtools stats does, i.e. none, reads_qc_failed the reads flagged as QC failed)
+bam_stats_counters = ["reads_total", "reads_filtered", "reads_qc_failed", "reads_non_primary", "reads_duplicated",
+                      "reads_mapped", "reads_zero_mq", "bases_total", "bases_mapped", "mismatches"]
+bam_stats_histograms = ["read_length", "quality", "gc", "mapq", "insertions", "deletions"]
+bam_stats_batch_columns = ["length", "flag", "mapq", "seq", "qual", "bases_mapped", "mismatches", "insertions",
+                           "deletions"]
+# number of alignments accumulated before they are added to the statistics
+bam_stats_batch_size = 10000
+# cigar operations which consume query bases aligned to the reference (M, I, =, X)
+cigar_query_mapped = (0, 1, 7, 8)
+# byte sizes and struct formats of the fixed size bam tag types
+bam_tag_sizes = {"A": 1, "c": 1, "C": 1, "s": 2, "S": 2, "i": 4, "I": 4, "f": 4}
+bam_tag_formats = {"A": "c", "c": "b", "C": "B", "s": "h", "S": "H", "i": "i", "I": "I", "f": "f"}
+# charts of the native statistics: histogram, title, x axis label
+native_stat_graphs = [("read_length", "Read length", "read length (bp)"),
+                      ("quality", "Base quality", "phred quality"),
+                      ("gc", "GC content", "GC content per read (%)"),
+                      ("mapq", "Mapping quality", "MAPQ"),
+                      ("insertions", "Insertion length", "insertion length (bp)"),
+                      ("deletions", "Deletion length", "deletion length (bp)")]
+# maximum number of bars of a chart
+chart_max_bars = 100
+# cigar operations which cover reference bases (M, =, X) and which skip reference bases (D, N)
+cigar_reference_covered = (0, 7, 8)
+cigar_reference_skipped = (2, 3)
+# alignments which do not count for the coverage (unmapped, secondary, qc fail, duplicate), like samtools depth
+coverage_excluded_flags = 0x704
+# depths of the breadth of coverage columns
+coverage_breadth_depths = [1, 5, 10]
+# number of largest gaps listed per organism
+coverage_max_gaps = 20
+# number of contigs listed in the coverage table of the report
+coverage_report_contigs = 50
+# columns of the per-read metrics table and their types (keys: read name keys of the read index, organism: position
+# of the organism in the organisms column, -1 for unmapped reads)
+read_metrics_columns = [("keys", numpy.uint64), ("length", numpy.uint32), ("mean_quality", numpy.float32),
+                        ("organism", numpy.int16), ("mapq", numpy.uint8), ("flag", numpy.uint16),
+                        ("aligned_fraction", numpy.float32), ("identity", numpy.float32),
+                        ("secondary", numpy.uint16), ("supplementary", numpy.uint16)]
+read_metrics_batch_columns = ["name", "length", "qual", "organism", "mapq", "flag", "aligned", "columns", "mismatches",
+                              "secondary", "supplementary"]
+# number of reads accumulated before they are added to the per-read metrics table
+read_metrics_batch_size = 10000
+# file name of the per-read metrics table of a demultiplexed mapping
+read_metrics_name = "read_metrics.npz"
 
 
 ##########################################
@@ -50,7 +164,7 @@ log_folder = ""
 
 # abort func to close the programm in case of an error
 def abort(message, code, usage=False):
-    print("ABORT: " + str(message) + " (ERROR " + str(code) + ")")
+    print(message_prefix() + "ABORT: " + str(message) + " (ERROR " + str(code) + ")")
     if usage:
         print("\n" + msg_usage)
     sys.exit(code)
@@ -58,13 +172,18 @@ def abort(message, code, usage=False):
 
 # warning func to show warnings
 def warning(message):
-    print("WARNING: " + str(message))
+    print(message_prefix() + "WARNING: " + str(message))
 
 
 # debug log func to show debugging messages
 def debug(message):
     if bool(params["software_settings"]["gru_debug"]) == True:
-        print("DEBUG: " + str(message))
+        print(message_prefix() + "DEBUG: " + str(message))
+
+
+# returns the job name prefix of messages in batch mode
+def message_prefix():
+    return "[" + job_name + "] " if job_name is not None else ""
 
 
 ##########################################
@@ -77,7 +196,8 @@ def debug(message):
 
 # reads configuration file
 def read_config(file):
-    global params
+    global params, config_path
+    config_path = os.path.abspath(file)
     try:
         with open(file, 'r') as config_file:
             # load params in YAML format
@@ -88,13 +208,20 @@ def read_config(file):
         abort("Could not read the config file", 1, True)
 
 
+# returns an optional setting of the config file or the given default if it is not set
+def get_setting(section, key, default=None):
+    if params.get(section) is not None and params[section].get(key) is not None:
+        return params[section][key]
+    return default
+
+
 # checks configuration file for correct settings
 def check_config():
     global project_folder
 
     # check project folder existence
     if os.path.exists(params["project_settings"]["project_folder"]):
-        if bool(params["project_settings"]["overwrite_folder"]) == False:
+        if bool(params["project_settings"]["overwrite_folder"]) == False and not resume_enabled():
             abort("Project output folder exists. But overwrite_folder is not 'True'", 1, True)
     # check nanopore input files tar.gz or as folder
     if params["nanopore_input"].endswith("tar.gz"):
@@ -179,41 +306,313 @@ def check_software():
         else:
             abort("Something went wrong by checking for poretools", 23)
 
+    if use_assembly():
+        for section, key, name, code in [("software_assembler", "minimap", "Minimap", 73),
+                                         ("software_assembler", "miniasm", "Miniasm", 75),
+                                         ("software_general", "quast", "Quast", 79)] + \
+                ([("software_assembler", "nanopolish", "Nanopolish", 77)] if use_assembly_polishing() else []):
+            try:
+                p = subprocess.Popen([params[section][key]], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+                out, err = p.communicate()
+            except OSError as e:
+                if e.errno == os.errno.ENOENT:
+                    abort(name + " executable could not be started. Wrong path?", code)
+                else:
+                    abort("Something went wrong by checking for " + name, code + 1)
+        if use_assembly_polishing() and params["nanopore_input"].endswith("tar.gz"):
+            abort("Polishing the assemblies requires a folder as nanopore input", 81)
+
+    if use_compressed_storage():
+        try:
+            p = subprocess.Popen([get_bgzip(), "-h"], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+            out, err = p.communicate()
+        except OSError as e:
+            if e.errno == os.errno.ENOENT:
+                abort("Bgzip executable could not be started. Wrong path?", 61)
+            else:
+                abort("Something went wrong by checking for bgzip", 61)
 
-# cleans project folder if overwrite is enabled and folder exists
+
+# cleans project folder if overwrite is enabled and folder exists. Resumed runs keep the folder.
 def clean_project_folder():
+    if resume_enabled():
+        debug("Resuming in the existing project output folder")
+        return
     if os.path.exists(params["project_settings"]["project_folder"]):
         if bool(params["project_settings"]["overwrite_folder"]) == True:
             shutil.rmtree(params["project_settings"]["project_folder"])
         debug("Project output folder cleaned")
 
 
+# returns True if a rerun should skip the stages which are still up to date
+def resume_enabled():
+    return bool(get_setting("project_settings", "resume", False)) == True
+
+
+# creates a folder (and its parents) if it does not exist yet
+def create_folder(folder, message, code):
+    if os.path.isdir(folder):
+        return
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):  # may have been created concurrently
+            abort(message, code)
+
+
+# returns the folder of the converted nanopore reads
+def get_reads_folder():
+    return project_folder + params["gru_settings"]["nanopore_reads_foldername"] + "/"
+
+
+# returns the path of the converted nanopore reads with the given extension (.fasta, .fastq), bgzip compressed
+# (.gz) in compressed storage mode
+def get_reads_file(extension):
+    return get_reads_folder() + params["gru_settings"]["nanopore_reads_filename"] + extension + compressed_suffix()
+
+
+# returns True if reads are stored bgzip compressed and alignments as cram (storage_mode: compressed)
+def use_compressed_storage():
+    return get_setting("software_settings", "storage_mode", "plain") == "compressed"
+
+
+# returns the suffix of bgzip compressed text files (empty in plain storage mode)
+def compressed_suffix():
+    return ".gz" if use_compressed_storage() else ""
+
+
+# returns the extension of the alignment files (.bam, .cram in compressed storage mode)
+def alignment_extension():
+    return ".cram" if use_compressed_storage() else ".bam"
+
+
+# returns the alignment file of an organism in the given folder (default: the splitted folder)
+def get_alignment_file(prefix, folder=None):
+    return (get_splitted_folder() if folder is None else folder) + prefix + alignment_extension()
+
+
+# returns the index file of an alignment file (.bai or .crai)
+def get_alignment_index(alignment_file):
+    return alignment_file + (".crai" if alignment_file.endswith(".cram") else ".bai")
+
+
+# returns the samtools options which select the concatenated references for cram encoding and decoding
+def reference_options():
+    if not use_compressed_storage():
+        return []
+    return ["--reference", get_index_folder() + "_contigs.fasta"]
+
+
+# returns the samtools options of commands which write alignment files (cram in compressed storage mode)
+def alignment_output_options():
+    if not use_compressed_storage():
+        return []
+    return ["-O", "cram"] + reference_options()
+
+
+# returns the threads of the bgzip processes which compress and decompress the reads
+def compression_threads():
+    return max(1, int(get_setting("software_settings", "compression_threads",
+                                  params["software_settings"]["sorting_threads"])))
+
+
+# returns the folder of the sorted Illumina alignments of the organisms
+def get_illumina_folder():
+    return get_work_folder() + params["gru_settings"]["mapping_foldername"] + "/illumina/"
+
+
+# returns the statistics folder of the Illumina alignments of an organism
+def get_illumina_stats_folder(prefix):
+    return get_stats_folder() + "illumina/" + prefix + "/"
+
+
+# returns the Illumina read files of an organism (empty if it has none or enable_illumina is off)
+def get_illumina_files(prefix):
+    if bool(params["illumina_reads"]["enable_illumina"]) != True:
+        return []
+    for gen in params["file_mapping"]:
+        if params["file_mapping"][gen]["prefix"] == prefix and params["file_mapping"][gen].has_key("illumina"):
+            illumina_files = params["file_mapping"][gen]["illumina"]
+            if isinstance(illumina_files, str):
+                illumina_files = [illumina_files]
+            return [params["illumina_reads"]["folder"] + illumina_file for illumina_file in illumina_files]
+    return []
+
+
+# returns the prefixes of the organisms with Illumina reads in a stable order
+def get_illumina_prefixes():
+    return [prefix for prefix in get_prefixes() if len(get_illumina_files(prefix)) > 0]
+
+
+# returns the reference file of an organism
+def get_reference_file(prefix):
+    for gen in params["file_mapping"]:
+        if params["file_mapping"][gen]["prefix"] == prefix:
+            return params["references"]["folder"] + params["file_mapping"][gen]["reference"]
+
+
+# returns the assembly folder of an organism (asm/<prefix>/), it takes the reads, the assembly and its evaluation
+def get_assembly_folder(prefix):
+    return project_folder + params["gru_settings"]["assembler_outputs_foldername"] + "/" + prefix + "/"
+
+
+# returns the folder of the miniasm assembly of an organism
+def get_miniasm_folder(prefix):
+    return get_assembly_folder(prefix) + params["gru_settings"]["miniasm_output_foldername"] + "/"
+
+
+# returns the folder of the polished assembly of an organism
+def get_polishing_folder(prefix):
+    return get_assembly_folder(prefix) + "nanopolish/"
+
+
+# returns the folder of the quast evaluation of an organism
+def get_quast_folder(prefix):
+    return get_assembly_folder(prefix) + params["gru_settings"]["quast_output_foldername"] + "/"
+
+
+# returns the assembly of an organism which is evaluated and reported: the polished contigs if polishing is enabled,
+# otherwise the miniasm contigs
+def get_assembly_file(prefix):
+    if use_assembly_polishing():
+        return get_polishing_folder(prefix) + prefix + ".fasta"
+    return get_miniasm_folder(prefix) + prefix + ".fasta"
+
+
+# returns the read index of a fastq file (default: the converted nanopore reads)
+def get_read_index_file(reads_fastq=None):
+    return (get_reads_file(".fastq") if reads_fastq is None else reads_fastq) + ".idx.npz"
+
+
+# returns the folder of the read index parts which watch mode writes next to a read index (one per micro-batch, merged
+# into the read index when watch mode finishes)
+def get_read_index_parts_folder(index_file=None):
+    return (get_read_index_file() if index_file is None else index_file)[:-len(".npz")] + "-parts/"
+
+
+# returns the folder of the filtered reads and the read filter summary
+def get_filtered_reads_folder():
+    return project_folder + "filtered_reads/"
+
+
+# returns the fastq file which is mapped: the filtered reads if the read filter is enabled, otherwise all reads
+def get_mapping_reads_file():
+    if not use_read_filter():
+        return get_reads_file(".fastq")
+    return get_filtered_reads_folder() + params["gru_settings"]["nanopore_reads_filename"] + ".fastq" + \
+        compressed_suffix()
+
+
+# returns the file of the read filter summary
+def get_read_filter_summary():
+    return get_filtered_reads_folder() + "read_filter.json"
+
+
+# returns the folder of the concatenated references and their bwa index
+def get_index_folder():
+    return project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/"
+
+
+# returns the mapping folder
+def get_mapping_folder():
+    return project_folder + params["gru_settings"]["mapping_foldername"] + "/"
+
+
+# returns the file of all alignments written by the non-streaming mapping (mapped.sam, mapped.cram in compressed
+# storage mode)
+def get_mapping_file():
+    return get_work_folder() + params["gru_settings"]["mapping_foldername"] + "/mapped" + \
+           (".cram" if use_compressed_storage() else ".sam")
+
+
+# returns the folder of the per organism mapping files. They are processed in the scratch folder (if set) and the
+# finished files are copied back into the same folder of the project by copy_back.
+def get_splitted_folder():
+    return get_work_folder() + params["gru_settings"]["mapping_foldername"] + "/splitted/"
+
+
+# returns the folder which takes the temporary files and the processing of the alignments: the scratch folder of the
+# job, or the project folder if no scratch folder is used
+def get_work_folder():
+    return project_folder if scratch_folder is None else scratch_folder
+
+
+# returns the place of a file of the work folder in the project folder
+def project_path(path):
+    if scratch_folder is None or not path.startswith(scratch_folder):
+        return path
+    return project_folder + path[len(scratch_folder):]
+
+
+# returns the statistics folder
+def get_stats_folder():
+    return project_folder + "stats/"
+
+
+# returns the folder of the coverage index of an organism
+def get_coverage_folder(prefix):
+    return project_folder + "coverage/" + prefix + "/"
+
+
+# returns the per-read metrics table of the nanopore reads
+def get_read_metrics_file():
+    return get_stats_folder() + read_metrics_name
+
+
+# returns the folder of the parts of a per-read metrics table (tables of shards and micro-batches which are combined
+# into the table)
+def get_read_metrics_parts_folder(metrics_file):
+    return metrics_file[:-len(".npz")] + "-parts/"
+
+
+# returns the organism prefixes in a stable order
+def get_prefixes():
+    return sorted(params["file_mapping"][gen]["prefix"] for gen in params["file_mapping"])
+
+
 # creates project folder if not exists
 def create_project_folder():
     if not os.path.exists(params["project_settings"]["project_folder"]):
-        try:
-            os.makedirs(params["project_settings"]["project_folder"])
-        except:
-            abort("Could not create the project folder!", 24)
+        create_folder(params["project_settings"]["project_folder"], "Could not create the project folder!", 24)
 
 
 # crates temporary folder
 def create_temp_folder():
     global temp_folder
+    create_folder(get_work_folder() + params["gru_settings"]["temp_foldername"] + "/", "Could not create the nanopore output folder folder!", 26)
+    temp_folder = get_work_folder() + params["gru_settings"]["temp_foldername"] + "/"
+
+
+# creates the scratch folder of the job, a new folder inside of the scratch_folder setting (e.g. on a node local disk
+# or tmpfs). It is removed by remove_scratch_folder when the job ends, also if it is aborted.
+def create_scratch_folder():
+    global scratch_folder
+    scratch_root = get_setting("software_settings", "scratch_folder")
+    if scratch_root is None:
+        return
+    if get_executor() == "queue":
+        warning("Jobs of the batch queue can not reach a node local scratch folder, scratch_folder is ignored")
+        return
+    create_folder(scratch_root, "Could not create the scratch folder!", 63)
     try:
-        os.makedirs(project_folder + params["gru_settings"]["temp_foldername"] + "/")
-    except:
-        abort("Could not create the nanopore output folder folder!", 26)
-    temp_folder = project_folder + params["gru_settings"]["temp_foldername"] + "/"
+        scratch_folder = tempfile.mkdtemp(prefix="gru-", dir=scratch_root) + "/"
+    except OSError:
+        abort("Could not create the scratch folder!", 63)
+    debug("Processing in the scratch folder " + scratch_folder)
+
+
+# waits for the pending copies and removes the scratch folder of the job
+def remove_scratch_folder():
+    if scratch_folder is None:
+        return
+    stop_copy_back()
+    shutil.rmtree(scratch_folder, ignore_errors=True)
 
 
 # creates log folder
 def create_log_folder():
     global log_folder
-    try:
-        os.makedirs(project_folder + "log" + "/")
-    except:
-        abort("Could not create the log folder!", 34)
+    create_folder(project_folder + "log" + "/", "Could not create the log folder!", 34)
     log_folder = project_folder + "log" + "/"
 
 
@@ -224,44 +623,655 @@ def run_prerequisites():
 
     clean_project_folder()
     create_project_folder()
+    create_scratch_folder()
     create_temp_folder()
     create_log_folder()
 
 
+# files of the scratch folder which wait to be copied back, the copying thread and the files it failed to copy
+copy_back_queue = Queue.Queue()
+copy_back_thread = None
+copy_back_failed = []
+
+
+# copies finished files of the scratch folder to the same place in the project folder. The copies are made by a
+# background thread while the following stages go on, finish_copy_back waits for them. Without scratch folder the
+# files are in the project folder already.
+def copy_back(files):
+    global copy_back_thread
+    if scratch_folder is None:
+        return
+    if copy_back_thread is None:
+        copy_back_thread = threading.Thread(target=run_copy_back)
+        copy_back_thread.daemon = True
+        copy_back_thread.start()
+    for path in files:
+        copy_back_queue.put(path)
+
+
+# copies the files of the copy back queue until it gets None. Every file is copied under a temporary name and renamed,
+# so the project folder never holds a partial copy.
+def run_copy_back():
+    while True:
+        path = copy_back_queue.get()
+        if path is None:
+            return
+        target = project_path(path)
+        try:
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(path, target + ".tmp")
+            os.rename(target + ".tmp", target)
+            debug("Copied " + target + " back from the scratch folder")
+        except (IOError, OSError) as e:
+            copy_back_failed.append(target + " (" + str(e) + ")")
+
+
+# waits until the copy back thread copied all queued files
+def stop_copy_back():
+    global copy_back_thread
+    if copy_back_thread is None:
+        return
+    copy_back_queue.put(None)
+    copy_back_thread.join()
+    copy_back_thread = None
+
+
+# waits for the copy back of the finished files, aborts if a file could not be copied
+def finish_copy_back():
+    stop_copy_back()
+    if len(copy_back_failed) > 0:
+        abort("Could not copy back into the project folder: " + ", ".join(copy_back_failed), 64)
+
+
 ##########################################
 #    END SECTION  CONFIGURATION          #
 ##########################################
 
+##########################################
+#    BEGIN SECTION  PROFILING            #
+##########################################
+
+# profile records of all stages and tool invocations (written to log/profile.jsonl) and the number of records written
+profile_records = []
+profile_written = 0
+# first record shown in the report (watch mode shows the records since the latest micro-batch started)
+profile_report_start = 0
+profile_lock = threading.Lock()
+# name of the stage running in the current thread
+profile_context = threading.local()
+
+
+# returns the name of the stage running in the current thread
+def current_stage():
+    return getattr(profile_context, "stage", None)
+
+
+# adds a profile record and appends it to log/profile.jsonl (one json object per line), together with the records
+# made before the log folder existed. The first write of a run replaces the records of the previous run.
+def record_profile(record):
+    global profile_written
+    with profile_lock:
+        profile_records.append(record)
+        if log_folder == "":
+            return
+        with open(log_folder + "profile.jsonl", "a" if profile_written > 0 else "w") as profile_file:
+            for written in profile_records[profile_written:]:
+                profile_file.write(json.dumps(written, sort_keys=True) + "\n")
+        profile_written = len(profile_records)
+
+
+# waits for a started process and records its wall clock time, cpu time, peak memory, block io (as reported by wait4
+# for the process and its waited-for children) and exit code. Returns the exit code.
+def wait_process(p, command, started):
+    if p.returncode is not None:
+        return p.returncode
+    while True:
+        try:
+            pid, status, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != os.errno.EINTR:
+                raise
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    record_profile({"type": "tool", "name": os.path.basename(command.split(" ")[0]), "command": command,
+                    "stage": current_stage(), "wall_seconds": time.time() - started,
+                    "user_seconds": usage.ru_utime, "system_seconds": usage.ru_stime,
+                    "max_rss_kb": usage.ru_maxrss, "read_bytes": usage.ru_inblock * 512,
+                    "written_bytes": usage.ru_oublock * 512, "exit_code": p.returncode})
+    return p.returncode
+
+
+# runs a python stage function in the current thread and records its wall clock time, the cpu time of gru itself and of
+# all children which finished meanwhile, and the peak memory of gru. Returns the result of function.
+def profile_stage(name, function):
+    parent_stage = current_stage()
+    profile_context.stage = name
+    started = time.time()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = None
+    try:
+        result = function()
+        return result
+    finally:
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record_profile({"type": "stage", "name": name, "stage": parent_stage, "wall_seconds": time.time() - started,
+                        "user_seconds": self_after.ru_utime - self_before.ru_utime,
+                        "system_seconds": self_after.ru_stime - self_before.ru_stime,
+                        "children_user_seconds": children_after.ru_utime - children_before.ru_utime,
+                        "children_system_seconds": children_after.ru_stime - children_before.ru_stime,
+                        "max_rss_kb": self_after.ru_maxrss,
+                        "read_bytes": (self_after.ru_inblock - self_before.ru_inblock) * 512,
+                        "written_bytes": (self_after.ru_oublock - self_before.ru_oublock) * 512,
+                        "exit_code": 0 if result is None or result is True or (result is not False and result == 0) else 1})
+        profile_context.stage = parent_stage
+
+
+##########################################
+#    END SECTION  PROFILING              #
+##########################################
+
+##########################################
+#    BEGIN SECTION  SCHEDULING           #
+##########################################
+
+# slots of the pool executor and job counter of the queue executor
+executor_slots = None
+executor_lock = threading.Lock()
+queue_jobs = [0]
+
+
+# returns the backend which runs the tool commands: local (started by gru right away), pool (started by gru as soon as
+# one of executor_pool_size slots is free) or queue (submitted as job of a SLURM/SGE style batch queue)
+def get_executor():
+    return get_setting("software_settings", "executor", "local")
+
+
+# runs a command (list of arguments) with the configured executor and returns its exit code. stdout and stderr can be
+# redirected into files. threads is the number of cores the command uses (requested from the batch queue).
+def run_command(command, stdout_file=None, stderr_file=None, threads=1):
+    global executor_slots
+    debug("running " + " ".join(command))
+    if get_executor() == "queue":
+        return submit_command(command, stdout_file, stderr_file, threads)
+    if get_executor() == "pool":
+        with executor_lock:
+            if executor_slots is None:
+                executor_slots = threading.Semaphore(
+                    max(1, int(get_setting("software_settings", "executor_pool_size", multiprocessing.cpu_count()))))
+        with executor_slots:
+            return run_local_command(command, stdout_file, stderr_file)
+    return run_local_command(command, stdout_file, stderr_file)
+
+
+# runs a command as child process of gru and returns its exit code
+def run_local_command(command, stdout_file=None, stderr_file=None):
+    stdout = open(stdout_file, "wb") if stdout_file is not None else None
+    stderr = open(stderr_file, "ab") if stderr_file is not None else None
+    try:
+        started = time.time()
+        p = subprocess.Popen(command, stdout=stdout, stderr=stderr)
+        wait_process(p, " ".join(command), started)
+    except OSError as e:
+        if e.errno == os.errno.ENOENT:
+            abort("Could not start " + command[0] + ".. Wrong path?", 47)
+        else:
+            abort("Something went wrong by starting " + command[0], 48)
+    finally:
+        if stdout is not None:
+            stdout.close()
+        if stderr is not None:
+            stderr.close()
+    return p.returncode
+
+
+# runs a command as job of a batch queue and returns its exit code. The job script runs the command in the current
+# folder (shared storage is required) and stores its exit code in tmp/queue/<n>.exit. It is submitted with queue_submit
+# ({threads} and {log} are replaced) and polled every queue_poll_seconds until the exit code appears. A job which
+# queue_status ({job} is replaced) does not list anymore and which left no exit code is regarded as failed.
+def submit_command(command, stdout_file=None, stderr_file=None, threads=1):
+    queue_folder = temp_folder + "queue/"
+    create_folder(queue_folder, "Could not create the queue folder!", 59)
+    with executor_lock:
+        queue_jobs[0] += 1
+        job = queue_folder + str(queue_jobs[0])
+    with open(job + ".sh", "w") as script:
+        script.write("#!/bin/sh\ncd " + pipes.quote(os.getcwd()) + "\n" + " ".join(pipes.quote(a) for a in command) +
+                     (" > " + pipes.quote(stdout_file) if stdout_file is not None else "") +
+                     (" 2>> " + pipes.quote(stderr_file) if stderr_file is not None else "") + "\n" +
+                     "echo $? > " + pipes.quote(job + ".exit.tmp") + "\n" +
+                     "mv " + pipes.quote(job + ".exit.tmp") + " " + pipes.quote(job + ".exit") + "\n")
+    os.chmod(job + ".sh", 0o755)
+
+    submit = get_setting("software_settings", "queue_submit", "sbatch --parsable -c {threads} -o {log} -e {log}")
+    started = time.time()
+    try:
+        job_id = re.search(r"\d+", subprocess.check_output(
+            shlex.split(submit.format(threads=threads, log=job + ".log")) + [job + ".sh"])).group(0)
+    except (OSError, subprocess.CalledProcessError, AttributeError) as e:
+        abort("Could not submit " + command[0] + " to the batch queue: " + str(e), 60)
+    debug("Submitted " + job + ".sh as job " + job_id)
+
+    status = get_setting("software_settings", "queue_status", "squeue -h -j {job}")
+    poll_seconds = float(get_setting("software_settings", "queue_poll_seconds", 10))
+    lost = False
+    while not os.path.exists(job + ".exit"):
+        time.sleep(poll_seconds)
+        if os.path.exists(job + ".exit") or queue_job_listed(status.format(job=job_id)):
+            continue
+        if lost:
+            break
+        lost = True  # the exit code may show up late on shared storage, wait one more poll
+    exit_code = -1
+    if os.path.exists(job + ".exit"):
+        with open(job + ".exit") as exit_file:
+            exit_code = int(exit_file.read())
+    record_profile({"type": "tool", "name": os.path.basename(command[0]), "command": " ".join(command),
+                    "stage": current_stage(), "wall_seconds": time.time() - started, "user_seconds": 0.0,
+                    "system_seconds": 0.0, "max_rss_kb": 0, "read_bytes": 0, "written_bytes": 0,
+                    "exit_code": exit_code, "queue_job": job_id})
+    if exit_code == 0:  # the job files of failed jobs are kept for debugging
+        for extension in [".sh", ".exit", ".log"]:
+            if os.path.exists(job + extension):
+                os.remove(job + extension)
+    return exit_code
+
+
+# returns True if the batch queue still lists a job (the status command succeeds and prints something)
+def queue_job_listed(status_command):
+    try:
+        return subprocess.check_output(shlex.split(status_command), stderr=open(os.devnull, "w")).strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+# creates the core budget shared by the job processes of a batch: every job has a slot in a shared array with the
+# number of cores it holds, the free cores are the total minus all held cores. Changes are made under a flock on
+# lock_file, which the kernel releases when a job dies, and run_batch clears the slot of a finished job, so the cores
+# of a killed job return to the budget.
+def create_core_budget(cores, jobs, lock_file):
+    return {"total": cores, "held": multiprocessing.Array("i", jobs, lock=False), "lock_file": lock_file, "slot": None}
+
+
+# takes threads cores from the core budget of the batch, waiting until they are free (at most the whole budget is
+# taken). Returns the number of cores to release afterwards (0 outside of batch mode).
+def acquire_cores(threads):
+    if core_budget is None:
+        return 0
+    threads = max(1, min(int(threads), core_budget["total"]))
+    while True:
+        with open(core_budget["lock_file"], "r") as lock_file:  # own file description, so threads lock each other
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if core_budget["total"] - sum(core_budget["held"]) >= threads:
+                core_budget["held"][core_budget["slot"]] += threads
+                return threads
+        time.sleep(core_poll_interval)
+
+
+# returns cores taken by acquire_cores to the core budget
+def release_cores(cores):
+    if core_budget is None or cores == 0:
+        return
+    with open(core_budget["lock_file"], "r") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        core_budget["held"][core_budget["slot"]] -= cores
+
+
+# creates a task for run_task_graph. function is called without arguments and fails by returning False, a non-zero
+# exit code or by raising. threads is the number of cores and memory_gb the memory the task occupies while running.
+def make_task(function, dependencies=[], threads=1, memory_gb=0):
+    return {"function": function, "dependencies": list(dependencies), "threads": threads, "memory_gb": memory_gb}
+
+
+# runs a graph of tasks (task name -> make_task) on a bounded pool of worker threads. A task is started as soon as all
+# its dependencies succeeded and enough of the thread budget (and of the memory budget, if given) is free; a task which
+# exceeds a budget on its own runs alone. Tasks depending on a failed task are skipped.
+# Returns the names of all tasks that failed or were skipped.
+def run_task_graph(tasks, thread_budget, memory_budget_gb=None):
+    for name in tasks:
+        for dependency in tasks[name]["dependencies"]:
+            if dependency not in tasks:
+                abort("Task " + name + " depends on the unknown task " + dependency, 49)
+
+    state = dict((name, "waiting") for name in tasks)
+    condition = threading.Condition()
+    used_threads = [0]
+    used_memory_gb = [0.0]
+
+    parent_stage = current_stage()
+
+    def worker(name):
+        profile_context.stage = parent_stage
+        try:
+            result = tasks[name]["function"]()
+            succeeded = result is None or result is True or (result is not False and result == 0)
+        except BaseException as e:  # abort() raises SystemExit inside of worker threads
+            warning("Task " + name + " failed: " + str(e))
+            succeeded = False
+        with condition:
+            state[name] = "done" if succeeded else "failed"
+            used_threads[0] -= min(tasks[name]["threads"], thread_budget)
+            used_memory_gb[0] -= tasks[name].get("memory_gb", 0)
+            condition.notify()
+
+    with condition:
+        while True:
+            progress = True
+            while progress:
+                progress = False
+                for name in sorted(tasks):
+                    if state[name] != "waiting":
+                        continue
+                    dependency_states = [state[dependency] for dependency in tasks[name]["dependencies"]]
+                    if "failed" in dependency_states or "skipped" in dependency_states:
+                        state[name] = "skipped"
+                        progress = True
+                    elif all(s == "done" for s in dependency_states):
+                        threads = min(tasks[name]["threads"], thread_budget)
+                        if used_threads[0] > 0 and used_threads[0] + threads > thread_budget:
+                            continue
+                        memory_gb = tasks[name].get("memory_gb", 0)
+                        if memory_budget_gb is not None and used_memory_gb[0] > 0 and \
+                                used_memory_gb[0] + memory_gb > memory_budget_gb:
+                            continue
+                        state[name] = "running"
+                        used_threads[0] += threads
+                        used_memory_gb[0] += memory_gb
+                        debug("Starting task " + name)
+                        t = threading.Thread(target=worker, args=(name,))
+                        t.daemon = True
+                        t.start()
+                        progress = True
+            if "running" not in state.values():
+                break
+            condition.wait()
+
+    return sorted(name for name in state if state[name] != "done")
+
+
+##########################################
+#    END SECTION  SCHEDULING             #
+##########################################
+
+##########################################
+#    BEGIN SECTION  CHECKPOINTS          #
+##########################################
+
+# manifest of finished stages: stage name -> inputs, config and outputs fingerprints
+manifest = {}
+manifest_lock = threading.Lock()
+
+
+# returns the path of the stage manifest
+def get_manifest_file():
+    return project_folder + "gru-manifest.json"
+
+
+# loads the manifest of a previous run
+def load_manifest():
+    global manifest
+    manifest = {}
+    if os.path.isfile(get_manifest_file()):
+        try:
+            with open(get_manifest_file(), "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except ValueError:
+            warning("Could not read the stage manifest, all stages will be run")
+
+
+# writes the manifest atomically, so a crash never leaves a broken manifest behind
+def save_manifest():
+    with open(get_manifest_file() + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.rename(get_manifest_file() + ".tmp", get_manifest_file())
+
+
+# returns a cheap fingerprint (size and modification time) of a file or of all files in a folder, None if missing
+def fingerprint(path):
+    if os.path.isdir(path):
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(os.path.relpath(os.path.join(root, name), path) + "\t" + str(stat.st_size) + "\t" + repr(stat.st_mtime) + "\n")
+        return "folder:" + digest.hexdigest()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return str(stat.st_size) + ":" + repr(stat.st_mtime)
+    return None
+
+
+# removes the outputs of a stage before it is run again
+def remove_outputs(outputs):
+    for output in outputs:
+        if os.path.isdir(output) and not os.path.islink(output):
+            shutil.rmtree(output)
+        elif os.path.lexists(output):
+            os.remove(output)
+
+
+# creates a task for run_task_graph which runs its function as a checkpointed stage (see run_stage)
+def make_stage_task(name, function, inputs, outputs, config, dependencies=[], threads=1, memory_gb=0):
+    return make_task(lambda: run_stage(name, function, inputs, outputs, config, threads), dependencies, threads,
+                     memory_gb)
+
+
+# runs a stage unless a resumed run finds it up to date: same input fingerprints, same config slice and untouched
+# outputs. Stages downstream of a rerun stage see changed input fingerprints and are run again as well.
+# In batch mode the stage waits for threads cores of the batch. Returns the result of function (True for skipped stages).
+def run_stage(name, function, inputs, outputs, config, threads=1):
+    inputs_fingerprint = dict((path, fingerprint(path)) for path in inputs)
+    config_fingerprint = hashlib.sha1(json.dumps(config, sort_keys=True, default=str)).hexdigest()
+    with manifest_lock:
+        entry = manifest.get(name)
+    if resume_enabled() and entry is not None and entry["inputs"] == inputs_fingerprint \
+            and entry["config"] == config_fingerprint \
+            and all(fingerprint(path) is not None and fingerprint(path) == entry["outputs"].get(path) for path in outputs):
+        debug("Stage " + name + " is up to date, skipped")
+        record_profile({"type": "stage", "name": name, "stage": current_stage(), "skipped": True, "wall_seconds": 0.0,
+                        "exit_code": 0})
+        return True
+
+    with manifest_lock:
+        if name in manifest:
+            del manifest[name]
+            save_manifest()
+    remove_outputs(outputs)
+    cores = acquire_cores(threads)
+    try:
+        result = profile_stage(name, function)
+    finally:
+        release_cores(cores)
+    if result is None or result is True or (result is not False and result == 0):
+        with manifest_lock:
+            manifest[name] = {"inputs": inputs_fingerprint, "config": config_fingerprint,
+                              "outputs": dict((path, fingerprint(path)) for path in outputs)}
+            save_manifest()
+    return result
+
+
+##########################################
+#    END SECTION  CHECKPOINTS            #
+##########################################
+
 ##########################################
 #    BEGIN SECTION  TOOLS_EXECUTION      #
 ##########################################
 
-# runs poretools in case to create fasta sequences from the raw files.
-def run_poretools():
+# reads the 2D basecalls of one fast5 file, given as path or as (name, file content) of an archive member.
+# Returns (fast5 file, (name, sequence, qualities) or None, error or None)
+def read_fast5(source):
+    if isinstance(source, tuple):
+        fast5_file, content = source
+        handle = io.BytesIO(content)
+    else:
+        fast5_file = handle = source
+    try:
+        fast5 = h5py.File(handle, "r")
+    except Exception as e:
+        return fast5_file, None, "could not open: " + str(e)
+    try:
+        if "Analyses" in fast5:
+            for group in sorted(fast5["Analyses"].keys()):  # Basecall_2D_000, Basecall_2D_001, ...
+                if group.startswith("Basecall_2D") and fast5_2d_fastq in fast5["Analyses"][group]:
+                    lines = bytes(fast5["Analyses"][group][fast5_2d_fastq][()]).strip().split("\n")
+                    if len(lines) < 4 or not lines[0].startswith("@"):
+                        return fast5_file, None, "malformed 2D fastq record"
+                    name = lines[0][1:].strip() + " " + os.path.basename(fast5_file)
+                    return fast5_file, (name, lines[1].strip(), lines[3].strip()), None
+        return fast5_file, None, "no 2D basecalls"
+    except Exception as e:
+        return fast5_file, None, str(e)
+    finally:
+        fast5.close()
+
+
+# reads the 2D basecalls of a batch of fast5 files (see read_fast5)
+def read_fast5_batch(sources):
+    return [read_fast5(source) for source in sources]
+
+
+# returns True if the fast5 files are converted by gru itself instead of poretools
+def use_native_extractor():
+    if get_setting("software_settings", "fast5_extractor", "native") != "native":
+        return False
+    if h5py is None:
+        warning("h5py is not installed, falling back to poretools for the fast5 conversion")
+        return False
+    return True
+
+
+# returns the sorted fast5 files of a folder
+def list_fast5_files(fast5_folder):
+    return sorted(os.path.join(fast5_folder, f) for f in os.listdir(fast5_folder) if f.endswith(".fast5"))
+
+
+# yields (name, content) of every fast5 member while reading a tar.gz archive sequentially, so the archive is neither
+# listed up front nor extracted to disk
+def stream_fast5_archive(archive_file):
+    archive = tarfile.open(archive_file, "r|gz")
+    try:
+        for member in archive:
+            if member.isreg() and member.name.endswith(".fast5"):
+                yield os.path.basename(member.name), archive.extractfile(member).read()
+    finally:
+        archive.close()
+
+
+# yields the items in lists of the given size
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+# writes the fasta and fastq reads of all fast5 sources (paths or archive members) in one pass, spread over a pool of
+# worker processes. At most extraction_queue_size batches are in flight, so reading an archive overlaps with the
+# conversion without holding more than a bounded number of files in memory. The reads keep the order of the sources;
+# files without readable 2D basecalls are listed in the error log. The reads are written to <reads_base>.fasta/.fastq
+# (default: the reads files of the project), bgzip compressed in compressed storage mode. on_reads is called with the
+# reads (name, sequence, qualities) of every written batch. Returns the number of converted and failed files.
+def extract_reads_native(fast5_sources, reads_base=None, error_log=None, on_reads=None):
+    if reads_base is None:
+        reads_base = get_reads_folder() + params["gru_settings"]["nanopore_reads_filename"]
+    if error_log is None:
+        error_log = log_folder + "fast5_extraction_error.log"
+    processes = max(1, int(get_setting("software_settings", "extraction_processes",
+                                       params["software_settings"]["mapping_threads"])))
+    queue_size = max(1, int(get_setting("software_settings", "extraction_queue_size", 2 * processes)))
+    debug("Converting fast5 files with " + str(processes) + " processes")
+
+    started = time.time()
+    fasta, fasta_compression = open_compressed_output(reads_base + ".fasta" + compressed_suffix())
+    fastq, fastq_compression = open_compressed_output(reads_base + ".fastq" + compressed_suffix())
+    errors = open(error_log, "wb")
+    pool = multiprocessing.Pool(processes)
+    counts = {"converted": 0, "failed": 0}
+    index = {"names": [], "lengths": []}
+
+    def write_batch(results):
+        reads = []
+        for fast5_file, read, error in results:
+            if read is None:
+                errors.write(fast5_file + "\t" + error + "\n")
+                counts["failed"] += 1
+                continue
+            name, sequence, qualities = read
+            record = "@" + name + "\n" + sequence + "\n+\n" + qualities + "\n"
+            fasta.write(">" + name + "\n" + sequence + "\n")
+            fastq.write(record)
+            index["names"].append(name)
+            index["lengths"].append(len(record))
+            reads.append(read)
+            counts["converted"] += 1
+        if on_reads is not None and len(reads) > 0:
+            on_reads(reads)
+
+    try:
+        pending = collections.deque()
+        for batch in batches(fast5_sources, extraction_chunk_size):
+            pending.append(pool.apply_async(read_fast5_batch, (batch,)))
+            if len(pending) >= queue_size:
+                write_batch(pending.popleft().get())
+        while len(pending) > 0:
+            write_batch(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        close_stream(fasta, fasta_compression, get_bgzip() + " -c " + reads_base + ".fasta", started)
+        close_stream(fastq, fastq_compression, get_bgzip() + " -c " + reads_base + ".fastq", started)
+        errors.close()
+    write_read_index(get_read_index_file(reads_base + ".fastq" + compressed_suffix()), index["names"],
+                     index["lengths"])
+    debug("Converted " + str(counts["converted"]) + " fast5 files, " + str(counts["failed"]) + " failed (see " +
+          error_log + ")")
+    return counts
+
+
+# runs poretools in case to create fasta sequences from the raw files. on_reads is passed to the native extractor.
+def run_poretools(on_reads=None):
     # folder names
     nanopore_reads = params["project_settings"]["project_folder"] + params["gru_settings"][
         "nanopore_reads_foldername"] + "/"
     nanopore_fastq = params["project_settings"]["project_folder"] + params["gru_settings"][
         "nanopore_reads_foldername"] + "/"
     # create reads folder
-    try:
-        os.makedirs(nanopore_reads)
-    except:
-        abort("Could not create the nanopore output folder!", 25)
+    create_folder(nanopore_reads, "Could not create the nanopore output folder!", 25)
     debug("Extracting fast5")
+    if use_native_extractor():
+        if params["nanopore_input"].endswith("tar.gz"):
+            extract_reads_native(stream_fast5_archive(params["nanopore_input"]), on_reads=on_reads)
+        else:
+            if not os.path.exists(params["nanopore_input"]):
+                abort("Nanopore input folder does not exist", 36)
+            extract_reads_native(list_fast5_files(params["nanopore_input"]), on_reads=on_reads)
+        return
+
     fastf_folder = params["nanopore_input"]
     poretools_fasta = params["software_general"]["poretools"] + " fasta "
     poretools_fastq = params["software_general"]["poretools"] + " fastq "
+    # in compressed storage mode the output of poretools is appended to the reads files through bgzip
+    compression = " | " + pipes.quote(get_bgzip()) + " -@ " + str(compression_threads()) + " -c" \
+        if use_compressed_storage() else ""
     if params["nanopore_input"].endswith("tar.gz"):
-        try:
-            os.makedirs(temp_folder + "nanopore_fast5" + "/")
-        except:
-            abort("Could not create temp folder for nanopore extraction!", 27)
-        archive = tarfile.open(params["nanopore_input"])
-        for member in archive.getmembers():
+        create_folder(temp_folder + "nanopore_fast5" + "/", "Could not create temp folder for nanopore extraction!", 27)
+        archive = tarfile.open(params["nanopore_input"], "r|gz")
+        for member in archive:
             if member.isreg():  # skip if the TarInfo is not files
                 member.name = os.path.basename(member.name)  # remove the path by reset it
                 archive.extract(member, temp_folder + "nanopore_fast5" + "/")  # extract
+        archive.close()
         fastf_folder = temp_folder + "nanopore_fast5" + "/"
         debug("Extraction of nanopore input done")
     else:
@@ -272,12 +1282,13 @@ def run_poretools():
         #print(["export HDF5_DISABLE_VERSION_CHECK=2; find " + fastf_folder + ' -maxdepth 1 -name "*.fast5" -print0 | xargs -0 -I "{}" ' + poretools_fasta + ' "{}" >> ' + nanopore_reads +
         #          params["gru_settings"]["nanopore_reads_filename"] + ".fasta"])
 
+        started = time.time()
         p = subprocess.Popen(
-            ["export HDF5_DISABLE_VERSION_CHECK=2; find " + fastf_folder + ' -maxdepth 1 -name "*.fast5" -print0 | xargs -0 -I "{}" ' + poretools_fasta +  ' "{}" >> ' + nanopore_reads +
-             params["gru_settings"]["nanopore_reads_filename"] + ".fasta"], shell=True, stderr=poretools_err)
+            ["export HDF5_DISABLE_VERSION_CHECK=2; find " + fastf_folder + ' -maxdepth 1 -name "*.fast5" -print0 | xargs -0 -I "{}" ' + poretools_fasta +  ' "{}"' + compression + ' >> ' +
+             get_reads_file(".fasta")], shell=True, stderr=poretools_err)
         # p.stderr
         # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+        wait_process(p, poretools_fasta + fastf_folder, started)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
             abort("Could not start poretools executable. Wrong path?", 30)
@@ -285,81 +1296,578 @@ def run_poretools():
             abort("Something went wrong by starting poretools", 31)
     debug("Generated fasta reads")
     try:
-        p = subprocess.Popen(["export HDF5_DISABLE_VERSION_CHECK=2; find " + fastf_folder + ' -maxdepth 1 -name "*.fast5" -print0 | xargs -0 -I "{}" ' + poretools_fastq + ' "{}" >> ' + nanopore_reads +
-                params["gru_settings"]["nanopore_reads_filename"] + ".fastq"], shell=True, stderr=poretools_err)
+        started = time.time()
+        p = subprocess.Popen(["export HDF5_DISABLE_VERSION_CHECK=2; find " + fastf_folder + ' -maxdepth 1 -name "*.fast5" -print0 | xargs -0 -I "{}" ' + poretools_fastq + ' "{}"' + compression + ' >> ' +
+                get_reads_file(".fastq")], shell=True, stderr=poretools_err)
         # p.stderr
         # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+        wait_process(p, poretools_fastq + fastf_folder, started)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
             abort("Could not start poretools executable. Wrong path?", 32)
         else:
             abort("Something went wrong by starting poretools", 33)
     debug("Generated fastq reads")
+    build_read_index(get_reads_file(".fastq"))
+    if fastf_folder != params["nanopore_input"]:
+        shutil.rmtree(fastf_folder)  # remove the extracted copy of the archive
 
 
-# builds index files using bwa_index
-def run_bwa_index():
-    if not bool(params["references"]["enable_references"]) == True:
-        warning("Skipped mapping to the reference genome because of disabled reference mapping")
-        return
-    try:
-        os.makedirs(project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/")
-    except:
-        abort("Could not create bwa index output folder!", 37)
-    bwa_output = project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/"
-    allcontigs = open(bwa_output + "_contigs.fasta", "wb")
-    # load for each genome reference file and read it. Enumerate and add prefix
-    for gen in params["file_mapping"]:
-        contig_count = 0
-        prefix = params["file_mapping"][gen]["prefix"]
-        with open(params["references"]["folder"] + params["file_mapping"][gen]["reference"], "r") as reference_file:
-            for line in reference_file:
-                if line.startswith('>'):
-                    allcontigs.write('>' + prefix + "_contig_" + str(contig_count) + "\n")
-                    contig_count = contig_count + 1
-                else:
-                    allcontigs.write(line)
+# returns the 64 bit keys of read names (md5 of the first word of the fastq header) as uint64 array
+def read_name_keys(names):
+    if len(names) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    return numpy.frombuffer("".join(hashlib.md5(name.split(None, 1)[0]).digest()[:8] for name in names),
+                            dtype="<u8").astype(numpy.uint64)
 
-    allcontigs.close()
-    contigfile = bwa_output + "_contigs.fasta"
-    bwa_index_err = open(log_folder + "bwa_index_error.log", "wb")
-    # print "Run bwa here"
 
-    try:
-        p = subprocess.Popen(
-            [params["software_general"]["bwa"], "index", contigfile], stderr=bwa_index_err)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+# writes a read index: the name keys in sorted order with the byte offset and length of every record in the
+# uncompressed fastq (like a .fai index for fastq files) and the uncompressed size of the fastq
+def save_read_index(index_file, keys, offsets, lengths, size):
+    order = numpy.argsort(keys, kind="mergesort")
+    with open(index_file + ".tmp", "wb") as index_output:
+        numpy.savez(index_output, keys=keys[order], offsets=offsets[order], lengths=lengths[order],
+                    size=numpy.array([size], dtype=numpy.uint64))
+    os.rename(index_file + ".tmp", index_file)
+
+
+# writes the read index of a fastq file from the names and record lengths of its reads in file order
+def write_read_index(index_file, names, lengths):
+    lengths = numpy.array(lengths, dtype=numpy.uint64)
+    save_read_index(index_file, read_name_keys(names), numpy.cumsum(lengths, dtype=numpy.uint64) - lengths, lengths,
+                    lengths.sum())
+
+
+# builds the read index of a fastq file which was written by another program (poretools) in one pass over the file
+def build_read_index(reads_fastq):
+    started = time.time()
+    reads, decompression = open_compressed_input(reads_fastq)
+    names, lengths = [], []
+    while True:
+        record = [reads.readline() for line in range(4)]
+        if record[0] == "":
+            break
+        names.append(record[0][1:])
+        lengths.append(sum(len(line) for line in record))
+    close_stream(reads, decompression, get_bgzip() + " -d " + reads_fastq, started)
+    write_read_index(get_read_index_file(reads_fastq), names, lengths)
+
+
+# returns the part files of a read index in the order they were added
+def list_read_index_parts(index_file):
+    parts_folder = get_read_index_parts_folder(index_file)
+    if not os.path.isdir(parts_folder):
+        return []
+    return [parts_folder + str(number) + ".npz" for number in
+            sorted(int(part.split(".")[0]) for part in os.listdir(parts_folder) if part.endswith(".npz"))]
+
+
+# returns the end of the indexed data (uncompressed size) of a read index and its parts: the size of the latest part,
+# otherwise the size of the read index (0 if there is none)
+def read_index_end(index_file):
+    parts = list_read_index_parts(index_file)
+    if len(parts) > 0:
+        index_file = parts[-1]
+    elif not os.path.isfile(index_file):
+        return 0
+    with numpy.load(index_file) as index:
+        return int(index["size"][0])
+
+
+# adds the read index of a fastq file, which was appended to the fastq file of target_index_file, as part number of the
+# target index. The part holds the offsets in the appended file and its end as size, so the work depends only on the
+# size of the appended file and not on the reads indexed before.
+def add_read_index_part(index_file, target_index_file, number):
+    create_folder(get_read_index_parts_folder(target_index_file), "Could not create the read index folder!", 70)
+    start = read_index_end(target_index_file)
+    index = load_read_index(index_file)
+    save_read_index(get_read_index_parts_folder(target_index_file) + str(number) + ".npz", index["keys"],
+                    index["offsets"] + numpy.uint64(start), index["lengths"], start + int(index["size"][0]))
+
+
+# merges the parts of a read index into the read index
+def merge_read_index_parts(index_file):
+    parts_folder = get_read_index_parts_folder(index_file)
+    if not os.path.isdir(parts_folder):
+        return
+    index = load_read_index(index_file)
+    save_read_index(index_file, index["keys"], index["offsets"], index["lengths"], read_index_end(index_file))
+    shutil.rmtree(parts_folder)
+
+
+# returns True if a fastq file has a read index (or read index parts of a running watch mode)
+def has_read_index(index_file):
+    return os.path.isfile(index_file) or len(list_read_index_parts(index_file)) > 0
+
+
+# loads a read index (keys, offsets, lengths, size) together with its parts
+def load_read_index(index_file):
+    indexes = []
+    for part in ([index_file] if os.path.isfile(index_file) else []) + list_read_index_parts(index_file):
+        with numpy.load(part) as index:
+            indexes.append(dict((key, index[key]) for key in index.files))
+    if len(indexes) == 1:
+        return indexes[0]
+    keys = numpy.concatenate([index["keys"] for index in indexes])
+    order = numpy.argsort(keys, kind="mergesort")
+    return {"keys": keys[order], "offsets": numpy.concatenate([index["offsets"] for index in indexes])[order],
+            "lengths": numpy.concatenate([index["lengths"] for index in indexes])[order],
+            "size": numpy.array([max(int(index["size"][0]) for index in indexes)], dtype=numpy.uint64)}
+
+
+# returns the (offset, length) arrays of the records with the given name keys, ordered by offset. Keys which are not in
+# the index are left out.
+def find_indexed_reads(index, keys):
+    keys = numpy.unique(keys)
+    positions = numpy.minimum(numpy.searchsorted(index["keys"], keys), max(0, len(index["keys"]) - 1))
+    positions = positions[index["keys"][positions] == keys] if len(index["keys"]) > 0 else positions[:0]
+    order = numpy.argsort(index["offsets"][positions], kind="mergesort")
+    return index["offsets"][positions][order], index["lengths"][positions][order]
+
+
+# writes the records at the given offsets (ascending) of a fastq file to output. Plain files are memory mapped and
+# neighbouring records are copied as one block, so the cost depends on the number of extracted reads, not on the size
+# of the file. Compressed files are decompressed in one pass which skips everything between the records.
+def copy_indexed_reads(reads_fastq, offsets, lengths, output):
+    if len(offsets) == 0:
+        return
+    ends = offsets + lengths
+    breaks = numpy.nonzero(offsets[1:] != ends[:-1])[0] + 1
+    block_starts = numpy.concatenate(([0], breaks))
+    block_ends = numpy.concatenate((breaks, [len(offsets)])) - 1
+    blocks = zip(offsets[block_starts].tolist(), ends[block_ends].tolist())
+    if not reads_fastq.endswith(".gz"):
+        with open(reads_fastq, "rb") as reads:
+            mapped = mmap.mmap(reads.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for start, end in blocks:
+                    output.write(mapped[start:end])
+            finally:
+                mapped.close()
+        return
+    started = time.time()
+    reads, decompression = open_compressed_input(reads_fastq)
+    position = 0
+    for start, end in blocks:
+        while position < start:
+            position += len(reads.read(min(read_index_skip_size, start - position)))
+        output.write(reads.read(end - start))
+        position = end
+    close_stream(reads, decompression, get_bgzip() + " -d " + reads_fastq, started)
+
+
+# writes the converted reads with the given names (first word of the fastq header) to output through the read index.
+# Returns the number of reads written.
+def extract_reads(names, output):
+    offsets, lengths = find_indexed_reads(load_read_index(get_read_index_file()), read_name_keys(names))
+    copy_indexed_reads(get_reads_file(".fastq"), offsets, lengths, output)
+    return len(offsets)
+
+
+# returns the names of the reads with a primary alignment in the alignment file of an organism
+def mapped_read_names(prefix):
+    started = time.time()
+    sam_stream, p = open_alignment_stream(get_alignment_file(prefix), ["-F", "0x904"])
+    names = [line.split("\t", 1)[0] for line in sam_stream if not line.startswith("@")]
+    close_stream(sam_stream, p, params["software_general"]["samtools"] + " view -F 0x904 " + prefix, started)
+    return names
+
+
+# writes the reads mapped to an organism to output through the read index. Returns the number of reads written.
+def extract_organism_reads(prefix, output):
+    return extract_reads(mapped_read_names(prefix), output)
+
+
+# writes the reads which are not mapped to any organism to output through the read index (with the read filter this
+# includes the rejected reads). Returns the number of reads written.
+def extract_unmapped_reads(output):
+    index = load_read_index(get_read_index_file())
+    mapped = numpy.concatenate([read_name_keys(mapped_read_names(prefix)) for prefix in get_prefixes()])
+    offsets, lengths = find_indexed_reads(index, numpy.setdiff1d(index["keys"], mapped))
+    copy_indexed_reads(get_reads_file(".fastq"), offsets, lengths, output)
+    return len(offsets)
+
+
+# writes the reads of an organism or the unmapped reads as fastq (arguments: config file, organism prefix or
+# "unmapped", optionally the output file, default stdout)
+def run_read_extraction(arguments):
+    global project_folder
+    if len(arguments) not in (2, 3):
+        abort("Wrong number of arguments for reads.", 1, True)
+    read_config(arguments[0])
+    project_folder = params["project_settings"]["project_folder"]
+    if arguments[1] != "unmapped" and arguments[1] not in get_prefixes():
+        abort("Unknown organism " + arguments[1], 70)
+    if not has_read_index(get_read_index_file()):
+        abort("The reads have no read index (" + get_read_index_file() + "), rerun the conversion", 70)
+    output = open(arguments[2], "wb") if len(arguments) == 3 else sys.stdout
+    try:
+        if arguments[1] == "unmapped":
+            count = extract_unmapped_reads(output)
+        else:
+            count = extract_organism_reads(arguments[1], output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write("Extracted " + str(count) + " reads\n")
+
+
+# returns the settings of the read filter: minimum length (after trimming), minimum mean phred quality of the trimmed
+# read and the bases trimmed from its head and tail
+def read_filter_settings():
+    return {"min_length": max(0, int(get_setting("software_settings", "filter_min_length", 0))),
+            "min_quality": max(0.0, float(get_setting("software_settings", "filter_min_quality", 0))),
+            "trim_head": max(0, int(get_setting("software_settings", "filter_trim_head", 0))),
+            "trim_tail": max(0, int(get_setting("software_settings", "filter_trim_tail", 0)))}
+
+
+# returns True if the reads are filtered before they are mapped
+def use_read_filter():
+    return any(value > 0 for value in read_filter_settings().values())
+
+
+# trims and filters a batch of fastq records (header, sequence, qualities without line breaks) and writes the passed
+# reads to output. The qualities of the whole batch are decoded at once, the quality sum of every trimmed read is the
+# difference of a running sum at its ends. Reads shorter than min_length after trimming (empty reads always) are
+# rejected first, then reads with a mean phred quality below min_quality.
+def filter_read_batch(records, settings, output, counts):
+    lengths = numpy.array([len(sequence) for header, sequence, qualities in records], dtype=numpy.int64)
+    qualities = numpy.frombuffer("".join(qualities for header, sequence, qualities in records), dtype=numpy.uint8)
+    quality_sums = numpy.concatenate(([0], numpy.cumsum(qualities.astype(numpy.int64) - 33)))
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    starts = numpy.minimum(settings["trim_head"], lengths)
+    ends = numpy.maximum(starts, lengths - settings["trim_tail"])
+    trimmed_lengths = ends - starts
+    mean_qualities = (quality_sums[offsets + ends] - quality_sums[offsets + starts]) / \
+        numpy.maximum(trimmed_lengths, 1).astype(numpy.float64)
+    too_short = (trimmed_lengths < settings["min_length"]) | (trimmed_lengths == 0)
+    low_quality = ~too_short & (mean_qualities < settings["min_quality"])
+    passed = ~too_short & ~low_quality
+
+    for i in numpy.nonzero(passed)[0]:
+        header, sequence, qualities = records[i]
+        output.write(header + "\n" + sequence[starts[i]:ends[i]] + "\n+\n" + qualities[starts[i]:ends[i]] + "\n")
+    counts["reads_total"] += len(records)
+    counts["reads_passed"] += int(numpy.count_nonzero(passed))
+    counts["reads_too_short"] += int(numpy.count_nonzero(too_short))
+    counts["reads_low_quality"] += int(numpy.count_nonzero(low_quality))
+    counts["bases_total"] += int(lengths.sum())
+    counts["bases_passed"] += int(trimmed_lengths[passed].sum())
+    counts["bases_trimmed"] += int((lengths - trimmed_lengths)[passed].sum())
+
+
+# filters a fastq file in one streaming pass into filtered_fastq (both bgzip compressed if they end with .gz).
+# Returns the counters of the filter.
+def filter_reads(reads_fastq, filtered_fastq):
+    settings = read_filter_settings()
+    counts = dict((counter, 0) for counter in read_filter_counters)
+    started = time.time()
+    reads, decompression = open_compressed_input(reads_fastq)
+    output, compression = open_compressed_output(filtered_fastq)
+    while True:
+        lines = [reads.readline() for line in range(4 * read_filter_batch_size)]
+        records = [(lines[i].rstrip("\n"), lines[i + 1].rstrip("\n"), lines[i + 3].rstrip("\n"))
+                   for i in range(0, len(lines), 4) if lines[i] != ""]
+        if len(records) == 0:
+            break
+        filter_read_batch(records, settings, output, counts)
+    close_stream(reads, decompression, get_bgzip() + " -d " + reads_fastq, started)
+    close_stream(output, compression, get_bgzip() + " -c " + filtered_fastq, started)
+    return counts
+
+
+# adds the counters of a filter run to the read filter summary (a new summary is started if there is none)
+def update_read_filter_summary(counts, append=False):
+    summary = {"settings": read_filter_settings(), "counts": dict((counter, 0) for counter in read_filter_counters)}
+    if append and os.path.isfile(get_read_filter_summary()):
+        with open(get_read_filter_summary(), "r") as summary_file:
+            summary["counts"] = json.load(summary_file)["counts"]
+    for counter in read_filter_counters:
+        summary["counts"][counter] += counts[counter]
+    with open(get_read_filter_summary(), "w") as summary_file:
+        json.dump(summary, summary_file, indent=1, sort_keys=True)
+
+
+# trims and filters the converted reads by length and mean quality before they are mapped, so the mapping time scales
+# with the usable reads. Writes the filtered fastq and the read filter summary for the report.
+def run_read_filter():
+    create_folder(get_filtered_reads_folder(), "Could not create the filtered reads folder!", 66)
+    counts = filter_reads(get_reads_file(".fastq"), get_mapping_reads_file())
+    update_read_filter_summary(counts)
+    debug("Read filter passed " + str(counts["reads_passed"]) + " of " + str(counts["reads_total"]) + " reads (" +
+          str(counts["reads_too_short"]) + " too short, " + str(counts["reads_low_quality"]) + " low quality)")
+
+
+# builds index files using bwa_index
+def run_bwa_index():
+    if not bool(params["references"]["enable_references"]) == True:
+        warning("Skipped mapping to the reference genome because of disabled reference mapping")
+        return
+    create_folder(project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/", "Could not create bwa index output folder!", 37)
+    bwa_output = project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/"
+
+    cache_folder = get_setting("software_settings", "index_cache_folder", batch_index_cache_folder)
+    if cache_folder is None:
+        build_bwa_index(bwa_output)
+    else:
+        run_cached_bwa_index(cache_folder.rstrip("/") + "/", bwa_output)
+
+
+# yields the content of a reference file in chunks of about reference_chunk_size bytes. gzip and bgzip compressed
+# references (any number of gzip members) are decompressed on the fly.
+def read_reference_chunks(reference):
+    with open(reference, "rb") as reference_file:
+        magic = reference_file.read(2)
+        chunk = magic + reference_file.read(reference_chunk_size)
+        if magic != "\x1f\x8b":
+            while chunk != "":
+                yield chunk
+                chunk = reference_file.read(reference_chunk_size)
+            return
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while chunk != "":
+            data = [decompressor.decompress(chunk)]
+            while decompressor.unused_data != "":  # the next gzip member starts
+                member = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data.append(decompressor.decompress(member))
+            yield "".join(data)
+            chunk = reference_file.read(reference_chunk_size)
+
+
+# copies a reference into the concatenated references in blocks, only the header lines are rewritten to
+# <prefix>_contig_<n>. Returns the contigs as [name, original name (first word of the header), length].
+def concatenate_reference(reference, prefix, output):
+    contigs = []
+    rest = ""  # header line which continues in the next chunk
+    line_start = True  # the next chunk starts at the beginning of a line
+    last = "\n"
+    for chunk in read_reference_chunks(reference):
+        buffer = rest + chunk
+        position = 0
+        while True:
+            if position == 0 and line_start and buffer.startswith(">"):
+                start = 0
+            else:
+                start = buffer.find("\n>", max(0, position - 1))  # position - 1 ends the previous header line
+                start = start + 1 if start != -1 else -1
+            block = buffer[position:] if start == -1 else buffer[position:start]
+            if len(block) > 0:
+                output.write(block)
+                last = block[-1]
+                if len(contigs) > 0:
+                    contigs[-1][2] += len(block) - block.count("\n") - block.count("\r")
+            if start == -1:
+                rest = ""
+                line_start = last == "\n"
+                break
+            end = buffer.find("\n", start)
+            if end == -1:
+                rest = buffer[start:]
+                line_start = True
+                break
+            contigs.append([prefix + "_contig_" + str(len(contigs)), (buffer[start + 1:end].split() or [""])[0], 0])
+            output.write(">" + contigs[-1][0] + "\n")
+            last = "\n"
+            position = end + 1
+    if rest != "":  # header in the last line of the file
+        contigs.append([prefix + "_contig_" + str(len(contigs)), (rest[1:].split() or [""])[0], 0])
+        output.write(">" + contigs[-1][0] + "\n")
+    elif last != "\n":
+        output.write("\n")  # the header of the next reference has to start on a new line
+    return contigs
+
+
+# writes the contig map of the concatenated references: contig name, organism, original contig name and length
+def write_contig_map(contig_map_file, contigs):
+    with open(contig_map_file, "w") as contig_map:
+        contig_map.write("contig\torganism\toriginal_name\tlength\n")
+        for prefix, name, original_name, length in contigs:
+            contig_map.write(name + "\t" + prefix + "\t" + original_name + "\t" + str(length) + "\n")
+
+
+# returns the contig map of the concatenated references (contig name -> organism, original_name, length). Empty for
+# indexes which were built without contig map.
+def load_contig_map():
+    contig_map = {}
+    if not os.path.isfile(get_index_folder() + contig_map_name):
+        return contig_map
+    with open(get_index_folder() + contig_map_name, "r") as contig_map_file:
+        contig_map_file.readline()
+        for line in contig_map_file:
+            name, prefix, original_name, length = line.rstrip("\n").split("\t")
+            contig_map[name] = {"organism": prefix, "original_name": original_name, "length": int(length)}
+    return contig_map
+
+
+# concatenates all reference files (plain, gzip or bgzip compressed) into _contigs.fasta of the given folder, writes
+# the contig map and indexes the concatenated references using bwa_index
+def build_bwa_index(bwa_output):
+    contigs = []
+    with open(bwa_output + "_contigs.fasta", "wb", reference_chunk_size) as allcontigs:
+        for gen in sorted(params["file_mapping"], key=lambda g: params["file_mapping"][g]["prefix"]):
+            prefix = params["file_mapping"][gen]["prefix"]
+            for name, original_name, length in concatenate_reference(
+                    params["references"]["folder"] + params["file_mapping"][gen]["reference"], prefix, allcontigs):
+                contigs.append((prefix, name, original_name, length))
+    write_contig_map(bwa_output + contig_map_name, contigs)
+
+    contigfile = bwa_output + "_contigs.fasta"
+    bwa_index_err = open(log_folder + "bwa_index_error.log", "wb")
+    # print "Run bwa here"
+
+    try:
+        started = time.time()
+        p = subprocess.Popen(
+            [params["software_general"]["bwa"], "index", contigfile], stderr=bwa_index_err)
+        # p.stderr
+        # p2 = subprocess.Popen(stdin=p.stderr)
+        wait_process(p, params["software_general"]["bwa"] + " index " + contigfile, started)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
             abort("Could not start bwa indexing.. Wrong path?", 32)
         else:
             abort("Something went wrong by starting bwa indexing", 33)
+    if p.returncode != 0:
+        abort("bwa indexing failed, see " + log_folder + "bwa_index_error.log", 45)
+
+
+# returns the version string bwa prints on its usage page
+def bwa_version():
+    try:
+        p = subprocess.Popen([params["software_general"]["bwa"]], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, err = p.communicate()
+    except OSError:
+        abort("BWA executable could not be started. Wrong path?", 16)
+    match = re.search(r"Version:\s*(\S+)", err)
+    return match.group(1) if match else ""
+
+
+# returns the cache key of the current reference set: a hash of the reference contents, their prefixes and the bwa version
+def reference_set_key():
+    key = hashlib.sha1()
+    key.update("bwa " + bwa_version() + "\n")
+    for gen in sorted(params["file_mapping"], key=lambda g: params["file_mapping"][g]["prefix"]):
+        content = hashlib.sha1()
+        with open(params["references"]["folder"] + params["file_mapping"][gen]["reference"], "rb") as reference_file:
+            for chunk in iter(lambda: reference_file.read(index_cache_chunk_size), b""):
+                content.update(chunk)
+        key.update(params["file_mapping"][gen]["prefix"] + "\t" + content.hexdigest() + "\n")
+    return key.hexdigest()
+
+
+# reuses the bwa index of an identical reference set from the cache folder or builds it there once. The cache entry is
+# locked while it is built and linked, so concurrent jobs with the same references wait instead of building it twice.
+def run_cached_bwa_index(cache_folder, bwa_output):
+    create_folder(cache_folder, "Could not create the bwa index cache folder!", 46)
+
+    key = reference_set_key()
+    entry = cache_folder + key + "/"
+    debug("bwa index cache key: " + key)
+    lock_file = open(cache_folder + key + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        if os.path.isfile(entry + "complete") and os.path.isfile(entry + contig_map_name):
+            debug("Reusing cached bwa index " + entry)
+        else:
+            debug("Building bwa index in cache " + entry)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)  # leftover of an interrupted build
+            os.makedirs(entry)
+            build_bwa_index(entry)
+            open(entry + "complete", "w").close()
+        os.utime(entry + "complete", None)  # mark as recently used
+        for extension in [""] + bwa_index_extensions:
+            link_file(entry + "_contigs.fasta" + extension, bwa_output + "_contigs.fasta" + extension)
+        link_file(entry + contig_map_name, bwa_output + contig_map_name)
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    evict_index_cache(cache_folder, key)
+
+
+# links a file (hardlink, copy if source and destination are on different file systems). No symlinks are used, so the
+# destination stays valid when the cache entry is evicted or the cache is removed.
+def link_file(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination + ".part")
+        os.rename(destination + ".part", destination)
+
+
+# removes least recently used index cache entries until the cache fits index_cache_max_gb. Entries which are locked
+# by other jobs and the entry in use are kept.
+def evict_index_cache(cache_folder, keep_key):
+    max_size = get_setting("software_settings", "index_cache_max_gb")
+    if max_size is None:
+        return
+    max_size = float(max_size) * 1024 * 1024 * 1024
+
+    entries = []
+    total_size = 0
+    for key in os.listdir(cache_folder):
+        entry = cache_folder + key + "/"
+        if not os.path.isfile(entry + "complete"):
+            continue
+        size = sum(os.path.getsize(entry + f) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry + "complete"), key, size))
+        total_size += size
+
+    for last_used, key, size in sorted(entries):
+        if total_size <= max_size:
+            break
+        if key == keep_key:
+            continue
+        lock_file = open(cache_folder + key + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            continue  # in use by another job
+        try:
+            shutil.rmtree(cache_folder + key + "/")
+            total_size -= size
+            debug("Evicted bwa index cache entry " + key)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
 
 
 # mapps reads using bwa_mapper
 def run_bwa_mapping():
     # create mapping folder
-    try:
-        os.makedirs(project_folder + params["gru_settings"]["mapping_foldername"] + "/")
-    except:
-        abort("Could not create bwa index output folder!", 38)
+    create_folder(get_work_folder() + params["gru_settings"]["mapping_foldername"] + "/", "Could not create bwa index output folder!", 38)
+
+    if mapping_shards() > 1:
+        run_bwa_mapping_sharded()
+        return
+    if use_streaming_mapping():
+        run_bwa_mapping_streaming()
+        return
 
     index_contigs = project_folder + params["gru_settings"]["bwa_reference_index_foldername"] + "/" + "_contigs.fasta"
-    reads_fastq = project_folder + params["gru_settings"]["nanopore_reads_foldername"] + "/" + params["gru_settings"][
-        "nanopore_reads_filename"] + ".fastq"
+    reads_fastq = get_mapping_reads_file()
     bwa_command = params["software_general"]["bwa"] + " mem -x ont2d -t " + str(params["software_settings"][
-                                                                                    "mapping_threads"]) + " " + index_contigs + " " + reads_fastq + " > " + project_folder + \
-                  params["gru_settings"]["mapping_foldername"] + "/" + "mapped.sam"
+                                                                                    "mapping_threads"]) + " " + index_contigs + " " + reads_fastq
+    if use_compressed_storage():
+        # encode the alignments as cram on the fly
+        bwa_command += " | " + " ".join(pipes.quote(a) for a in [params["software_general"]["samtools"], "view", "-@",
+                                                                 str(compression_threads())] +
+                                       alignment_output_options() + ["-o", get_mapping_file(), "-"])
+    else:
+        bwa_command += " > " + get_mapping_file()
     debug("running " + bwa_command);
 
     try:
+        started = time.time()
         p = subprocess.Popen(bwa_command, shell=True)
         # p.stderr
         # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+        wait_process(p, bwa_command, started)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
             abort("Could not start bwa mapping.. Wrong command?", 32)
@@ -367,122 +1875,951 @@ def run_bwa_mapping():
             abort("Something went wrong by starting bwa mapping", 33)
 
 
-# splits mapping files into single files, takes care about unique identifiers.
-def process_mappingfile():
-    mapping_folder = project_folder + params["gru_settings"]["mapping_foldername"] + "/"
-    splitted_mapping_folder = project_folder + params["gru_settings"]["mapping_foldername"] + "/splitted/"
-    mapping_file = project_folder + params["gru_settings"]["mapping_foldername"] + "/" + "mapped.sam"
-    stats_folder = project_folder + "stats/"
-
-    try:
-        os.makedirs(splitted_mapping_folder)
-    except:
-        abort("Could not create bwa index output folder!", 38)
+# starts one samtools sort process per organism (default: all organisms) which reads sam from stdin and writes
+# <prefix>.bam (.cram) to output_folder
+def start_sort_processes(output_folder, threads, prefixes=None):
+    sorters = {}
+    for prefix in (get_prefixes() if prefixes is None else prefixes):
+        try:
+            sorters[prefix] = subprocess.Popen(
+                [params["software_general"]["samtools"], "sort", "-@", str(threads), "-T", output_folder + prefix + ".tmp"] +
+                alignment_output_options() + ["-o", get_alignment_file(prefix, output_folder), "-"],
+                stdin=subprocess.PIPE, bufsize=demultiplex_buffer_size)
+        except OSError as e:
+            if e.errno == os.errno.ENOENT:
+                abort("Could not start samtools sort.. Wrong path?", 41)
+            else:
+                abort("Something went wrong by starting samtools sort", 42)
+    return sorters
 
-    prefix_set = ""
 
-    for gen in params["file_mapping"]:
-        prefix_set = prefix_set + params["file_mapping"][gen]["prefix"] + " "
+# mapps reads using bwa_mapper and streams the alignments through the demultiplexer straight into one
+# samtools sort process per organism, so neither mapped.sam nor the splitted sam files are written
+def run_bwa_mapping_streaming():
+    map_reads_streaming(get_mapping_reads_file(), get_splitted_folder(), params["software_settings"]["mapping_threads"],
+                        params["software_settings"]["sorting_threads"], "bwa_mapping_error.log",
+                        get_read_metrics_file())
 
-    debug("Prefix set: " + prefix_set)
 
-    split_command = "for i in " + prefix_set + "; do grep $i " + mapping_file + " > " + splitted_mapping_folder + "${i}.sam; done"
+# mapps a fastq file with bwa mem, demultiplexes the alignments on the fly and sorts them into <prefix>.bam files of
+# the output folder. The per-read metrics are written to read_metrics_file. With feed (and reads_fastq "-") bwa mem
+# reads from stdin: feed is called with the stdin of bwa mem in a thread, which is started once the sort processes are
+# running, and has to close it.
+def map_reads_streaming(reads_fastq, output_folder, mapping_threads, sorting_threads, error_log, read_metrics_file,
+                        feed=None):
+    index_contigs = get_index_folder() + "_contigs.fasta"
+    create_folder(output_folder, "Could not create bwa index output folder!", 38)
 
+    bwa_command = [params["software_general"]["bwa"], "mem", "-x", "ont2d", "-t", str(mapping_threads), index_contigs,
+                   reads_fastq]
+    debug("running " + " ".join(bwa_command) + " | demultiplex | samtools sort")
+    bwa_mapping_err = open(log_folder + error_log, "wb")
     try:
-        p = subprocess.Popen(split_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+        started = time.time()
+        p = subprocess.Popen(bwa_command, stdin=subprocess.PIPE if feed is not None else None, stdout=subprocess.PIPE,
+                             stderr=bwa_mapping_err, bufsize=demultiplex_buffer_size)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
-            abort("Could not split mappings into single files.. Wrong command?", 32)
+            abort("Could not start bwa mapping.. Wrong command?", 32)
         else:
-            abort("Something went wrong by splitting the mappings into single files", 33)
+            abort("Something went wrong by starting bwa mapping", 33)
 
-    sort_command = "for i in `ls " + splitted_mapping_folder + "*sam | sed 's/.sam//'`; do echo $i; samtools view -buh $i.sam | samtools sort -@ " + str(
-        params["software_settings"]["sorting_threads"]) + " -o $i.bam -; done"
+    feeder = None
+    if feed is not None:
+        # processes started later must not inherit the stdin of bwa mem, it would never see the end of the reads
+        fcntl.fcntl(p.stdin.fileno(), fcntl.F_SETFD, fcntl.fcntl(p.stdin.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        feeder = threading.Thread(target=feed, args=(p.stdin,))
+        feeder.daemon = True
 
-    debug("Sorting cmd: " + sort_command)
-    try:
-        p = subprocess.Popen(sort_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            abort("Could not split mappings into single files.. Wrong command?", 32)
-        else:
-            abort("Something went wrong by splitting the mappings into single files", 33)
+    sort_demultiplexed(p.stdout, output_folder, sorting_threads, read_metrics_file=read_metrics_file,
+                       on_started=feeder.start if feeder is not None else None)
+    p.stdout.close()
+    if feeder is not None:
+        feeder.join()
+    if wait_process(p, " ".join(bwa_command), started) != 0:
+        abort("bwa mapping failed, see " + log_folder + error_log, 43)
+    bwa_mapping_err.close()
 
-    index_command = "for i in " + splitted_mapping_folder + "*bam; do samtools index $i; done"
 
-    try:
-        p = subprocess.Popen(index_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            abort("Could not split mappings into single files.. Wrong command?", 32)
-        else:
-            abort("Something went wrong by splitting the mappings into single files", 33)
+# demultiplexes a sam stream into one samtools sort process per organism (default: all organisms, alignments to the
+# contigs of other organisms are dropped) which write the sorted <prefix>.bam files of the output folder. With
+# read_metrics_file the per-read metrics of the stream are written as well. on_started is called once the sort
+# processes are running. Returns the number of alignments per organism.
+def sort_demultiplexed(sam_stream, output_folder, sorting_threads, prefixes=None, read_metrics_file=None,
+                       on_started=None):
+    started = time.time()
+    sorters = start_sort_processes(output_folder, sorting_threads, prefixes)
+    if on_started is not None:
+        on_started()
+    read_metrics = new_read_metrics(get_prefixes()) if read_metrics_file is not None else None
+    counts = demultiplex_sam(sam_stream, dict((prefix, sorters[prefix].stdin) for prefix in sorters), read_metrics)
+    for prefix in sorters:
+        sorters[prefix].stdin.close()
+    for prefix in sorters:
+        if wait_process(sorters[prefix], params["software_general"]["samtools"] + " sort " + prefix, started) != 0:
+            abort("Sorting the mappings of " + prefix + " failed", 44)
+        debug("Alignments for " + prefix + " in " + output_folder + ": " + str(counts[prefix]))
+    if read_metrics is not None:
+        write_read_metrics(read_metrics_file, read_metrics)
+    return counts
 
-    stats_command = "for i in " + splitted_mapping_folder + "*bam; do samtools stats $i > $i.stats & done"
 
-    try:
-        p = subprocess.Popen(stats_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            abort("Could not split mappings into single files.. Wrong command?", 32)
-        else:
-            abort("Something went wrong by splitting the mappings into single files", 33)
+# converts the fast5 files while their reads are mapped: the converted batches (trimmed and filtered by the read
+# filter) wait in a queue of overlapped_queue_size batches for a feeder thread which writes them to the stdin of bwa
+# mem, the alignments are demultiplexed and sorted like in the streaming mapping. The conversion blocks while the queue
+# is full, so it never runs far ahead of the mapping and the wall time is close to the slower of both instead of their
+# sum. The reads files, the read index and the filtered reads are written as by the separate stages.
+def run_overlapped_mapping():
+    filtering = use_read_filter()
+    if filtering:
+        create_folder(get_filtered_reads_folder(), "Could not create the filtered reads folder!", 66)
+    settings = read_filter_settings()
+    filter_counts = dict((counter, 0) for counter in read_filter_counters)
+    chunks = Queue.Queue(overlapped_queue_size())
+    failures = []
+
+    def queue_reads(reads):
+        if filtering:
+            output = io.BytesIO()
+            filter_read_batch([("@" + name, sequence, qualities) for name, sequence, qualities in reads], settings,
+                              output, filter_counts)
+            chunks.put(output.getvalue())
+            return
+        chunks.put("".join("@" + name + "\n" + sequence + "\n+\n" + qualities + "\n"
+                           for name, sequence, qualities in reads))
+
+    def convert():
+        try:
+            run_poretools(queue_reads)
+        except SystemExit as e:  # abort in the conversion, the message is already printed
+            failures.append("the conversion of the fast5 files failed (ERROR " + str(e.code) + ")")
+        except Exception as e:
+            failures.append("the conversion of the fast5 files failed: " + str(e))
+        finally:
+            chunks.put(None)
+
+    def feed(stdin):
+        converter = threading.Thread(target=convert)
+        converter.daemon = True
+        converter.start()
+        started = time.time()
+        filtered, compression = open_compressed_output(get_mapping_reads_file()) if filtering else (None, None)
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                if filtered is not None:
+                    filtered.write(chunk)
+                stdin.write(chunk)
+        except IOError as e:
+            failures.append("bwa mem stopped reading the reads: " + str(e))
+            while chunks.get() is not None:  # let the conversion finish
+                pass
+        finally:
+            try:
+                stdin.close()
+            except IOError:
+                pass
+            if filtered is not None:
+                close_stream(filtered, compression, get_bgzip() + " -c " + get_mapping_reads_file(), started)
+            converter.join()
+
+    create_folder(get_reads_folder(), "Could not create the nanopore output folder!", 25)
+    debug("Converting and mapping the fast5 files at the same time")
+    map_reads_streaming("-", get_splitted_folder(), params["software_settings"]["mapping_threads"],
+                        params["software_settings"]["sorting_threads"], "bwa_mapping_error.log",
+                        get_read_metrics_file(), feed)
+    if len(failures) > 0:
+        abort("Overlapped mapping failed: " + "; ".join(failures), 72)
+    if filtering:
+        update_read_filter_summary(filter_counts)
+        debug("Read filter passed " + str(filter_counts["reads_passed"]) + " of " + str(filter_counts["reads_total"]) +
+              " reads")
+
+
+# returns the shell pipeline of a mapping job for the batch queue: bwa mem piped into "gru.py demultiplex", which sorts
+# the alignments into one bam file per organism of the output folder and writes the per-read metrics to
+# read_metrics_file
+def mapping_pipeline(reads_fastq, output_folder, mapping_threads, sorting_threads, error_log, read_metrics_file):
+    bwa_command = [params["software_general"]["bwa"], "mem", "-x", "ont2d", "-t", str(mapping_threads),
+                   get_index_folder() + "_contigs.fasta", reads_fastq]
+    demultiplex_command = [sys.executable, os.path.abspath(__file__), "demultiplex", "--read-metrics",
+                           read_metrics_file, config_path, output_folder, str(sorting_threads)]
+    return " ".join(pipes.quote(a) for a in bwa_command) + " 2> " + pipes.quote(log_folder + error_log) + " | " + \
+           " ".join(pipes.quote(a) for a in demultiplex_command)
+
+
+# demultiplexes sam from stdin into sorted bam files per organism (arguments: optionally --read-metrics and the file
+# of the per-read metrics, config file, output folder, sorting threads and optionally the organism prefixes to keep).
+# Runs in the mapping jobs of the batch queue and of the Illumina reads.
+def run_demultiplex(arguments):
+    global project_folder
+    read_metrics_file = None
+    if len(arguments) > 1 and arguments[0] == "--read-metrics":
+        read_metrics_file = arguments[1]
+        arguments = arguments[2:]
+    read_config(arguments[0])
+    project_folder = params["project_settings"]["project_folder"]  # cram is encoded against the index of the project
+    create_folder(arguments[1], "Could not create bwa index output folder!", 38)
+    sam_stream = io.open(sys.stdin.fileno(), "rb", buffering=demultiplex_buffer_size, closefd=False)
+    sort_demultiplexed(sam_stream, arguments[1], arguments[2], arguments[3:] or None, read_metrics_file)
+
+
+# returns the number of fastq shards which are mapped concurrently (1 disables sharding)
+def mapping_shards():
+    return max(1, int(get_setting("software_settings", "mapping_shards", 1)))
+
+
+# returns True if the mapping writes sorted bam files per organism itself (streaming or sharded mapping)
+def use_streaming_mapping():
+    return bool(get_setting("software_settings", "streaming_mapping", False)) == True or mapping_shards() > 1 or \
+        use_overlapped_mapping()
+
+
+# returns True if the conversion of the fast5 files overlaps with the mapping (overlapped_mapping: True). Requires the
+# native fast5 extractor and a single bwa mem process of gru (no mapping shards, no batch queue).
+def use_overlapped_mapping():
+    return bool(get_setting("software_settings", "overlapped_mapping", False)) == True and use_native_extractor() and \
+        mapping_shards() == 1 and get_executor() != "queue"
+
+
+# returns the number of converted read batches which may wait for bwa mem in the overlapped mapping
+def overlapped_queue_size():
+    return max(1, int(get_setting("software_settings", "overlapped_queue_size", 64)))
+
+
+# splits a fastq file into shard files of about the same size, keeping the records in order. The uncompressed size of
+# bgzip compressed reads is not known up front, they are dealt out to the shards in chunks of records instead.
+def split_fastq(reads_fastq, shard_files):
+    if reads_fastq.endswith(".gz"):
+        split_fastq_chunked(reads_fastq, shard_files)
+        return
+    total_size = os.path.getsize(reads_fastq)
+    shard = 0
+    written = 0
+    output = open(shard_files[0], "wb", demultiplex_buffer_size)
+    with open(reads_fastq, "rb", demultiplex_buffer_size) as reads:
+        while True:
+            record = "".join([reads.readline() for line in range(4)])
+            if record == "":
+                break
+            if written >= total_size * (shard + 1) // len(shard_files) and shard + 1 < len(shard_files):
+                output.close()
+                shard += 1
+                output = open(shard_files[shard], "wb", demultiplex_buffer_size)
+            output.write(record)
+            written += len(record)
+    output.close()
+    for shard_file in shard_files[shard + 1:]:
+        open(shard_file, "wb").close()  # fewer reads than shards
 
-    flagstats_command = "for i in " + splitted_mapping_folder + "*bam; do samtools flagstat $i > $i.flagstat & done"
 
+# splits a bgzip compressed fastq file into compressed shard files, chunks of shard_chunk_records records are written
+# to the shards in turn
+def split_fastq_chunked(reads_fastq, shard_files):
+    started = time.time()
+    reads, decompression = open_compressed_input(reads_fastq)
+    outputs = [open_compressed_output(shard_file) for shard_file in shard_files]
+    shard = 0
+    while True:
+        chunk = [reads.readline() for line in range(4 * shard_chunk_records)]
+        if chunk[0] == "":
+            break
+        outputs[shard][0].write("".join(chunk))
+        shard = (shard + 1) % len(outputs)
+    close_stream(reads, decompression, get_bgzip() + " -d " + reads_fastq, started)
+    for output, compression in outputs:
+        close_stream(output, compression, get_bgzip() + " -c", started)
+
+
+# mapps the reads in size balanced shards with concurrent bwa mem workers, each with a share of the mapping threads,
+# and k-way merges the sorted per shard and organism bam files into splitted/<prefix>.bam (.cram)
+def run_bwa_mapping_sharded():
+    shards = mapping_shards()
+    shard_folder = temp_folder + "shards/"
+    create_folder(shard_folder, "Could not create the shard folder!", 52)
+    create_folder(get_splitted_folder(), "Could not create bwa index output folder!", 38)
+    shard_files = [shard_folder + "reads_" + str(shard) + ".fastq" + compressed_suffix() for shard in range(shards)]
+    split_fastq(get_mapping_reads_file(), shard_files)
+    debug("Mapping " + str(shards) + " shards")
+
+    mapping_threads = max(1, int(params["software_settings"]["mapping_threads"]) // shards)
+    sorting_threads = max(1, int(params["software_settings"]["sorting_threads"]) // shards)
+    tasks = {}
+    for shard in range(shards):
+        if get_executor() == "queue":
+            # every shard is mapped by a job of the batch queue
+            tasks["map:" + str(shard)] = make_task(
+                lambda shard=shard: run_command(
+                    ["/bin/bash", "-o", "pipefail", "-c",
+                     mapping_pipeline(shard_files[shard], shard_folder + str(shard) + "/", mapping_threads,
+                                      sorting_threads, "bwa_mapping_error_" + str(shard) + ".log",
+                                      shard_folder + str(shard) + "/" + read_metrics_name)],
+                    threads=mapping_threads + sorting_threads), threads=mapping_threads)
+            continue
+        tasks["map:" + str(shard)] = make_task(
+            lambda shard=shard: map_reads_streaming(shard_files[shard], shard_folder + str(shard) + "/",
+                                                    mapping_threads, sorting_threads,
+                                                    "bwa_mapping_error_" + str(shard) + ".log",
+                                                    shard_folder + str(shard) + "/" + read_metrics_name),
+            threads=mapping_threads)
+    for prefix in get_prefixes():
+        tasks["merge:" + prefix] = make_task(
+            lambda prefix=prefix: run_command(
+                [params["software_general"]["samtools"], "merge", "-f", "-@",
+                 str(params["software_settings"]["sorting_threads"])] + alignment_output_options() +
+                [get_alignment_file(prefix)] +
+                [get_alignment_file(prefix, shard_folder + str(shard) + "/") for shard in range(shards)],
+                stderr_file=log_folder + "samtools_error.log", threads=params["software_settings"]["sorting_threads"]),
+            ["map:" + str(shard) for shard in range(shards)], params["software_settings"]["sorting_threads"])
+
+    failed = run_task_graph(tasks, int(params["software_settings"]["mapping_threads"]))
+    if len(failed) > 0:
+        abort("Sharded mapping failed for: " + ", ".join(failed) + " (see " + log_folder + ")", 53)
+    # the shard tables replace the table of a previous mapping
+    if os.path.isfile(get_read_metrics_file()):
+        os.remove(get_read_metrics_file())
+    shutil.rmtree(get_read_metrics_parts_folder(get_read_metrics_file()), ignore_errors=True)
+    for shard in range(shards):
+        add_read_metrics_part(shard_folder + str(shard) + "/" + read_metrics_name, get_read_metrics_file(), shard)
+    merge_read_metrics_parts(get_read_metrics_file())
+    shutil.rmtree(shard_folder)
+
+
+# returns the threads of every Illumina mapping job (default: half of the mapping threads)
+def illumina_mapping_threads():
+    return max(1, int(get_setting("software_settings", "illumina_mapping_threads",
+                                  int(params["software_settings"]["mapping_threads"]) // 2)))
+
+
+# returns the bwa mem input of Illumina read files: gzipped files are decompressed by their own process which streams
+# into bwa through a bash process substitution, so bwa never waits for the decompression
+def illumina_input(illumina_files):
+    if len(illumina_files) == 1 and not illumina_files[0].endswith(".gz"):
+        return pipes.quote(illumina_files[0])
+    return "<(" + " ".join(pipes.quote(a) for a in [get_setting("software_general", "gzip", "gzip"), "-dcf"] +
+                           illumina_files) + ")"
+
+
+# returns the first and the second mates of Illumina read files as two lists in matching order (e.g. the R1 and R2
+# files of every lane), or None if the files do not form pairs. Mates are told apart by their names
+# (<name>_R1_001.fastq.gz / <name>_R2_001.fastq.gz, <name>_1.fq / <name>_2.fq, ...); two files which are not named
+# like mates are taken as pair in the given order.
+def pair_illumina_files(illumina_files):
+    mates = {}
+    for illumina_file in illumina_files:
+        match = illumina_mate_pattern.match(os.path.basename(illumina_file))
+        if match is None:
+            break
+        mates.setdefault(os.path.dirname(illumina_file) + "/" + match.group(1) + match.group(3), {})[match.group(2)] = \
+            illumina_file
+    else:
+        if len(mates) > 0 and all(sorted(pair) == ["1", "2"] for pair in mates.values()):
+            return [mates[key]["1"] for key in sorted(mates)], [mates[key]["2"] for key in sorted(mates)]
+    if len(illumina_files) == 2:
+        return illumina_files[:1], illumina_files[1:]
+    return None
+
+
+# returns the shell pipeline which maps the Illumina reads of an organism against the shared index and sorts the
+# alignments to its own contigs into illumina/<prefix>.bam (.cram). Files which form pairs are mapped as pairs (the
+# mates of all pairs concatenated in matching order), otherwise the files are mapped as single reads one after another.
+def illumina_mapping_pipeline(prefix, mapping_threads, sorting_threads):
+    illumina_files = get_illumina_files(prefix)
+    pairs = pair_illumina_files(illumina_files)
+    if pairs is not None:
+        reads = illumina_input(pairs[0]) + " " + illumina_input(pairs[1])
+    else:
+        if len(illumina_files) > 1:
+            warning("The Illumina files of " + prefix + " do not form R1/R2 pairs, they are mapped as single reads")
+        reads = illumina_input(illumina_files)
+    bwa_command = [params["software_general"]["bwa"], "mem", "-t", str(mapping_threads),
+                   get_index_folder() + "_contigs.fasta"]
+    demultiplex_command = [sys.executable, os.path.abspath(__file__), "demultiplex", config_path, get_illumina_folder(),
+                           str(sorting_threads), prefix]
+    return " ".join(pipes.quote(a) for a in bwa_command) + " " + reads + " 2> " + \
+           pipes.quote(log_folder + "bwa_illumina_" + prefix + "_error.log") + " | " + \
+           " ".join(pipes.quote(a) for a in demultiplex_command)
+
+
+# mapps the Illumina reads of an organism with bwa mem into illumina/<prefix>.bam (.cram)
+def run_illumina_mapping(prefix):
+    create_folder(get_illumina_folder(), "Could not create the Illumina mapping folder!", 67)
+    threads = illumina_mapping_threads()
+    sorting_threads = max(1, min(threads, int(params["software_settings"]["sorting_threads"])))
+    debug("Mapping the Illumina reads of " + prefix)
+    return run_command(["/bin/bash", "-o", "pipefail", "-c", illumina_mapping_pipeline(prefix, threads, sorting_threads)],
+                       threads=threads + sorting_threads)
+
+
+# runs the mapping of the nanopore reads and the mapping of the Illumina reads of every organism (enable_illumina) in
+# one task graph, so the Illumina reads are mapped next to the nanopore reads. The graph has room for the nanopore
+# mapping and one Illumina mapping job.
+def run_mapping_stages():
+    mapping_threads = int(params["software_settings"]["mapping_threads"])
+    stages = {"mapping": (run_bwa_mapping, [get_index_folder() + "_contigs.fasta", get_mapping_reads_file()],
+                          get_mapping_outputs(),
+                          [params["software_general"]["bwa"], get_setting("software_settings", "streaming_mapping", False),
+                           mapping_shards(), use_compressed_storage(), get_prefixes()], mapping_threads)}
+    if use_overlapped_mapping():
+        # the conversion (and the read filter) is part of the mapping
+        stages["mapping"] = (run_overlapped_mapping, [params["nanopore_input"], get_index_folder() + "_contigs.fasta"],
+                             [get_reads_folder()] + ([get_filtered_reads_folder()] if use_read_filter() else []) +
+                             get_mapping_outputs(),
+                             [params["software_general"]["bwa"], use_compressed_storage(), get_prefixes(),
+                              read_filter_settings() if use_read_filter() else None], mapping_threads)
+    for prefix in get_illumina_prefixes():
+        stages["illumina:" + prefix] = (lambda prefix=prefix: run_illumina_mapping(prefix),
+                                        [get_index_folder() + "_contigs.fasta"] + get_illumina_files(prefix),
+                                        [get_alignment_file(prefix, get_illumina_folder())],
+                                        [params["software_general"]["bwa"], use_compressed_storage()],
+                                        illumina_mapping_threads())
+    if len(stages) == 1:
+        run_stage("mapping", *stages["mapping"])
+        return
+    tasks = dict((name, make_stage_task(name, function, inputs, outputs, config, threads=threads))
+                 for name, (function, inputs, outputs, config, threads) in stages.items())
+    failed = run_task_graph(tasks, mapping_threads + illumina_mapping_threads())
+    if len(failed) > 0:
+        abort("Mapping failed for: " + ", ".join(sorted(failed)) + " (see " + log_folder + ")", 67)
+
+
+# returns the organism prefix of a contig name written by run_bwa_index (<prefix>_contig_<n>)
+def contig_prefix(contig_name):
+    pos = contig_name.rfind("_contig_")
+    if pos == -1:
+        return None
+    return contig_name[:pos]
+
+
+# returns the path of bgzip
+def get_bgzip():
+    return get_setting("software_general", "bgzip", "bgzip")
+
+
+# starts a bgzip process (with the given arguments) for a compressed stream
+def start_bgzip(arguments, stdin=None, stdout=None):
     try:
-        p = subprocess.Popen(flagstats_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
+        return subprocess.Popen([get_bgzip(), "-@", str(compression_threads())] + arguments, stdin=stdin, stdout=stdout,
+                                bufsize=demultiplex_buffer_size)
     except OSError as e:
         if e.errno == os.errno.ENOENT:
-            abort("Could not split mappings into single files.. Wrong command?", 32)
+            abort("Could not start bgzip.. Wrong path?", 61)
         else:
-            abort("Something went wrong by splitting the mappings into single files", 33)
+            abort("Something went wrong by starting bgzip", 61)
+
+
+# opens a text file for writing. Files ending with .gz are compressed by a multithreaded bgzip process (append: add a
+# bgzf member to the file). Returns the stream and the compression process (None for plain files).
+def open_compressed_output(path, append=False):
+    if not path.endswith(".gz"):
+        return open(path, "ab" if append else "wb", demultiplex_buffer_size), None
+    with open(path, "ab" if append else "wb") as output:
+        p = start_bgzip(["-c"], stdin=subprocess.PIPE, stdout=output)
+    return p.stdin, p
+
+
+# opens a text file for reading. Files ending with .gz are decompressed by a multithreaded bgzip process. Returns the
+# stream and the decompression process (None for plain files).
+def open_compressed_input(path):
+    if not path.endswith(".gz"):
+        return open(path, "rb", demultiplex_buffer_size), None
+    p = start_bgzip(["-d", "-c", path], stdout=subprocess.PIPE)
+    return p.stdout, p
+
+
+# closes a stream of open_compressed_output, open_compressed_input or open_bam_stream and waits for its process
+# (command is the description of the process for the profile), aborts if the process failed
+def close_stream(stream, p, command, started):
+    stream.close()
+    if p is not None and wait_process(p, command, started) != 0:
+        abort(command + " failed (see " + log_folder + ")", 62)
+
+
+# opens an alignment file as bam stream for the native statistics, cram files are decoded into uncompressed bam by
+# samtools view. Returns the stream and the decoding process (None for bam files)
+def open_bam_stream(alignment_file):
+    if not alignment_file.endswith(".cram"):
+        return open(alignment_file, "rb", demultiplex_buffer_size), None
+    return open_alignment_stream(alignment_file, ["-u"])
+
+
+# opens a sam, bam or cram file as a stream of sam lines (bam and cram files are decoded by samtools view, options
+# replace -h). Returns the stream and the decoding process (None for sam files)
+def open_alignment_stream(alignment_file, options=None):
+    if alignment_file.endswith(".bam") or alignment_file.endswith(".cram"):
+        try:
+            p = subprocess.Popen([params["software_general"]["samtools"], "view"] + (options or ["-h"]) +
+                                 reference_options() + [alignment_file],
+                                 stdout=subprocess.PIPE, bufsize=demultiplex_buffer_size)
+        except OSError as e:
+            if e.errno == os.errno.ENOENT:
+                abort("Could not start samtools view.. Wrong path?", 39)
+            else:
+                abort("Something went wrong by starting samtools view", 40)
+        return p.stdout, p
+    return open(alignment_file, "rb", demultiplex_buffer_size), None
+
+
+# returns an empty collector of the per-read metrics of the organisms
+def new_read_metrics(prefixes):
+    return {"organisms": list(prefixes), "organism_ids": dict((prefix, i) for i, prefix in enumerate(prefixes)),
+            "batch": dict((column, []) for column in read_metrics_batch_columns),
+            "parts": dict((column, []) for column, dtype in read_metrics_columns)}
+
+
+# adds one sam record to the per-read metrics. The primary alignment makes the row of a read, its secondary and
+# supplementary alignments are counted on that row (bwa writes all alignments of a read next to each other).
+def add_read_metrics(metrics, line, prefix):
+    fields = line.rstrip("\n").split("\t", 11)
+    flag = int(fields[1])
+    batch = metrics["batch"]
+    if flag & 0x900:
+        if len(batch["name"]) > 0 and batch["name"][-1] == fields[0]:
+            batch["secondary" if flag & 0x100 else "supplementary"][-1] += 1
+        return
+    if len(batch["name"]) >= read_metrics_batch_size:
+        flush_read_metrics(metrics)
+    aligned = 0
+    columns = 0
+    for length, op in re.findall(r"(\d+)([MIDNSHP=X])", fields[5]):
+        if op in "MI=X":
+            aligned += int(length)
+        if op in "MID=X":
+            columns += int(length)
+    mismatches = re.search(r"(?:^|\t)NM:i:(\d+)", fields[11]) if len(fields) > 11 else None
+    batch["name"].append(fields[0])
+    batch["length"].append(len(fields[9]) if fields[9] != "*" else 0)
+    batch["qual"].append(fields[10] if fields[10] != "*" else "")
+    batch["organism"].append(metrics["organism_ids"].get(prefix, -1) if not flag & 0x4 else -1)
+    batch["mapq"].append(int(fields[4]))
+    batch["flag"].append(flag)
+    batch["aligned"].append(aligned if not flag & 0x4 else 0)
+    batch["columns"].append(columns if not flag & 0x4 else 0)
+    batch["mismatches"].append(int(mismatches.group(1)) if mismatches is not None else -1)
+    batch["secondary"].append(0)
+    batch["supplementary"].append(0)
+
+
+# converts the batch of reads of the per-read metrics into typed columns
+def flush_read_metrics(metrics):
+    batch = metrics["batch"]
+    if len(batch["name"]) == 0:
+        return
+    lengths = numpy.array(batch["length"], dtype=numpy.int64)
+    quality_lengths = numpy.array([len(qual) for qual in batch["qual"]], dtype=numpy.int64)
+    qualities = numpy.frombuffer("".join(batch["qual"]), dtype=numpy.uint8)
+    quality_sums = numpy.concatenate(([0], numpy.cumsum(qualities.astype(numpy.int64) - 33)))
+    ends = numpy.cumsum(quality_lengths)
+    mean_qualities = (quality_sums[ends] - quality_sums[ends - quality_lengths]) / \
+        numpy.maximum(quality_lengths, 1).astype(numpy.float64)
+    columns = numpy.array(batch["columns"], dtype=numpy.float64)
+    mismatches = numpy.array(batch["mismatches"], dtype=numpy.float64)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        identities = numpy.where((columns > 0) & (mismatches >= 0), 1 - mismatches / columns, numpy.nan)
+    table = {"keys": read_name_keys(batch["name"]), "length": lengths,
+             "mean_quality": numpy.where(quality_lengths > 0, mean_qualities, numpy.nan),
+             "organism": batch["organism"], "mapq": batch["mapq"], "flag": batch["flag"],
+             "aligned_fraction": numpy.array(batch["aligned"], dtype=numpy.float64) / numpy.maximum(lengths, 1),
+             "identity": identities, "secondary": batch["secondary"], "supplementary": batch["supplementary"]}
+    for column, dtype in read_metrics_columns:
+        metrics["parts"][column].append(numpy.asarray(table[column]).astype(dtype))
+    metrics["batch"] = dict((column, []) for column in read_metrics_batch_columns)
+
+
+# writes a per-read metrics table (one typed column per metric and the organisms) as npz file
+def save_read_metrics(metrics_file, table):
+    create_folder(os.path.dirname(metrics_file) + "/", "Could not create the read metrics folder!", 71)
+    with open(metrics_file + ".tmp", "wb") as metrics_output:
+        numpy.savez(metrics_output, **table)
+    os.rename(metrics_file + ".tmp", metrics_file)
+
+
+# writes the per-read metrics collected by the demultiplexer
+def write_read_metrics(metrics_file, metrics):
+    flush_read_metrics(metrics)
+    table = dict((column, numpy.concatenate(metrics["parts"][column]) if len(metrics["parts"][column]) > 0 else
+                  numpy.zeros(0, dtype=dtype)) for column, dtype in read_metrics_columns)
+    table["organisms"] = numpy.array(metrics["organisms"], dtype=str)
+    save_read_metrics(metrics_file, table)
+
+
+# returns the part files of a per-read metrics table in the order they were added
+def list_read_metrics_parts(metrics_file):
+    parts_folder = get_read_metrics_parts_folder(metrics_file)
+    if not os.path.isdir(parts_folder):
+        return []
+    return [parts_folder + str(number) + ".npz" for number in
+            sorted(int(part.split(".")[0]) for part in os.listdir(parts_folder) if part.endswith(".npz"))]
+
+
+# loads a per-read metrics table together with its parts (rows of the parts follow the rows of the table)
+def load_read_metrics(metrics_file):
+    parts = list_read_metrics_parts(metrics_file)
+    tables = []
+    for part in ([metrics_file] if os.path.isfile(metrics_file) or len(parts) == 0 else []) + parts:
+        with numpy.load(part) as table:
+            tables.append(dict((column, table[column]) for column in table.files))
+    if len(tables) == 1:
+        return tables[0]
+    combined = dict((column, numpy.concatenate([table[column] for table in tables]))
+                    for column, dtype in read_metrics_columns)
+    combined["organisms"] = tables[0]["organisms"]
+    return combined
+
+
+# moves a per-read metrics table (of the same organisms) into the parts of another table as part number. Only the
+# moved table is touched, the parts are combined by merge_read_metrics_parts or when the table is loaded.
+def add_read_metrics_part(metrics_file, target_metrics_file, number):
+    create_folder(get_read_metrics_parts_folder(target_metrics_file), "Could not create the read metrics folder!", 71)
+    shutil.move(metrics_file, get_read_metrics_parts_folder(target_metrics_file) + str(number) + ".npz")
+
+
+# combines the parts of a per-read metrics table into the table
+def merge_read_metrics_parts(metrics_file):
+    if len(list_read_metrics_parts(metrics_file)) == 0:
+        return
+    save_read_metrics(metrics_file, load_read_metrics(metrics_file))
+    shutil.rmtree(get_read_metrics_parts_folder(metrics_file))
+
+
+# splits a sam stream in a single pass into one output per organism prefix. Header lines are copied to every output,
+# alignments are routed by their reference name (RNAME). Unmapped reads and unknown contigs are dropped.
+# The per-read metrics of all records are collected into read_metrics (see new_read_metrics) if given. Returns the
+# number of alignments written per prefix.
+def demultiplex_sam(sam_stream, outputs, read_metrics=None):
+    counts = dict((prefix, 0) for prefix in outputs)
+    writers = list(outputs.values())
+    contig_outputs = {}  # cache: contig name -> prefix (or None)
+    for line in sam_stream:
+        if line.startswith("@"):
+            for writer in writers:
+                writer.write(line)
+            continue
+        rname = line.split("\t", 3)[2]
+        if rname not in contig_outputs:
+            prefix = contig_prefix(rname)
+            contig_outputs[rname] = prefix if prefix in outputs else None
+        prefix = contig_outputs[rname]
+        if read_metrics is not None:
+            add_read_metrics(read_metrics, line, prefix)
+        if prefix is not None:
+            outputs[prefix].write(line)
+            counts[prefix] += 1
+    return counts
+
+
+# splits the mapping file into one sam file per organism (bgzip compressed in compressed storage mode)
+def split_mappingfile():
+    splitted_mapping_folder = get_splitted_folder()
+    mapping_file = get_mapping_file()
+
+    create_folder(splitted_mapping_folder, "Could not create bwa index output folder!", 38)
+
+    # demultiplex the mapping file in one pass into one sam file per organism
+    outputs = {}
+    compressions = {}
+    for gen in params["file_mapping"]:
+        prefix = params["file_mapping"][gen]["prefix"]
+        outputs[prefix], compressions[prefix] = open_compressed_output(splitted_mapping_folder + prefix + ".sam" +
+                                                                      compressed_suffix())
+
+    debug("Prefix set: " + " ".join(outputs.keys()))
 
     try:
-        os.makedirs(stats_folder)
-    except:
-        abort("Could not create bwa index output folder!", 38)
-
-        # try:
-        #     p = subprocess.Popen("cp " + splitted_mapping_folder + "*.stats" + stats_folder, shell=True)
-        #     # p.stderr
-        #     # p2 = subprocess.Popen(stdin=p.stderr)
-        #     out, err = p.communicate()
-        # except OSError as e:
-        #     if e.errno == os.errno.ENOENT:
-        #         abort("Could not split mappings into single files.. Wrong command?", 32)
-        #     else:
-        #         abort("Something went wrong by splitting the mappings into single files", 33)
-        #
-        # try:
-        #     p = subprocess.Popen("cp " + splitted_mapping_folder + "*.flagstat " + stats_folder, shell=True)
-        #     # p.stderr
-        #     # p2 = subprocess.Popen(stdin=p.stderr)
-        #     out, err = p.communicate()
-        # except OSError as e:
-        #     if e.errno == os.errno.ENOENT:
-        #         abort("Could not split mappings into single files.. Wrong command?", 32)
-        #     else:
-        #         abort("Something went wrong by splitting the mappings into single files", 33)
-
-
-# run assembler
-# TODO
+        started = time.time()
+        sam_stream, p = open_alignment_stream(mapping_file)
+        read_metrics = new_read_metrics(get_prefixes())
+        counts = demultiplex_sam(sam_stream, outputs, read_metrics)
+        sam_stream.close()
+        if p is not None and wait_process(p, params["software_general"]["samtools"] + " view -h " + mapping_file,
+                                          started) != 0:
+            abort("Could not decode " + mapping_file, 39)
+    except IOError:
+        abort("Could not split mappings into single files.. Wrong path?", 32)
+    for prefix in outputs:
+        close_stream(outputs[prefix], compressions[prefix], get_bgzip() + " -c " + prefix + ".sam", started)
+        debug("Alignments for " + prefix + ": " + str(counts[prefix]))
+    write_read_metrics(get_read_metrics_file(), read_metrics)
+
+
+# splits mapping files into single files, takes care about unique identifiers. Sorts, indexes and evaluates the
+# mappings of every organism in a task graph: sort -> index -> (stats, flagstat) -> plot-bamstats, or
+# sort -> index -> bamstats with the native statistics engine
+def process_mappingfile():
+    splitted_mapping_folder = get_splitted_folder()
+    stats_folder = get_stats_folder()
+    samtools = params["software_general"]["samtools"]
+
+    # in streaming mode the mapping already wrote one sorted bam file per organism
+    streaming = use_streaming_mapping()
+    if not streaming:
+        run_stage("split", split_mappingfile, [get_mapping_file()],
+                  [splitted_mapping_folder + prefix + ".sam" + compressed_suffix() for prefix in get_prefixes()] +
+                  [get_read_metrics_file()], get_prefixes())
+
+    create_folder(stats_folder, "Could not create bwa index output folder!", 38)
+
+    tasks = {}
+    for prefix in get_prefixes():
+        bam = get_alignment_file(prefix)
+        sam = splitted_mapping_folder + prefix + ".sam" + compressed_suffix()
+        index_dependencies = []
+        if not streaming:
+            tasks["sort:" + prefix] = make_stage_task(
+                "sort:" + prefix,
+                lambda prefix=prefix, bam=bam, sam=sam: run_command(
+                    [samtools, "sort", "-@", str(params["software_settings"]["sorting_threads"]),
+                     "-T", splitted_mapping_folder + prefix + ".tmp"] + alignment_output_options() + ["-o", bam, sam],
+                    stderr_file=log_folder + "samtools_error.log", threads=params["software_settings"]["sorting_threads"]),
+                [sam], [bam], [samtools], threads=params["software_settings"]["sorting_threads"])
+            index_dependencies = ["sort:" + prefix]
+        tasks["index:" + prefix] = make_stage_task(
+            "index:" + prefix,
+            lambda bam=bam: run_command([samtools, "index", bam], stderr_file=log_folder + "samtools_error.log"),
+            [bam], [get_alignment_index(bam)], [samtools], index_dependencies)
+        tasks["coverage:" + prefix] = make_stage_task(
+            "coverage:" + prefix, lambda prefix=prefix: run_coverage_index(prefix),
+            [bam], [get_coverage_folder(prefix)],
+            [coverage_bin_size(), get_setting("software_settings", "coverage_gap_depth", 1)], ["index:" + prefix])
+        if use_native_stats():
+            tasks["bamstats:" + prefix] = make_stage_task(
+                "bamstats:" + prefix, lambda prefix=prefix: run_native_bamstats(prefix),
+                [bam], [stats_folder + prefix + "/"], [bam_stats_counters, bam_stats_histograms], ["index:" + prefix])
+            if scratch_folder is not None:
+                tasks["copy-back:" + prefix] = make_task(
+                    lambda bam=bam: copy_back([bam, get_alignment_index(bam)]), ["index:" + prefix])
+            continue
+        tasks["stats:" + prefix] = make_stage_task(
+            "stats:" + prefix,
+            lambda bam=bam: run_command([samtools, "stats", bam], stdout_file=bam + ".stats",
+                                        stderr_file=log_folder + "samtools_error.log"),
+            [bam], [bam + ".stats"], [samtools], ["index:" + prefix])
+        tasks["flagstat:" + prefix] = make_stage_task(
+            "flagstat:" + prefix,
+            lambda bam=bam: run_command([samtools, "flagstat", bam], stdout_file=bam + ".flagstat",
+                                        stderr_file=log_folder + "samtools_error.log"),
+            [bam], [bam + ".flagstat"], [samtools], ["index:" + prefix])
+        tasks["plot-bamstats:" + prefix] = make_stage_task(
+            "plot-bamstats:" + prefix, lambda prefix=prefix: plot_bamstats(prefix),
+            [bam + ".stats"], [stats_folder + prefix + "/"], [params["software_general"]["plot_bamstats"]],
+            ["stats:" + prefix])
+        if scratch_folder is not None:
+            tasks["copy-back:" + prefix] = make_task(
+                lambda bam=bam: copy_back([bam, get_alignment_index(bam), bam + ".stats", bam + ".flagstat"]),
+                ["index:" + prefix, "stats:" + prefix, "flagstat:" + prefix])
+
+    # the Illumina alignments are indexed and evaluated with the native statistics
+    for prefix in get_illumina_prefixes():
+        bam = get_alignment_file(prefix, get_illumina_folder())
+        tasks["illumina-index:" + prefix] = make_stage_task(
+            "illumina-index:" + prefix,
+            lambda bam=bam: run_command([samtools, "index", bam], stderr_file=log_folder + "samtools_error.log"),
+            [bam], [get_alignment_index(bam)], [samtools])
+        tasks["illumina-bamstats:" + prefix] = make_stage_task(
+            "illumina-bamstats:" + prefix,
+            lambda prefix=prefix, bam=bam: run_native_bamstats(prefix, bam, get_illumina_stats_folder(prefix)),
+            [bam], [get_illumina_stats_folder(prefix)], [bam_stats_counters, bam_stats_histograms],
+            ["illumina-index:" + prefix])
+        if scratch_folder is not None:
+            tasks["illumina-copy-back:" + prefix] = make_task(
+                lambda bam=bam: copy_back([bam, get_alignment_index(bam)]), ["illumina-index:" + prefix])
+
+    failed = run_task_graph(tasks, stage_thread_budget())
+    if len(failed) > 0:
+        abort("Processing the mappings failed for: " + ", ".join(failed) + " (see " + log_folder + ")", 50)
+
+
+# returns the number of cores stage tasks may occupy at the same time
+def stage_thread_budget():
+    return max(1, int(get_setting("software_settings", "stage_threads", params["software_settings"]["mapping_threads"])))
+
+
+# returns True if the mapped reads of every organism are assembled (assembly: True)
+def use_assembly():
+    return bool(get_setting("software_settings", "assembly", False)) == True
+
+
+# returns True if the assemblies are polished with nanopolish (assembly_polishing: True)
+def use_assembly_polishing():
+    return bool(get_setting("software_settings", "assembly_polishing", False)) == True
+
+
+# returns the threads of every assembly job (default: half of the mapping threads)
+def assembly_threads():
+    return max(1, int(get_setting("software_settings", "assembly_threads",
+                                  int(params["software_settings"]["mapping_threads"]) // 2)))
+
+
+# returns the memory budget of the concurrent assemblies in GB (default: job_memory_gb or the memory of the machine)
+def assembly_memory_budget():
+    budget = float(get_setting("software_settings", "assembly_memory_gb",
+                               get_setting("software_settings", "job_memory_gb", 0)))
+    if budget <= 0:
+        budget = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024.0 ** 3
+    return budget
+
+
+# estimates the peak memory of the assembly of an organism in GB from its mapped bases (taken from the coverage index,
+# or from the size of the alignment file if there is none): assembly_memory_per_base bytes per base, at least 1 GB
+def estimate_assembly_memory(prefix):
+    if os.path.isfile(get_coverage_folder(prefix) + "coverage.json"):
+        with open(get_coverage_folder(prefix) + "coverage.json", "r") as coverage_file:
+            total = json.load(coverage_file)["total"]
+        mapped_bases = total["mean_depth"] * total["length"]
+    else:
+        mapped_bases = 4 * os.path.getsize(get_alignment_file(prefix))
+    bytes_per_base = float(get_setting("software_settings", "assembly_memory_per_base", 10))
+    return max(1.0, mapped_bases * bytes_per_base / 1024.0 ** 3)
+
+
+# writes the reads of an organism for its assembly: the reads of its primary alignments, taken from the converted
+# reads through the read index (or from its sorted bam file as fastq if the reads have no index)
+def extract_assembly_reads(prefix):
+    create_folder(get_assembly_folder(prefix), "Could not create the assembly folder!", 68)
+    if has_read_index(get_read_index_file()):
+        with open(get_assembly_folder(prefix) + "reads.fastq", "wb") as output:
+            debug("Extracted " + str(extract_organism_reads(prefix, output)) + " reads of " + prefix)
+        return
+    return run_command([params["software_general"]["samtools"], "fastq", "-F", "0x904"] + reference_options() +
+                       [get_alignment_file(prefix)], stdout_file=get_assembly_folder(prefix) + "reads.fastq",
+                       stderr_file=log_folder + "samtools_error.log")
+
+
+# converts the segments of a gfa assembly graph into fasta contigs (named <prefix>_<segment>) and returns the contig
+# lengths
+def gfa_to_fasta(gfa_file, fasta_file, prefix):
+    lengths = []
+    with open(gfa_file, "r") as gfa, open(fasta_file, "w") as fasta:
+        for line in gfa:
+            if not line.startswith("S\t"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            fasta.write(">" + prefix + "_" + fields[1] + "\n")
+            for start in range(0, len(fields[2]), 80):
+                fasta.write(fields[2][start:start + 80] + "\n")
+            lengths.append(len(fields[2]))
+    return lengths
+
+
+# writes the size statistics of an assembly (contigs, total length, largest contig, N50) next to it
+def write_assembly_summary(lengths, summary_file):
+    lengths = sorted(lengths, reverse=True)
+    total = sum(lengths)
+    n50, covered = 0, 0
+    for length in lengths:
+        covered += length
+        if 2 * covered >= total:
+            n50 = length
+            break
+    with open(summary_file, "w") as summary:
+        json.dump({"contigs": len(lengths), "total_length": total, "largest_contig": lengths[0] if lengths else 0,
+                   "n50": n50}, summary, indent=1, sort_keys=True)
+
+
+# assembles the reads of an organism with minimap (all-vs-all overlaps) and miniasm into miniasm/<prefix>.fasta. The
+# overlaps are removed once the assembly graph is written.
+def run_miniasm(prefix):
+    miniasm_folder = get_miniasm_folder(prefix)
+    create_folder(miniasm_folder, "Could not create the assembly folder!", 68)
+    reads = get_assembly_folder(prefix) + "reads.fastq"
+    threads = assembly_threads()
+    if run_command([params["software_assembler"]["minimap"], "-Sw5", "-L100", "-m0", "-t" + str(threads), reads, reads],
+                   stdout_file=miniasm_folder + "reads.paf", stderr_file=log_folder + "minimap_" + prefix + ".log",
+                   threads=threads) != 0:
+        abort("minimap failed for " + prefix + " (see " + log_folder + ")", 69)
+    if run_command([params["software_assembler"]["miniasm"], "-f", reads, miniasm_folder + "reads.paf"],
+                   stdout_file=miniasm_folder + prefix + ".gfa",
+                   stderr_file=log_folder + "miniasm_" + prefix + ".log") != 0:
+        abort("miniasm failed for " + prefix + " (see " + log_folder + ")", 69)
+    os.remove(miniasm_folder + "reads.paf")
+    lengths = gfa_to_fasta(miniasm_folder + prefix + ".gfa", miniasm_folder + prefix + ".fasta", prefix)
+    write_assembly_summary(lengths, miniasm_folder + "assembly.json")
+    debug("Assembled " + prefix + ": " + str(len(lengths)) + " contigs, " + str(sum(lengths)) + " bp")
+
+
+# polishes the miniasm assembly of an organism with nanopolish: the reads are indexed against the fast5 files, mapped
+# to the draft contigs with bwa mem and the consensus is written to nanopolish/<prefix>.fasta
+def run_nanopolish(prefix):
+    polishing_folder = get_polishing_folder(prefix)
+    create_folder(polishing_folder, "Could not create the polishing folder!", 68)
+    draft = polishing_folder + "draft.fasta"
+    shutil.copy(get_miniasm_folder(prefix) + prefix + ".fasta", draft)
+    reads = get_assembly_folder(prefix) + "reads.fastq"
+    nanopolish = params["software_assembler"]["nanopolish"]
+    threads = assembly_threads()
+    samtools = params["software_general"]["samtools"]
+    bwa = params["software_general"]["bwa"]
+    polishing_log = log_folder + "nanopolish_" + prefix + ".log"
+    commands = [[bwa, "index", draft],
+                [nanopolish, "index", "-d", params["nanopore_input"], reads],
+                ["/bin/bash", "-o", "pipefail", "-c",
+                 " ".join(pipes.quote(a) for a in [bwa, "mem", "-x", "ont2d", "-t", str(threads), draft, reads]) +
+                 " | " + " ".join(pipes.quote(a) for a in [samtools, "sort", "-@", str(threads), "-T",
+                                                           polishing_folder + "reads.tmp", "-o",
+                                                           polishing_folder + "reads.bam", "-"])],
+                [samtools, "index", polishing_folder + "reads.bam"],
+                [nanopolish, "variants", "--consensus", polishing_folder + prefix + ".fasta", "-r", reads, "-b",
+                 polishing_folder + "reads.bam", "-g", draft, "-t", str(threads)]]
+    for command in commands:
+        if run_command(command, stderr_file=polishing_log, threads=threads) != 0:
+            abort("Polishing failed for " + prefix + " (see " + polishing_log + ")", 69)
+    lengths = []
+    with open(polishing_folder + prefix + ".fasta", "r") as polished:
+        for line in polished:
+            if line.startswith(">"):
+                lengths.append(0)
+            elif len(lengths) > 0:
+                lengths[-1] += len(line.strip())
+    write_assembly_summary(lengths, polishing_folder + "assembly.json")
+
+
+# evaluates the assembly of an organism with quast against its reference
+def run_quast(prefix):
+    return run_command([params["software_general"]["quast"], "-o", get_quast_folder(prefix), "-R",
+                        get_reference_file(prefix), "-t", str(assembly_threads()), "-l", prefix,
+                        get_assembly_file(prefix)], stderr_file=log_folder + "quast_" + prefix + ".log",
+                       threads=assembly_threads())
+
+
+# assembles the mapped reads of every organism in a task graph: reads -> miniasm (-> nanopolish) -> quast. The
+# assemblies run in parallel as far as the stage threads and the memory budget (assembly_memory_gb) allow, the peak
+# memory of every assembly is estimated from its mapped bases (see estimate_assembly_memory).
+def run_assemblies():
+    memory_budget = assembly_memory_budget()
+    tasks = {}
+    for prefix in get_prefixes():
+        bam = get_alignment_file(prefix)
+        reads = get_assembly_folder(prefix) + "reads.fastq"
+        memory_gb = estimate_assembly_memory(prefix)
+        if memory_gb > memory_budget:
+            warning("The assembly of " + prefix + " may need %.1f GB, more than the assembly memory budget (%.1f GB)"
+                    % (memory_gb, memory_budget))
+        tasks["asm-reads:" + prefix] = make_stage_task(
+            "asm-reads:" + prefix, lambda prefix=prefix: extract_assembly_reads(prefix), [bam], [reads],
+            [params["software_general"]["samtools"]])
+        tasks["miniasm:" + prefix] = make_stage_task(
+            "miniasm:" + prefix, lambda prefix=prefix: run_miniasm(prefix), [reads], [get_miniasm_folder(prefix)],
+            [params["software_assembler"]["minimap"], params["software_assembler"]["miniasm"]], ["asm-reads:" + prefix],
+            assembly_threads(), memory_gb)
+        evaluation_dependencies = ["miniasm:" + prefix]
+        if use_assembly_polishing():
+            tasks["nanopolish:" + prefix] = make_stage_task(
+                "nanopolish:" + prefix, lambda prefix=prefix: run_nanopolish(prefix),
+                [reads, get_miniasm_folder(prefix) + prefix + ".fasta"], [get_polishing_folder(prefix)],
+                [params["software_assembler"]["nanopolish"], params["nanopore_input"]], ["miniasm:" + prefix],
+                assembly_threads(), memory_gb)
+            evaluation_dependencies = ["nanopolish:" + prefix]
+        tasks["quast:" + prefix] = make_stage_task(
+            "quast:" + prefix, lambda prefix=prefix: run_quast(prefix),
+            [get_assembly_file(prefix), get_reference_file(prefix)], [get_quast_folder(prefix)],
+            [params["software_general"]["quast"]], evaluation_dependencies, assembly_threads())
+
+    debug("Assembling " + str(len(get_prefixes())) + " organisms with a memory budget of %.1f GB" % memory_budget)
+    failed = run_task_graph(tasks, stage_thread_budget(), memory_budget)
+    if len(failed) > 0:
+        abort("The assembly failed for: " + ", ".join(sorted(failed)) + " (see " + log_folder + ")", 69)
 ##########################################
 #    END SECTION  TOOLS_EXECUTION        #
 ##########################################
@@ -491,71 +2828,667 @@ def process_mappingfile():
 #    BEGIN SECTION  STATISTICS           #
 ##########################################
 
-# creates statistics from bam files using bamstats
-def plot_bamstats():
-    time.sleep(10)  # take 10 secons to snyc files
-
+# creates statistics charts of one organism from its samtools stats using bamstats
+def plot_bamstats(prefix):
     stats_folder = project_folder + "stats/"
-    splitted_mapping_folder = project_folder + params["gru_settings"]["mapping_foldername"] + "/splitted/"
-    # plot_stats_command = params["software_general"]["plot_bamstats"] + " -p " + stats_folder + " " + stats_folder + "*.stats"
+    splitted_mapping_folder = get_splitted_folder()
+    return run_command([params["software_general"]["plot_bamstats"], "-p", stats_folder + prefix + "/",
+                        get_alignment_file(prefix, splitted_mapping_folder) + ".stats"],
+                       stderr_file=log_folder + "plot_bamstats_error.log")
+
+
+# yields the decompressed blocks of a bgzf compressed stream (bam)
+def read_bgzf_blocks(handle):
+    while True:
+        header = handle.read(12)
+        if len(header) == 0:
+            break
+        if len(header) < 12 or header[:4] != "\x1f\x8b\x08\x04":
+            raise IOError("not a bgzf block")
+        extra_length = struct.unpack("<H", header[10:12])[0]
+        extra = handle.read(extra_length)
+        block_size = None
+        pos = 0
+        while pos + 4 <= len(extra):  # find the BC subfield which holds the block size
+            subfield_length = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == "BC":
+                block_size = struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+            pos += 4 + subfield_length
+        if block_size is None:
+            raise IOError("bgzf block without size")
+        data = handle.read(block_size - 12 - extra_length)
+        yield zlib.decompress(data[:-8], -15)
+
+
+# reads a bam stream. Returns the references [(name, length)] and an iterator over the alignments as tuples
+# (reference id, position, mapq, flag, read name, cigar, packed sequence, qualities, sequence length, tags) with the
+# cigar as list of (operation, length) and sequence/qualities/tags as raw bam strings.
+def read_bam(handle):
+    blocks = read_bgzf_blocks(handle)
+    state = {"buffer": "", "offset": 0}
+
+    def take(size):
+        while len(state["buffer"]) - state["offset"] < size:
+            try:
+                block = next(blocks)
+            except StopIteration:
+                return None
+            state["buffer"] = state["buffer"][state["offset"]:] + block
+            state["offset"] = 0
+        data = state["buffer"][state["offset"]:state["offset"] + size]
+        state["offset"] += size
+        return data
+
+    if take(4) != "BAM\x01":
+        raise IOError("not a bam file")
+    take(struct.unpack("<i", take(4))[0])  # header text
+    references = []
+    for i in range(struct.unpack("<i", take(4))[0]):
+        name = take(struct.unpack("<i", take(4))[0]).rstrip("\x00")
+        references.append((name, struct.unpack("<i", take(4))[0]))
+
+    def alignments():
+        while True:
+            size = take(4)
+            if size is None or len(size) < 4:
+                return
+            record = take(struct.unpack("<i", size)[0])
+            ref_id, pos, name_length, mapq, bam_bin, cigar_length, flag, seq_length = \
+                struct.unpack_from("<iiBBHHHi", record)
+            offset = 32
+            name = record[offset:offset + name_length - 1]
+            offset += name_length
+            cigar = [(op & 0xf, op >> 4) for op in struct.unpack_from("<%dI" % cigar_length, record, offset)]
+            offset += 4 * cigar_length
+            seq = record[offset:offset + (seq_length + 1) // 2]
+            offset += (seq_length + 1) // 2
+            qual = record[offset:offset + seq_length]
+            offset += seq_length
+            yield ref_id, pos, mapq, flag, name, cigar, seq, qual, seq_length, record[offset:]
+
+    return references, alignments()
+
+
+# returns the value of an integer tag (e.g. NM) of raw bam tags or None
+def bam_int_tag(tags, key):
+    pos = 0
+    while pos + 3 <= len(tags):
+        tag, value_type = tags[pos:pos + 2], tags[pos + 2]
+        pos += 3
+        if value_type in bam_tag_sizes:
+            if tag == key:
+                return struct.unpack_from("<" + bam_tag_formats[value_type], tags, pos)[0] if value_type != "A" else None
+            pos += bam_tag_sizes[value_type]
+        elif value_type in "ZH":
+            pos = tags.index("\x00", pos) + 1
+        elif value_type == "B":
+            sub_type, count = tags[pos], struct.unpack_from("<i", tags, pos + 1)[0]
+            pos += 5 + count * bam_tag_sizes[sub_type]
+        else:
+            return None
+    return None
+
+
+# creates empty counters and histograms of the native bam statistics
+def new_bam_stats():
+    return {"counters": dict((counter, 0) for counter in bam_stats_counters),
+            "histograms": dict((histogram, numpy.zeros(1, dtype=numpy.int64)) for histogram in bam_stats_histograms)}
+
+
+# adds values to a growing histogram
+def add_to_histogram(stats, histogram, values, weights=None):
+    if len(values) == 0:
+        return
+    counts = numpy.bincount(values, weights=weights).astype(numpy.int64)
+    current = stats["histograms"][histogram]
+    if len(counts) > len(current):
+        counts[:len(current)] += current
+        stats["histograms"][histogram] = counts
+    else:
+        current[:len(counts)] += counts
+
+
+# adds a batch of primary alignments to the statistics in a vectorised way
+def add_bam_batch(stats, batch):
+    counters = stats["counters"]
+    lengths = numpy.array(batch["length"], dtype=numpy.int64)
+    flags = numpy.array(batch["flag"], dtype=numpy.int64)
+    mapqs = numpy.array(batch["mapq"], dtype=numpy.int64)
+    mapped = (flags & 0x4) == 0
+
+    counters["reads_total"] += len(lengths)
+    counters["reads_qc_failed"] += int(numpy.count_nonzero(flags & 0x200))
+    counters["reads_duplicated"] += int(numpy.count_nonzero(flags & 0x400))
+    counters["reads_mapped"] += int(numpy.count_nonzero(mapped))
+    counters["reads_zero_mq"] += int(numpy.count_nonzero(mapped & (mapqs == 0)))
+    counters["bases_total"] += int(lengths.sum())
+    counters["bases_mapped"] += int(numpy.sum(batch["bases_mapped"]))
+    counters["mismatches"] += int(numpy.sum(batch["mismatches"]))
+
+    add_to_histogram(stats, "read_length", lengths)
+    add_to_histogram(stats, "mapq", mapqs[mapped])
+    add_to_histogram(stats, "insertions", numpy.array(batch["insertions"], dtype=numpy.int64))
+    add_to_histogram(stats, "deletions", numpy.array(batch["deletions"], dtype=numpy.int64))
+
+    qualities = numpy.frombuffer("".join(batch["qual"]), dtype=numpy.uint8)
+    add_to_histogram(stats, "quality", qualities[qualities != 0xff])
+
+    # gc content per read from the 4 bit encoded sequences (C = 2, G = 4)
+    packed = numpy.frombuffer("".join(batch["seq"]), dtype=numpy.uint8)
+    if len(packed) > 0:
+        gc = (((packed >> 4) == 2) | ((packed >> 4) == 4)).astype(numpy.int64) + \
+             (((packed & 0xf) == 2) | ((packed & 0xf) == 4)).astype(numpy.int64)
+        packed_lengths = (lengths + 1) // 2
+        with_sequence = packed_lengths > 0
+        starts = numpy.concatenate(([0], numpy.cumsum(packed_lengths)[:-1]))[with_sequence]
+        gc_percent = 100 * numpy.add.reduceat(gc, starts) // lengths[with_sequence]
+        add_to_histogram(stats, "gc", gc_percent)
+
+
+# computes the statistics of one bam stream in a single pass
+def compute_bam_stats(handle):
+    stats = new_bam_stats()
+    references, alignments = read_bam(handle)
+    batch = dict((column, []) for column in bam_stats_batch_columns)
+    for ref_id, pos, mapq, flag, name, cigar, seq, qual, seq_length, tags in alignments:
+        if flag & 0x100:  # secondary alignments
+            stats["counters"]["reads_non_primary"] += 1
+            continue
+        if flag & 0x800:  # supplementary alignments count for the mapped bases only (like samtools stats)
+            stats["counters"]["bases_mapped"] += sum(length for op, length in cigar if op in cigar_query_mapped)
+            stats["counters"]["mismatches"] += bam_int_tag(tags, "NM") or 0
+            continue
+        batch["length"].append(seq_length)
+        batch["flag"].append(flag)
+        batch["mapq"].append(mapq)
+        batch["seq"].append(seq)
+        batch["qual"].append(qual)
+        bases_mapped = 0
+        for op, length in cigar:
+            if op in cigar_query_mapped:
+                bases_mapped += length
+            if op == 1:
+                batch["insertions"].append(length)
+            elif op == 2:
+                batch["deletions"].append(length)
+        mismatches = bam_int_tag(tags, "NM") if not flag & 0x4 else None
+        batch["bases_mapped"].append(bases_mapped if not flag & 0x4 else 0)
+        batch["mismatches"].append(mismatches or 0)
+        if len(batch["length"]) >= bam_stats_batch_size:
+            add_bam_batch(stats, batch)
+            batch = dict((column, []) for column in bam_stats_batch_columns)
+    add_bam_batch(stats, batch)
+    return stats
+
+
+# merges the statistics b into a (counters and histograms are additive)
+def merge_bam_stats(a, b):
+    for counter in bam_stats_counters:
+        a["counters"][counter] += b["counters"][counter]
+    for histogram in bam_stats_histograms:
+        add_to_histogram(a, histogram, numpy.arange(len(b["histograms"][histogram])), b["histograms"][histogram])
+    return a
+
+
+# returns the derived summary values (averages, rates and percentages) of the statistics
+def summarize_bam_stats(stats):
+    counters = stats["counters"]
+
+    def percent(value, total):
+        return 100.0 * value / total if total > 0 else 0.0
+
+    return {"reads_filtered_percent": percent(counters["reads_filtered"], counters["reads_total"]),
+            "reads_non_primary_percent": percent(counters["reads_non_primary"],
+                                                 counters["reads_total"] + counters["reads_non_primary"]),
+            "reads_duplicated_percent": percent(counters["reads_duplicated"], counters["reads_total"]),
+            "reads_mapped_percent": percent(counters["reads_mapped"], counters["reads_total"]),
+            "reads_zero_mq_percent": percent(counters["reads_zero_mq"], counters["reads_mapped"]),
+            "read_length_average": float(counters["bases_total"]) / counters["reads_total"] if counters["reads_total"] else 0.0,
+            "bases_mapped_percent": percent(counters["bases_mapped"], counters["bases_total"]),
+            "error_rate": float(counters["mismatches"]) / counters["bases_mapped"] if counters["bases_mapped"] else 0.0}
+
+
+# writes the statistics (counters, summary and histograms) as json
+def write_bam_stats(stats, stats_file):
+    with open(stats_file, "w") as output:
+        json.dump({"counters": stats["counters"], "summary": summarize_bam_stats(stats),
+                   "histograms": dict((h, stats["histograms"][h].tolist()) for h in bam_stats_histograms)},
+                  output, indent=1, sort_keys=True)
+
+
+# reads statistics written by write_bam_stats
+def load_bam_stats(stats_file):
+    with open(stats_file, "r") as stats_input:
+        stats = json.load(stats_input)
+    for counter in bam_stats_counters:
+        stats["counters"].setdefault(counter, 0)  # statistics written before a counter was added
+    stats["histograms"] = dict((h, numpy.array(stats["histograms"].get(h, [0]), dtype=numpy.int64))
+                               for h in bam_stats_histograms)
+    return stats
+
+
+# renders a histogram as svg bar chart. Long histograms are combined into at most chart_max_bars bars.
+def render_histogram_svg(counts, title, xlabel):
+    counts = numpy.trim_zeros(numpy.asarray(counts, dtype=numpy.int64), "b")
+    if len(counts) == 0:
+        counts = numpy.zeros(1, dtype=numpy.int64)
+    bin_width = max(1, int(math.ceil(len(counts) / float(chart_max_bars))))
+    padded = numpy.zeros(bin_width * int(math.ceil(len(counts) / float(bin_width))), dtype=numpy.int64)
+    padded[:len(counts)] = counts
+    bars = padded.reshape(-1, bin_width).sum(axis=1)
+    return render_bars_svg(bars, title, xlabel, len(bars) * bin_width)
+
+
+# renders bars as svg chart, x_end labels the end of the x axis
+def render_bars_svg(bars, title, xlabel, x_end):
+    width, height, margin = 600, 400, 50
+    plot_width, plot_height = width - 2 * margin, height - 2 * margin
+    integers = numpy.issubdtype(bars.dtype, numpy.integer)
+    maximum = max(1, int(bars.max())) if integers else max(1.0, float(bars.max()))
+    bar_width = float(plot_width) / len(bars)
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" font-family="sans-serif" font-size="12">'
+           % (width, height),
+           '<text x="%d" y="20" text-anchor="middle" font-size="16">%s</text>' % (width // 2, title),
+           '<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="black"/>' % (margin, height - margin, width - margin, height - margin),
+           '<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="black"/>' % (margin, margin, margin, height - margin)]
+    for i, value in enumerate(bars):
+        bar_height = plot_height * float(value) / maximum
+        svg.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="#337ab7"/>'
+                   % (margin + i * bar_width, height - margin - bar_height, max(bar_width - 1, 0.5), bar_height))
+    svg.append('<text x="%d" y="%d" text-anchor="start">0</text>' % (margin, height - margin + 15))
+    svg.append('<text x="%d" y="%d" text-anchor="end">%d</text>' % (width - margin, height - margin + 15, x_end))
+    svg.append('<text x="%d" y="%d" text-anchor="middle">%s</text>' % (width // 2, height - 10, xlabel))
+    svg.append('<text x="%d" y="%d" text-anchor="end">%s</text>' % (margin - 5, margin + 5,
+                                                                   "%d" % maximum if integers else "%.1f" % maximum))
+    svg.append('</svg>')
+    return "\n".join(svg)
+
+
+# computes the statistics of one organism with the native engine and renders its charts into the stats folder
+def run_native_bamstats(prefix, alignment_file=None, organism_stats_folder=None):
+    alignment_file = get_alignment_file(prefix) if alignment_file is None else alignment_file
+    if organism_stats_folder is None:
+        organism_stats_folder = get_stats_folder() + prefix + "/"
+    create_folder(organism_stats_folder, "Could not create the statistics folder!", 51)
+    started = time.time()
+    bam, p = open_bam_stream(alignment_file)
+    stats = compute_bam_stats(bam)
+    close_stream(bam, p, params["software_general"]["samtools"] + " view -u " + prefix, started)
+    write_bam_stats(stats, organism_stats_folder + "gru-stats.json")
+    write_bam_stats_charts(stats, organism_stats_folder)
+
+
+# renders the charts of native statistics into a folder
+def write_bam_stats_charts(stats, folder):
+    for histogram, title, xlabel in native_stat_graphs:
+        with open(folder + histogram + ".svg", "w") as chart:
+            chart.write(render_histogram_svg(stats["histograms"][histogram], title, xlabel))
+
+
+# returns the reads and bases tables of the report (same layout as scraped from plot-bamstats) from native statistics
+def native_stats_tables(stats):
+    counters = stats["counters"]
+    summary = summarize_bam_stats(stats)
+    reads_stats_a = [str(counters["reads_total"]), str(counters["reads_filtered"]), str(counters["reads_non_primary"]),
+                     str(counters["reads_duplicated"]), str(counters["reads_mapped"]), str(counters["reads_zero_mq"]),
+                     "%.1f" % summary["read_length_average"]]
+    reads_stats_b = ["(%.2f%%)" % summary["reads_filtered_percent"], "(%.2f%%)" % summary["reads_non_primary_percent"],
+                     "(%.2f%%)" % summary["reads_duplicated_percent"], "(%.2f%%)" % summary["reads_mapped_percent"],
+                     "(%.2f%%)" % summary["reads_zero_mq_percent"]]
+    bases_stats_a = [str(counters["bases_total"]), str(counters["bases_mapped"]), "%.6e" % summary["error_rate"]]
+    bases_stats_b = ["(%.2f%% mapped)" % summary["bases_mapped_percent"]]
+    return reads_stats_a, reads_stats_b, bases_stats_a, bases_stats_b
+
+
+# returns True if the statistics are computed by gru instead of samtools stats and plot-bamstats
+def use_native_stats():
+    return get_setting("software_settings", "stats_engine", "native") == "native"
+
+
+# returns the number of reference bases per bin of the coverage index
+def coverage_bin_size():
+    return max(1, int(get_setting("software_settings", "coverage_bin_size", 100)))
+
+
+# adds the aligned blocks of a batch of alignments to the depth differences of a contig (+1 at the start, -1 at the
+# end of every block). The reference positions of all cigar operations are computed at once: a running sum over the
+# reference lengths of the operations, restarted at the position of every alignment.
+def add_coverage_batch(differences, positions, cigars, cigar_counts):
+    if len(cigars) == 0:
+        return
+    cigar = numpy.array(cigars, dtype=numpy.int64).reshape(-1, 2)
+    ops, lengths = cigar[:, 0], cigar[:, 1]
+    reference_lengths = numpy.where(numpy.in1d(ops, cigar_reference_covered + cigar_reference_skipped), lengths, 0)
+    ends = numpy.cumsum(reference_lengths)
+    first_ops = numpy.concatenate(([0], numpy.cumsum(cigar_counts)[:-1]))
+    read_starts = numpy.repeat(numpy.array(positions, dtype=numpy.int64) - (ends - reference_lengths)[first_ops],
+                               cigar_counts)
+    covered = numpy.in1d(ops, cigar_reference_covered) & (lengths > 0)
+    contig_length = len(differences) - 1
+    starts = numpy.clip((ends - reference_lengths + read_starts)[covered], 0, contig_length)
+    ends = numpy.clip((ends + read_starts)[covered], 0, contig_length)
+    differences += numpy.bincount(starts, minlength=contig_length + 1)[:contig_length + 1]
+    differences -= numpy.bincount(ends, minlength=contig_length + 1)[:contig_length + 1]
+
+
+# returns the runs of a boolean array as (start, end) arrays
+def find_runs(mask):
+    edges = numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8), [0])))
+    return numpy.nonzero(edges == 1)[0], numpy.nonzero(edges == -1)[0]
+
+
+# computes the per base depth of a contig from its depth differences, stores its bins in the coverage memmap and
+# returns its summary (mean depth, breadth of coverage, gaps with a depth below coverage_gap_depth)
+def finish_contig_coverage(name, differences, coverage, offset, bin_size, gap_depth):
+    length = len(differences) - 1
+    depth = numpy.cumsum(differences[:length], dtype=numpy.int64)
+    if length > 0:
+        bin_starts = numpy.arange(0, length, bin_size)
+        coverage[offset:offset + len(bin_starts)] = numpy.add.reduceat(depth, bin_starts) / \
+            numpy.minimum(bin_size, length - bin_starts).astype(numpy.float64)
+    gap_starts, gap_ends = find_runs(depth < gap_depth)
+    summary = {"name": name, "length": length, "offset": offset, "bins": int(math.ceil(length / float(bin_size))),
+               "mean_depth": float(depth.mean()) if length > 0 else 0.0,
+               "gaps": len(gap_starts), "gap_bases": int((gap_ends - gap_starts).sum())}
+    for breadth_depth in coverage_breadth_depths:
+        summary["breadth_" + str(breadth_depth)] = \
+            float(numpy.count_nonzero(depth >= breadth_depth)) / length if length > 0 else 0.0
+    largest = numpy.argsort(gap_starts - gap_ends, kind="mergesort")[:coverage_max_gaps]
+    return summary, [(name, int(gap_starts[i]), int(gap_ends[i])) for i in largest]
+
 
-    # plot_stats_command = "for i in " + stats_folder + "*.stats; do  plot-bamstats -p stats_$i/ $i; done"
-    plot_stats_command = "for i in `ls " + splitted_mapping_folder + "*.stats`; do base=$(basename $i | sed 's/\///' | sed 's/.bam.stats//'); " + \
-                         params["software_general"]["plot_bamstats"] + " -p " + stats_folder + "$base/ $i; done"
+# builds the coverage index of an organism in one streaming pass over its sorted bam file. The depth of one contig at a
+# time is summed up from the aligned blocks of the cigars (deletions and skipped regions are not covered, like samtools
+# depth) and stored as mean depth per bin of coverage_bin_size bases in coverage.npy, a memmap of all contigs of the
+# organism. The summary of every contig (mean depth, breadth at 1x/5x/10x, gaps) is written to coverage.json and
+# coverage-summary.tsv, the largest gaps to coverage-gaps.tsv and the depth along the organism to coverage.svg.
+def run_coverage_index(prefix):
+    coverage_folder = get_coverage_folder(prefix)
+    create_folder(coverage_folder, "Could not create the coverage folder!", 65)
+    bin_size = coverage_bin_size()
+    gap_depth = max(1, int(get_setting("software_settings", "coverage_gap_depth", 1)))
+    started = time.time()
+    bam, p = open_bam_stream(get_alignment_file(prefix))
+    references, alignments = read_bam(bam)
+    contigs = [(ref_id, name, length) for ref_id, (name, length) in enumerate(references)
+               if contig_prefix(name) == prefix]
+    total_bins = sum(int(math.ceil(length / float(bin_size))) for ref_id, name, length in contigs)
+    coverage = numpy.lib.format.open_memmap(coverage_folder + "coverage.npy", mode="w+", dtype=numpy.float32,
+                                            shape=(total_bins,))
+    summaries, gaps = [], []
+    batch = {"positions": [], "cigars": [], "cigar_counts": []}
+    current = {"contig": 0, "offset": 0, "differences": None}
 
-    print(plot_stats_command)
+    def finish_contigs(until_ref_id):
+        # completes the contigs in front of until_ref_id (all contigs for None)
+        while current["contig"] < len(contigs) and (until_ref_id is None or contigs[current["contig"]][0] < until_ref_id):
+            ref_id, name, length = contigs[current["contig"]]
+            differences = current["differences"]
+            if differences is None:
+                differences = numpy.zeros(length + 1, dtype=numpy.int64)  # contig without alignments
+            add_coverage_batch(differences, batch["positions"], batch["cigars"], batch["cigar_counts"])
+            batch.update(positions=[], cigars=[], cigar_counts=[])
+            summary, contig_gaps = finish_contig_coverage(name, differences, coverage, current["offset"], bin_size,
+                                                          gap_depth)
+            summaries.append(summary)
+            gaps[:] = sorted(gaps + contig_gaps, key=lambda gap: gap[1] - gap[2])[:coverage_max_gaps]
+            current.update(contig=current["contig"] + 1, offset=current["offset"] + summary["bins"], differences=None)
+
+    for ref_id, pos, mapq, flag, name, cigar, seq, qual, seq_length, tags in alignments:
+        if flag & coverage_excluded_flags or ref_id < 0:
+            continue
+        finish_contigs(ref_id)
+        if current["contig"] >= len(contigs) or contigs[current["contig"]][0] != ref_id:
+            continue  # contig of another organism
+        if current["differences"] is None:
+            current["differences"] = numpy.zeros(contigs[current["contig"]][2] + 1, dtype=numpy.int64)
+        batch["positions"].append(pos)
+        batch["cigars"].extend(cigar)
+        batch["cigar_counts"].append(len(cigar))
+        if len(batch["positions"]) >= bam_stats_batch_size:
+            add_coverage_batch(current["differences"], batch["positions"], batch["cigars"], batch["cigar_counts"])
+            batch.update(positions=[], cigars=[], cigar_counts=[])
+    finish_contigs(None)
+    close_stream(bam, p, params["software_general"]["samtools"] + " view -u " + prefix, started)
+    coverage.flush()
+    contig_map = load_contig_map()
+    for summary in summaries:
+        summary["original_name"] = contig_map.get(summary["name"], {}).get("original_name", summary["name"])
+    write_coverage_index(prefix, coverage, summaries, gaps, bin_size, gap_depth)
+
+
+# writes the summary tables and the chart of a coverage index. Gaps are given as 0-based, half open ranges (like bed).
+def write_coverage_index(prefix, coverage, summaries, gaps, bin_size, gap_depth):
+    coverage_folder = get_coverage_folder(prefix)
+    length = sum(summary["length"] for summary in summaries)
+    total = {"length": length, "contigs": len(summaries),
+             "mean_depth": sum(s["mean_depth"] * s["length"] for s in summaries) / length if length > 0 else 0.0,
+             "gaps": sum(s["gaps"] for s in summaries), "gap_bases": sum(s["gap_bases"] for s in summaries)}
+    breadth_columns = ["breadth_" + str(breadth_depth) for breadth_depth in coverage_breadth_depths]
+    for column in breadth_columns:
+        total[column] = sum(s[column] * s["length"] for s in summaries) / length if length > 0 else 0.0
+    with open(coverage_folder + "coverage.json", "w") as output:
+        json.dump({"bin_size": bin_size, "gap_depth": gap_depth, "total": total, "contigs": summaries,
+                   "largest_gaps": [{"contig": contig, "start": start, "end": end, "length": end - start}
+                                    for contig, start, end in gaps]}, output, indent=1, sort_keys=True)
+    with open(coverage_folder + "coverage-summary.tsv", "w") as output:
+        output.write("\t".join(["contig", "original_name", "length", "mean_depth"] +
+                               [str(d) + "x_breadth" for d in coverage_breadth_depths] + ["gaps", "gap_bases"]) + "\n")
+        for summary in summaries:
+            output.write("\t".join([summary["name"], summary["original_name"], str(summary["length"]),
+                                    "%.2f" % summary["mean_depth"]] +
+                                   ["%.4f" % summary[column] for column in breadth_columns] +
+                                   [str(summary["gaps"]), str(summary["gap_bases"])]) + "\n")
+    with open(coverage_folder + "coverage-gaps.tsv", "w") as output:
+        output.write("contig\tstart\tend\tlength\n")
+        for contig, start, end in gaps:
+            output.write(contig + "\t" + str(start) + "\t" + str(end) + "\t" + str(end - start) + "\n")
+    with open(coverage_folder + "coverage.svg", "w") as chart:
+        chart.write(render_coverage_svg(coverage, bin_size))
+
+
+# renders the binned depth of an organism as svg chart, neighbouring bins are averaged into at most chart_max_bars bars
+def render_coverage_svg(coverage, bin_size):
+    if len(coverage) == 0:
+        return render_bars_svg(numpy.zeros(1), "Coverage depth", "position in the contigs (bp)", 0)
+    group = max(1, int(math.ceil(len(coverage) / float(chart_max_bars))))
+    group_starts = numpy.arange(0, len(coverage), group)
+    bars = numpy.add.reduceat(numpy.asarray(coverage, dtype=numpy.float64), group_starts) / \
+        numpy.minimum(group, len(coverage) - group_starts)
+    return render_bars_svg(bars, "Coverage depth", "position in the contigs (bp)", len(coverage) * bin_size)
+
+
+# opens the coverage index of an organism. Returns the index (coverage.json) and the binned depth of all contigs as
+# read only memmap, so queries only read the bins they need.
+def open_coverage_index(prefix):
+    with open(get_coverage_folder(prefix) + "coverage.json", "r") as index_file:
+        index = json.load(index_file)
+    return index, numpy.load(get_coverage_folder(prefix) + "coverage.npy", mmap_mode="r")
+
+
+# returns the bins of a contig (gru or original contig name) which overlap the 0-based, half open range [start, end)
+# (default: the whole contig) as list of (bin start, bin end, mean depth)
+def query_coverage(index, coverage, contig, start=0, end=None):
+    for summary in index["contigs"]:
+        if contig in (summary["name"], summary.get("original_name")):
+            break
+    else:
+        raise KeyError("unknown contig " + contig)
+    bin_size = index["bin_size"]
+    end = summary["length"] if end is None else min(end, summary["length"])
+    first, last = max(0, start) // bin_size, int(math.ceil(end / float(bin_size)))
+    depths = coverage[summary["offset"] + first:summary["offset"] + max(first, last)]
+    return [((first + i) * bin_size, min((first + i + 1) * bin_size, summary["length"]), float(depth))
+            for i, depth in enumerate(depths)]
+
+
+# prints the binned depth of a contig range (arguments: config file, organism prefix, contig[:start-end] with 1-based,
+# inclusive positions like samtools regions)
+def run_coverage_query(arguments):
+    global project_folder
+    if len(arguments) != 3:
+        abort("Wrong number of arguments for coverage.", 1, True)
+    read_config(arguments[0])
+    project_folder = params["project_settings"]["project_folder"]
+    region = re.match(r"^(.+?)(?::(\d+)-(\d+))?$", arguments[2])
+    start = int(region.group(2)) - 1 if region.group(2) else 0
+    end = int(region.group(3)) if region.group(3) else None
     try:
-        p = subprocess.Popen(plot_stats_command, shell=True)
-        # p.stderr
-        # p2 = subprocess.Popen(stdin=p.stderr)
-        out, err = p.communicate()
-        time.sleep(10)
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            abort("Could not create statisic charts.. Wrong command?", 32)
+        index, coverage = open_coverage_index(arguments[1])
+        bins = query_coverage(index, coverage, region.group(1), start, end)
+    except (IOError, KeyError) as e:
+        abort("Could not query the coverage index: " + str(e), 65)
+    sys.stdout.write("contig\tstart\tend\tmean_depth\n")
+    for bin_start, bin_end, depth in bins:
+        sys.stdout.write("%s\t%d\t%d\t%.2f\n" % (region.group(1), bin_start + 1, bin_end, depth))
+
+
+# returns the N50 of read lengths
+def length_n50(lengths):
+    if len(lengths) == 0:
+        return 0
+    lengths = numpy.sort(lengths.astype(numpy.int64))[::-1]
+    sums = numpy.cumsum(lengths)
+    return int(lengths[numpy.searchsorted(sums, (sums[-1] + 1) // 2)])
+
+
+# returns the mean of the values which are not nan (nan if there are none)
+def nan_mean(values):
+    values = values[~numpy.isnan(values)]
+    return float(values.mean()) if len(values) > 0 else float("nan")
+
+
+# summarizes a per-read metrics table per organism (and the unmapped reads) for the reads with at least min_length
+# bases and a mean quality of at least min_quality. Returns rows of organism, reads, bases, fraction of the reads,
+# mean length, N50, mean quality, mean identity, mean aligned fraction and reads with supplementary alignments.
+def summarize_read_metrics(table, min_length=0, min_quality=0):
+    selected = (table["length"] >= min_length) & ~(table["mean_quality"] < min_quality)
+    total = max(1, int(numpy.count_nonzero(selected)))
+    rows = []
+    for organism, name in list(enumerate(table["organisms"])) + [(-1, "unmapped")]:
+        reads = selected & (table["organism"] == organism)
+        lengths = table["length"][reads].astype(numpy.int64)
+        rows.append((name, len(lengths), int(lengths.sum()), len(lengths) / float(total),
+                     float(lengths.mean()) if len(lengths) > 0 else 0.0, length_n50(lengths),
+                     nan_mean(table["mean_quality"][reads]), nan_mean(table["identity"][reads]),
+                     nan_mean(table["aligned_fraction"][reads]),
+                     int(numpy.count_nonzero(table["supplementary"][reads]))))
+    return rows
+
+
+# prints the per organism summary of per-read metrics tables as tsv, so runs can be compared without reading their
+# alignments (arguments: optionally --min-length and --min-quality, then read_metrics.npz files or job config files)
+def run_read_metrics_query(arguments):
+    global project_folder
+    options = {"--min-length": 0, "--min-quality": 0}
+    runs = []
+    while len(arguments) > 0:
+        argument = arguments.pop(0)
+        if argument in options:
+            if len(arguments) == 0:
+                abort("Missing value of " + argument, 1, True)
+            options[argument] = float(arguments.pop(0))
         else:
-            abort("Something went wrong by creating statistic charts", 33)
+            runs.append(argument)
+    if len(runs) == 0:
+        abort("No read metrics given.", 1, True)
+    sys.stdout.write("run\torganism\treads\tbases\tfraction\tmean_length\tn50\tmean_quality\tmean_identity\t"
+                     "aligned_fraction\tsupplementary\n")
+    for run in runs:
+        metrics_file = run
+        if run.endswith(".yml") or run.endswith(".yaml"):
+            read_config(run)
+            project_folder = params["project_settings"]["project_folder"]
+            metrics_file = get_read_metrics_file()
+        try:
+            table = load_read_metrics(metrics_file)
+        except (IOError, KeyError) as e:
+            abort("Could not read the read metrics of " + run + ": " + str(e), 71)
+        for row in summarize_read_metrics(table, options["--min-length"], options["--min-quality"]):
+            sys.stdout.write("%s\t%s\t%d\t%d\t%.4f\t%.1f\t%d\t%.2f\t%.4f\t%.4f\t%d\n" % ((run,) + row))
 
 
 ##########################################
 #    BEGIN SECTION  RENDERING            #
 ##########################################
+# writes the report page. The template is copied into the output file piece by piece and every <gru-.../> placeholder
+# is replaced by the chunks of its renderer, so the page is never held in memory as a whole. Charts are referenced as
+# lazily loaded files of the stats folder (report_assets: external) or embedded as data uris (report_assets: inline).
 def render_output():
-    output = ""
-    output_file = open(params["project_settings"]["project_folder"] + 'gru-output.html', 'w')
-    with open('template.html', 'r') as template:
-        output = template.read()
+    with open('template.html', 'r') as template_file:
+        template = template_file.read()
+    renderers = {"<gru-menu-general/>": render_menu_general,
+                 "<gru-menu-organism-statistics/>": render_menu_organism_statistics,
+                 "<gru-menu-assemblies/>": render_menu_assemblies,
+                 "<gru-menu-logs/>": render_menu_logs,
+                 "<gru-content-settings-general/>": render_settings_general,
+                 "<gru-content-file-mapping/>": render_file_mapping,
+                 "<gru-content-software-used/>": render_software_used,
+                 "<gru-content-organisms-stats/>": render_organisms_stats,
+                 "<gru-content-assembly-overview/>": lambda: [render_assembly_overview()],
+                 "<gru-content-quast/>": lambda: [render_quast_report()],
+                 "<gru-content-profile/>": lambda: [render_profile_table()]}
+
+    with open(params["project_settings"]["project_folder"] + 'gru-output.html', 'w') as output_file:
+        position = 0
+        for placeholder in re.finditer(r"<gru-[a-z-]+/>", template):
+            output_file.write(template[position:placeholder.start()])
+            renderer = renderers.get(placeholder.group(0))
+            if renderer is None:
+                output_file.write(placeholder.group(0))
+            else:
+                for chunk in renderer():
+                    output_file.write(chunk)
+            position = placeholder.end()
+        output_file.write(template[position:])
+
 
-    ##produce captions + menu entreis
+# returns True if the charts are embedded into the report instead of referenced as files
+def use_inline_report_assets():
+    return get_setting("software_settings", "report_assets", "external") == "inline"
+
+
+# renders the menu entries of the general panes
+def render_menu_general():
     gru_menu_general = '<h3 class="gru_menu_general">General</h3>'
     gru_menu_general += '<ul class="nav nav-sidebar"> <li class="active"><a href="#" data-paneclass="gru-general-overview">Input overview</a></li>' \
                         '<li><a href="#" data-paneclass="gru-general-organisms">Organisms</a></li>' \
                         '</ul>'
-    output = output.replace("<gru-menu-general/>", gru_menu_general)
+    return [gru_menu_general]
+
 
+# renders the menu entries of the organism statistics
+def render_menu_organism_statistics():
     gru_menu_organism_staticstics = '<h3>Organism statistics</h3><ul class="nav nav-sidebar">'
     for gen in params["file_mapping"]:
         prefix = params["file_mapping"][gen]["prefix"] + " "
         gru_menu_organism_staticstics += '<li><a href="#" data-paneclass="gru-stats-' + prefix + '">' + prefix + '</a></li>'  # e.g. gru-stats-nc201
 
     gru_menu_organism_staticstics += '</ul>'
-    output = output.replace("<gru-menu-organism-statistics/>", gru_menu_organism_staticstics)
+    return [gru_menu_organism_staticstics]
 
+
+# renders the menu entries of the assemblies
+def render_menu_assemblies():
     gru_menu_assemblies = '<h3>Assemblies</h3>' \
                           '<ul class="nav nav-sidebar">' \
                           '<li><a href="#" data-paneclass="gru-assembler-overview">Assembler overview</a></li> <li><a href="#" data-paneclass="gru-assembler-quast">Quast report</a></li>' \
                           '</ul>'
-    output = output.replace("<gru-menu-assemblies/>", gru_menu_assemblies)
+    return [gru_menu_assemblies]
+
 
+# renders the menu entries of the logs
+def render_menu_logs():
     gru_menu_logs = '<h3>Logs</h3>' \
                     '<ul class="nav nav-sidebar">' \
                     '<li><a href="#" data-paneclass="">gru logs</a></li>' \
+                    '<li><a href="#" data-paneclass="gru-logs-profile">Stage timings</a></li>' \
                     '<li><a href="#" data-paneclass="">3rd party software logs</a></li></ul>'
+    return [gru_menu_logs]
 
-    output = output.replace("<gru-menu-logs/>", gru_menu_logs)
 
-    # content - general
-    ## Input overview
+# renders the rows of the input overview
+def render_settings_general():
     gru_content_settings_general = "<tr><td>Project folder</td><td>" + params["project_settings"][
         "project_folder"] + "</td></tr>"
     gru_content_settings_general += "<tr><td>Enable overwrite</td><td>" + "Yes" if bool(
@@ -564,12 +3497,37 @@ def render_output():
     gru_content_settings_general += "<tr><td>Enable references</td><td>" + "Yes" if bool(
         params["references"]["enable_references"]) == True else "No" + "</td></tr>"
     gru_content_settings_general += "<tr><td>References folder</td><td>" + params["references"]["folder"] + "</td></tr>"
+    return [gru_content_settings_general, render_read_filter_rows()]
+
+
+# renders the read filter summary as rows of the input overview
+def render_read_filter_rows():
+    if not use_read_filter() or not os.path.isfile(get_read_filter_summary()):
+        return "<tr><td>Read filter</td><td>disabled</td></tr>"
+    with open(get_read_filter_summary(), "r") as summary_file:
+        summary = json.load(summary_file)
+    settings, counts = summary["settings"], summary["counts"]
 
-    output = output.replace("<gru-content-settings-general/>", gru_content_settings_general)
+    def percent(value, total):
+        return " (%.2f%%)" % (100.0 * value / total) if total > 0 else ""
 
-    ## GRU content file mapping
+    rows = "<tr><td>Read filter</td><td>length &ge; %d bp, mean quality &ge; %.1f, trimmed %d bp (head) and %d bp " \
+           "(tail)</td></tr>" % (settings["min_length"], settings["min_quality"], settings["trim_head"],
+                                  settings["trim_tail"])
+    rows += "<tr><td>Reads passed</td><td>" + str(counts["reads_passed"]) + " of " + str(counts["reads_total"]) + \
+            percent(counts["reads_passed"], counts["reads_total"]) + "</td></tr>"
+    rows += "<tr><td>Reads rejected (too short)</td><td>" + str(counts["reads_too_short"]) + \
+            percent(counts["reads_too_short"], counts["reads_total"]) + "</td></tr>"
+    rows += "<tr><td>Reads rejected (low quality)</td><td>" + str(counts["reads_low_quality"]) + \
+            percent(counts["reads_low_quality"], counts["reads_total"]) + "</td></tr>"
+    rows += "<tr><td>Bases passed</td><td>" + str(counts["bases_passed"]) + " of " + str(counts["bases_total"]) + \
+            percent(counts["bases_passed"], counts["bases_total"]) + ", " + str(counts["bases_trimmed"]) + \
+            " trimmed</td></tr>"
+    return rows
 
-    gru_content_file_mapping = ""
+
+# renders one row per organism of the file mapping
+def render_file_mapping():
     for gen in params["file_mapping"]:
         genome = params["file_mapping"][gen]
         prefix = params["file_mapping"][gen]["prefix"]
@@ -585,27 +3543,17 @@ def render_output():
         else:
             illumina_reads = "-"
 
-        gru_content_file_mapping += "<tr><td>" + prefix + "</td><td>" + prefix + "</td><td>" + reference + "</td><td>" + illumina_reads + "</td></tr>"
-    output = output.replace("<gru-content-file-mapping/>", gru_content_file_mapping)
+        yield "<tr><td>" + prefix + "</td><td>" + prefix + "</td><td>" + reference + "</td><td>" + illumina_reads + "</td></tr>"
 
-    ## Software
 
-    gru_content_software_used = ""
+# renders one row per configured program
+def render_software_used():
     for programm in params["software_general"]:
-        gru_content_file_mapping += "<tr><td>" + programm + "</td><td>" + params["software_general"][
-            programm] + "</td></tr>"
-    output = output.replace("<gru-content-file-mapping/>", gru_content_software_used)
-
-    ##Used assembler
-    gru_content_assembler_used = ""
-    # TODO
-
+        yield "<tr><td>" + programm + "</td><td>" + str(params["software_general"][programm]) + "</td></tr>"
 
-    # Organism details
-    # TODO
 
-    # Organism statistics
-    gru_content_organisms_stats = ""
+# renders the statistics pane of every organism. Every pane is wrapped into a <template>, the page renders it when it is opened first.
+def render_organisms_stats():
     stats_folder = project_folder + "stats/"
     for organism in params["file_mapping"]:
         prefix = params["file_mapping"][organism]["prefix"]
@@ -613,18 +3561,28 @@ def render_output():
                                                                                                                                '<h1 class="page-header">Statistics ' + prefix + '</h1>' \
                                                                                                                                                                                 '<h2>Overview</h2>'
 
-        # read stats from bamstats html and strip it
-        bamstats_file = open(stats_folder + prefix + "/index.html")
-        bamstats_s = bamstats_file.read()
-        bamstats_html = etree.HTML(bamstats_s)
-        reads_stats_a = [stat.strip(' ') for stat in
-                         bamstats_html.xpath('//table[@class="nums"]/tr[2]/td/table/tr/td[2]//text()')]
-        reads_stats_b = [stat.strip(' ') for stat in
-                         bamstats_html.xpath('//table[@class="nums"]/tr[2]/td/table/tr/td[3]//text()')]
-        bases_stats_a = [stat.strip(' ') for stat in
-                         bamstats_html.xpath('//table[@class="nums"]/tr[4]/td/table/tr/td[2]//text()')]
-        bases_stats_b = [stat.strip(' ') for stat in
-                         bamstats_html.xpath('//table[@class="nums"]/tr[4]/td/table/tr/td[3]//text()')]
+        if use_native_stats():
+            # read the stats computed by gru
+            reads_stats_a, reads_stats_b, bases_stats_a, bases_stats_b = native_stats_tables(
+                load_bam_stats(stats_folder + prefix + "/gru-stats.json"))
+        else:
+            # read stats from bamstats html and strip it
+            bamstats_file = open(stats_folder + prefix + "/index.html")
+            bamstats_s = bamstats_file.read()
+            bamstats_html = etree.HTML(bamstats_s)
+            reads_stats_a = [stat.strip(' ') for stat in
+                             bamstats_html.xpath('//table[@class="nums"]/tr[2]/td/table/tr/td[2]//text()')]
+            reads_stats_b = [stat.strip(' ') for stat in
+                             bamstats_html.xpath('//table[@class="nums"]/tr[2]/td/table/tr/td[3]//text()')]
+            bases_stats_a = [stat.strip(' ') for stat in
+                             bamstats_html.xpath('//table[@class="nums"]/tr[4]/td/table/tr/td[2]//text()')]
+            bases_stats_b = [stat.strip(' ') for stat in
+                             bamstats_html.xpath('//table[@class="nums"]/tr[4]/td/table/tr/td[3]//text()')]
+
+        coverage_index = None
+        if os.path.isfile(get_coverage_folder(prefix) + "coverage.json"):
+            with open(get_coverage_folder(prefix) + "coverage.json", "r") as coverage_file:
+                coverage_index = json.load(coverage_file)
 
         reads_mapped = reads_stats_b[3].translate(None, '()%').replace(',', '.')
         organism_stat += '<div class="row">' \
@@ -665,76 +3623,617 @@ def render_output():
                          '<tbody><tr><th>Futher stats</th></tr>' \
                          '<tr>' \
                          '<td class="pad"><table>' \
-                         '<tbody><tr><td>Key</td><td class="right"> value</td><td class="right"></td></tr>' \
-                         '</tbody></table></td></tr>' \
+                         '<tbody>' + render_coverage_rows(coverage_index) + '</tbody></table></td></tr>' \
                          '</tbody></table>' \
                          '</div>' \
                          '</div>'
 
-        organism_stat += '<div class="row gru-bamstats-charts">'\
-                '<h2>Bamstats charts'\
-                '<a tabindex="0" class="btn btn-default gru-popover" role="button" data-toggle="popover" data-trigger="focus" title="Information" data-content="These charts were generated by samtools\' plot-bamstats. For further description and meaning of the charts please consider the samtools manual."><span class="glyphicon glyphicon-info-sign" aria-hidden="true"></span></a>'\
-                '</h2>'
-        stat_graphs = [("gc-content", "GC Content"),
-                       ("coverage", "Coverage"),
-                       ("quals", "Quality per cycle"),
-                       ("quals2", "Quality per cycle"),
-                       ("quals3", "Quality per cycle"),
-                       ("quals-hm", "Quality per cycle"),
-                       ("acgt-cycles", "Per-base sequence content"),
-                       ("gc-depth", "Mapped depth vs GC"),
-                       ("indel-cycles", "InDels per cycle"),
-                       ("indel-dist", "InDel length")]
+        if use_native_stats():
+            organism_stat += '<div class="row gru-bamstats-charts">'\
+                    '<h2>Mapping charts'\
+                    '<a tabindex="0" class="btn btn-default gru-popover" role="button" data-toggle="popover" data-trigger="focus" title="Information" data-content="These charts were computed by gru from the primary alignments of the sorted bam file."><span class="glyphicon glyphicon-info-sign" aria-hidden="true"></span></a>'\
+                    '</h2>'
+            stat_graphs = [(stats_folder + prefix + "/" + histogram + ".svg", title)
+                           for histogram, title, xlabel in native_stat_graphs]
+        else:
+            organism_stat += '<div class="row gru-bamstats-charts">'\
+                    '<h2>Bamstats charts'\
+                    '<a tabindex="0" class="btn btn-default gru-popover" role="button" data-toggle="popover" data-trigger="focus" title="Information" data-content="These charts were generated by samtools\' plot-bamstats. For further description and meaning of the charts please consider the samtools manual."><span class="glyphicon glyphicon-info-sign" aria-hidden="true"></span></a>'\
+                    '</h2>'
+            stat_graphs = [(stats_folder + prefix + "/" + graph, description) for graph, description in
+                           [("gc-content.png", "GC Content"),
+                            ("coverage.png", "Coverage"),
+                            ("quals.png", "Quality per cycle"),
+                            ("quals2.png", "Quality per cycle"),
+                            ("quals3.png", "Quality per cycle"),
+                            ("quals-hm.png", "Quality per cycle"),
+                            ("acgt-cycles.png", "Per-base sequence content"),
+                            ("gc-depth.png", "Mapped depth vs GC"),
+                            ("indel-cycles.png", "InDels per cycle"),
+                            ("indel-dist.png", "InDel length")]]
+        if coverage_index is not None:
+            stat_graphs.append((get_coverage_folder(prefix) + "coverage.svg", "Coverage depth (gru coverage index)"))
 
         for graph, description in stat_graphs:
-            graph_file = open(stats_folder + prefix + "/" + graph + ".png")
-            print (graph_file.name)
+            if use_inline_report_assets():
+                with open(graph, "rb") as graph_file:
+                    mime_type = "image/svg+xml" if graph.endswith(".svg") else "image/png"
+                    graph_source = "data:" + mime_type + ";base64," + base64.b64encode(graph_file.read())
+            else:
+                graph_source = os.path.relpath(graph, project_folder)
             organism_stat += '<div class="col-sm-6 col-md-6">' \
                                  '<div class="thumbnail">' \
-                             '<img src="data:image/png;base64,' + base64.b64encode(graph_file.read()) + '" />' \
+                             '<img loading="lazy" src="' + graph_source + '" />' \
                                     '<div class="caption"><h3>' + description + '</h3></div>' \
                                  '</div>' \
                              '</div>'
-            graph_file.close()
         organism_stat += '</div>'
+        if coverage_index is not None:
+            organism_stat += render_coverage_table(coverage_index)
+        if os.path.isfile(get_illumina_stats_folder(prefix) + "gru-stats.json"):
+            organism_stat += render_illumina_stats(load_bam_stats(get_illumina_stats_folder(prefix) + "gru-stats.json"))
 
         organism_stat += '</div>'
 
-        gru_content_organisms_stats += organism_stat
+        yield '<template class="gru-pane" data-paneclass="gru-stats-' + prefix + '">' + organism_stat + '</template>'
+
+
+# renders the statistics of the Illumina alignments of an organism next to the nanopore statistics
+def render_illumina_stats(stats):
+    reads_stats_a, reads_stats_b, bases_stats_a, bases_stats_b = native_stats_tables(stats)
+    return '<div class="row"><h2>Illumina mapping' \
+           '<a tabindex="0" class="btn btn-default gru-popover" role="button" data-toggle="popover" data-trigger="focus" title="Information" data-content="Statistics of the Illumina reads of this organism, mapped with bwa mem against its contigs. The sorted alignments are in the illumina folder of the mapping folder."><span class="glyphicon glyphicon-info-sign" aria-hidden="true"></span></a>' \
+           '</h2><div class="col-sm-4"><table class="nums">' \
+           '<tbody><tr><th>Reads</th></tr>' \
+           '<tr><td class="pad"><table>' \
+           '<tbody><tr><td>total: </td><td class="right">' + reads_stats_a[0] + '</td><td class="right"></td></tr>' \
+           '<tr><td>non-primary: </td><td class="right">' + reads_stats_a[2] + '</td><td class="right"> </td></tr>' \
+           '<tr><td>mapped: </td><td class="right">' + reads_stats_a[4] + '</td><td class="right">' + reads_stats_b[3] + '</td></tr>' \
+           '<tr><td>zero MQ: </td><td class="right">' + reads_stats_a[5] + '</td><td class="right">' + reads_stats_b[4] + '</td></tr>' \
+           '<tr><td>avg read length: </td><td class="right">' + reads_stats_a[6] + '</td><td class="right"></td></tr>' \
+           '</tbody></table></td></tr>' \
+           '<tr><th>Bases</th></tr>' \
+           '<tr><td class="pad"><table>' \
+           '<tbody><tr><td>total: </td><td class="right">' + bases_stats_a[0] + '</td><td class="right">' + bases_stats_b[0] + '</td></tr>' \
+           '<tr><td>mapped: </td><td class="right">' + bases_stats_a[1] + '</td><td class="right"></td></tr>' \
+           '<tr><td>error rate: </td><td class="right">' + bases_stats_a[2] + '</td><td class="right"></td></tr>' \
+           '</tbody></table></td></tr>' \
+           '</tbody></table></div></div>'
+
+
+# renders the coverage summary of an organism as rows of the further stats table
+def render_coverage_rows(coverage_index):
+    if coverage_index is None:
+        return '<tr><td>coverage: </td><td class="right">not computed</td><td class="right"></td></tr>'
+    total = coverage_index["total"]
+    rows = '<tr><td>mean depth: </td><td class="right">%.2f</td><td class="right"></td></tr>' % total["mean_depth"]
+    for breadth_depth in coverage_breadth_depths:
+        rows += '<tr><td>breadth &ge; %dx: </td><td class="right">%.2f%%</td><td class="right"></td></tr>' \
+                % (breadth_depth, 100 * total["breadth_" + str(breadth_depth)])
+    rows += '<tr><td>gaps: </td><td class="right">%d</td><td class="right">(%d bp)</td></tr>' \
+            % (total["gaps"], total["gap_bases"])
+    if len(coverage_index["largest_gaps"]) > 0:
+        gap = coverage_index["largest_gaps"][0]
+        rows += '<tr><td>largest gap: </td><td class="right">%d bp</td><td class="right">(%s:%d-%d)</td></tr>' \
+                % (gap["length"], gap["contig"], gap["start"] + 1, gap["end"])
+    return rows
+
+
+# renders the per contig coverage table of an organism (the first coverage_report_contigs contigs)
+def render_coverage_table(coverage_index):
+    html = '<div class="row"><h2>Coverage' \
+           '<a tabindex="0" class="btn btn-default gru-popover" role="button" data-toggle="popover" data-trigger="focus" title="Information" data-content="Depth and breadth of coverage per contig, computed by gru from the sorted bam file (primary and supplementary alignments, like samtools depth). Gaps are regions with a depth below ' + str(coverage_index["gap_depth"]) + '. The full tables are in the coverage folder of the project."><span class="glyphicon glyphicon-info-sign" aria-hidden="true"></span></a>' \
+           '</h2><table class="nums"><tbody><tr><th>contig</th><th>original name</th><th>length</th><th>mean depth</th>' + \
+           "".join('<th>&ge; %dx</th>' % breadth_depth for breadth_depth in coverage_breadth_depths) + \
+           '<th>gaps</th><th>gap bases</th></tr>'
+    for summary in coverage_index["contigs"][:coverage_report_contigs]:
+        html += '<tr><td>' + summary["name"] + '</td><td>' + summary.get("original_name", summary["name"]) + \
+                '</td><td class="right">%d</td><td class="right">%.2f</td>' \
+                % (summary["length"], summary["mean_depth"]) + \
+                "".join('<td class="right">%.2f%%</td>' % (100 * summary["breadth_" + str(breadth_depth)])
+                        for breadth_depth in coverage_breadth_depths) + \
+                '<td class="right">%d</td><td class="right">%d</td></tr>' % (summary["gaps"], summary["gap_bases"])
+    if len(coverage_index["contigs"]) > coverage_report_contigs:
+        html += '<tr><td colspan="9">%d more contigs in coverage-summary.tsv</td></tr>' \
+                % (len(coverage_index["contigs"]) - coverage_report_contigs)
+    return html + '</tbody></table></div>'
+
+
+# renders the size statistics of the assembly of every organism
+def render_assembly_overview():
+    if not use_assembly():
+        return '<span>The assembly is disabled (assembly: False).</span>'
+    html = '<div class="table-responsive"><table class="table table-striped"><thead><tr><th>Organism</th>' \
+           '<th>Assembler</th><th>Contigs</th><th>Total length</th><th>Largest contig</th><th>N50</th><th>Assembly</th>' \
+           '</tr></thead><tbody>'
+    assembler = "minimap + miniasm" + (" + nanopolish" if use_assembly_polishing() else "")
+    for prefix in get_prefixes():
+        summary_file = os.path.dirname(get_assembly_file(prefix)) + "/assembly.json"
+        if not os.path.isfile(summary_file):
+            html += '<tr><td>' + prefix + '</td><td>' + assembler + '</td><td colspan="5">not assembled</td></tr>'
+            continue
+        with open(summary_file, "r") as summary_handle:
+            summary = json.load(summary_handle)
+        html += '<tr><td>' + prefix + '</td><td>' + assembler + '</td><td>%d</td><td>%d</td><td>%d</td><td>%d</td>' \
+                % (summary["contigs"], summary["total_length"], summary["largest_contig"], summary["n50"]) + \
+                '<td>' + os.path.relpath(get_assembly_file(prefix), project_folder) + '</td></tr>'
+    return html + '</tbody></table></div>'
+
 
-    output = output.replace("<gru-content-organisms-stats/>", gru_content_organisms_stats)
+# renders the quast reports (report.tsv) of all organisms as one table with a column per organism
+def render_quast_report():
+    metrics, reports = [], {}
+    for prefix in get_prefixes():
+        report_file = get_quast_folder(prefix) + "report.tsv"
+        if not use_assembly() or not os.path.isfile(report_file):
+            continue
+        reports[prefix] = {}
+        with open(report_file, "r") as report:
+            for line in report:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2 or fields[0] == "Assembly":
+                    continue
+                if fields[0] not in metrics:
+                    metrics.append(fields[0])
+                reports[prefix][fields[0]] = fields[1]
+    if len(reports) == 0:
+        return '<span>No quast reports (assembly: False or the assemblies failed).</span>'
+    prefixes = sorted(reports)
+    html = '<div class="table-responsive"><table class="table table-striped"><thead><tr><th>Metric</th>' + \
+           "".join('<th>' + prefix + '</th>' for prefix in prefixes) + '</tr></thead><tbody>'
+    for metric in metrics:
+        html += '<tr><td>' + metric + '</td>' + \
+                "".join('<td>' + reports[prefix].get(metric, "-") + '</td>' for prefix in prefixes) + '</tr>'
+    return html + '</tbody></table></div>'
 
-    output_file.write(output)
-    output_file.close()
+
+# renders the profile records of this run (stages and tool invocations) as table rows
+def render_profile_table():
+    rows = ""
+    with profile_lock:
+        records = profile_records[profile_report_start:]
+    for record in records:
+        if record.get("skipped"):
+            rows += "<tr><td>" + record["name"] + "</td><td>stage</td><td colspan=\"6\">up to date, skipped</td></tr>"
+            continue
+        cpu = record.get("user_seconds", 0) + record.get("system_seconds", 0) + \
+              record.get("children_user_seconds", 0) + record.get("children_system_seconds", 0)
+        name = record["name"] if record["type"] == "stage" else "&nbsp;&nbsp;" + record["command"]
+        rows += "<tr><td>" + name + "</td><td>" + (record.get("stage") or "") + "</td>" \
+                "<td>%.1f</td><td>%.1f</td><td>%.1f</td><td>%.1f</td><td>%.1f</td><td>%d</td></tr>" \
+                % (record["wall_seconds"], cpu, record["max_rss_kb"] / 1024.0, record["read_bytes"] / 1048576.0,
+                   record["written_bytes"] / 1048576.0, record["exit_code"])
+    return rows
 
 
 ##########################################
 #    END SECTION  RENDERING              #
 ##########################################
 
+##########################################
+#    BEGIN SECTION  WATCH                #
+##########################################
+
+# set to finish watch mode after the current micro-batch (SIGTERM/SIGINT)
+watch_stop = threading.Event()
+
+
+# returns the folder of the part files (sorted bam files of micro-batches) of an organism
+def get_parts_folder(prefix):
+    return get_mapping_folder() + "parts/" + prefix + "/"
+
+
+# returns the list of fast5 files processed by watch mode (kept over finalization for resumed runs)
+def get_watch_log():
+    return get_mapping_folder() + "watch-processed.txt"
+
+
+# returns the part files of an organism as sorted list of (level, number, file). Parts are named <level>_<number>.bam
+# (.cram), level 0 parts hold one micro-batch and every higher level is merged from parts of the level below.
+def list_parts(prefix):
+    parts = []
+    for part in os.listdir(get_parts_folder(prefix)):
+        if part.endswith(alignment_extension()):
+            level, number = part[:-len(alignment_extension())].split("_")
+            parts.append((int(level), int(number), get_parts_folder(prefix) + part))
+    return sorted(parts)
+
+
+# returns the fast5 files of the input folder which are new (not in known) and complete, i.e. have the same size as at
+# the previous poll. poll_state keeps the folder modification time and the sizes of the incomplete files; the folder
+# is only listed again if it changed or files are still being written.
+def poll_fast5_files(fast5_folder, known, poll_state):
+    mtime = os.stat(fast5_folder).st_mtime
+    if mtime == poll_state["mtime"] and len(poll_state["pending"]) == 0:
+        return []
+    poll_state["mtime"] = mtime
+    ready = []
+    pending = {}
+    for fast5_file in list_fast5_files(fast5_folder):
+        if fast5_file in known:
+            continue
+        try:
+            size = os.path.getsize(fast5_file)
+        except OSError:
+            continue  # removed meanwhile
+        if size > 0 and poll_state["pending"].get(fast5_file) == size:
+            ready.append(fast5_file)
+        else:
+            pending[fast5_file] = size
+    poll_state["pending"] = pending
+    return ready
+
+
+# appends a file to another one
+def append_file(source_file, target_file):
+    with open(source_file, "rb") as source:
+        with open(target_file, "ab") as target:
+            shutil.copyfileobj(source, target, demultiplex_buffer_size)
+
+
+# writes the statistics and charts of an organism into its stats folder
+def write_watch_stats(prefix, stats):
+    organism_stats_folder = get_stats_folder() + prefix + "/"
+    create_folder(organism_stats_folder, "Could not create the statistics folder!", 51)
+    write_bam_stats(stats, organism_stats_folder + "gru-stats.json")
+    write_bam_stats_charts(stats, organism_stats_folder)
+
+
+# converts, maps and evaluates one micro-batch of fast5 files: the reads are appended to the reads files, the
+# alignments are sorted into a new level 0 part per organism and added to the running statistics. The work depends
+# only on the size of the batch, not on the number of reads processed before.
+def process_watch_batch(batch, fast5_files, watch_stats):
+    batch_folder = temp_folder + "watch/" + str(batch) + "/"
+    create_folder(batch_folder, "Could not create the micro-batch folder!", 55)
+    extract_reads_native(fast5_files, batch_folder + "reads", batch_folder + "fast5_extraction_error.log")
+    # bgzf files stay valid when they are concatenated
+    append_file(batch_folder + "reads.fasta" + compressed_suffix(), get_reads_file(".fasta"))
+    append_file(batch_folder + "reads.fastq" + compressed_suffix(), get_reads_file(".fastq"))
+    add_read_index_part(get_read_index_file(batch_folder + "reads.fastq" + compressed_suffix()), get_read_index_file(),
+                        batch)
+    append_file(batch_folder + "fast5_extraction_error.log", log_folder + "fast5_extraction_error.log")
+    reads_fastq = batch_folder + "reads.fastq" + compressed_suffix()
+    if use_read_filter():
+        filtered_fastq = batch_folder + "reads_filtered.fastq" + compressed_suffix()
+        update_read_filter_summary(filter_reads(reads_fastq, filtered_fastq), True)
+        append_file(filtered_fastq, get_mapping_reads_file())
+        reads_fastq = filtered_fastq
+
+    map_reads_streaming(reads_fastq, batch_folder,
+                        params["software_settings"]["mapping_threads"], params["software_settings"]["sorting_threads"],
+                        "bwa_mapping_error.log", batch_folder + read_metrics_name)
+    add_read_metrics_part(batch_folder + read_metrics_name, get_read_metrics_file(), batch)
+    for prefix in get_prefixes():
+        started = time.time()
+        bam, p = open_bam_stream(get_alignment_file(prefix, batch_folder))
+        merge_bam_stats(watch_stats[prefix], compute_bam_stats(bam))
+        close_stream(bam, p, params["software_general"]["samtools"] + " view -u " + prefix, started)
+        shutil.move(get_alignment_file(prefix, batch_folder),
+                    get_parts_folder(prefix) + "0_" + str(batch) + alignment_extension())
+        write_watch_stats(prefix, watch_stats[prefix])
+
+    with open(get_watch_log(), "ab") as watch_log:
+        watch_log.write("".join(fast5_file + "\n" for fast5_file in fast5_files))
+    shutil.rmtree(batch_folder)
+
+
+# merges watch_merge_parts parts of the same level into one part of the next level until no level is full, so the
+# number of parts grows only logarithmically with the number of micro-batches. Runs next to the batches in a thread.
+def compact_parts():
+    merge_parts = max(2, int(get_setting("software_settings", "watch_merge_parts", 16)))
+    merging_folder = temp_folder + "watch/merging/"
+    create_folder(merging_folder, "Could not create the micro-batch folder!", 55)
+    for prefix in get_prefixes():
+        while True:
+            levels = collections.defaultdict(list)
+            for level, number, part in list_parts(prefix):
+                levels[level].append((number, part))
+            full = [level for level in sorted(levels) if len(levels[level]) >= merge_parts]
+            if len(full) == 0:
+                break
+            group = levels[full[0]][:merge_parts]
+            merged = str(full[0] + 1) + "_" + str(group[0][0]) + alignment_extension()
+            if run_command([params["software_general"]["samtools"], "merge", "-f", "-@",
+                            str(params["software_settings"]["sorting_threads"])] + alignment_output_options() +
+                           [merging_folder + merged] +
+                           [part for number, part in group], stderr_file=log_folder + "samtools_error.log",
+                           threads=params["software_settings"]["sorting_threads"]) != 0:
+                warning("Could not merge the parts of " + prefix + " (see " + log_folder + "samtools_error.log)")
+                break
+            shutil.move(merging_folder + merged, get_parts_folder(prefix) + merged)
+            for number, part in group:
+                os.remove(part)
+
+
+# merges the remaining parts of every organism into splitted/<prefix>.bam (.cram) and indexes it, and the read index
+# and per-read metrics parts of the micro-batches into the read index and the per-read metrics table
+def finalize_watch():
+    samtools = params["software_general"]["samtools"]
+    create_folder(get_splitted_folder(), "Could not create bwa index output folder!", 38)
+    tasks = {}
+    for prefix in get_prefixes():
+        bam = get_alignment_file(prefix)
+        parts = [part for level, number, part in list_parts(prefix)]
+        if len(parts) == 0:
+            continue
+        if len(parts) == 1:
+            tasks["merge:" + prefix] = make_task(lambda part=parts[0], bam=bam: shutil.move(part, bam))
+        else:
+            tasks["merge:" + prefix] = make_task(
+                lambda parts=parts, bam=bam: run_command(
+                    [samtools, "merge", "-f", "-@", str(params["software_settings"]["sorting_threads"])] +
+                    alignment_output_options() + [bam] + parts,
+                    stderr_file=log_folder + "samtools_error.log", threads=params["software_settings"]["sorting_threads"]),
+                threads=params["software_settings"]["sorting_threads"])
+        tasks["index:" + prefix] = make_task(
+            lambda bam=bam: run_command([samtools, "index", bam], stderr_file=log_folder + "samtools_error.log"),
+            ["merge:" + prefix])
+        tasks["coverage:" + prefix] = make_task(lambda prefix=prefix: run_coverage_index(prefix), ["index:" + prefix])
+        if scratch_folder is not None:
+            tasks["copy-back:" + prefix] = make_task(
+                lambda bam=bam: copy_back([bam, get_alignment_index(bam)]), ["index:" + prefix])
+
+    failed = run_task_graph(tasks, stage_thread_budget())
+    if len(failed) > 0:
+        abort("Merging the parts failed for: " + ", ".join(failed) + " (see " + log_folder + ")", 56)
+    merge_read_index_parts(get_read_index_file())
+    merge_read_metrics_parts(get_read_metrics_file())
+    shutil.rmtree(get_mapping_folder() + "parts/")
+    shutil.rmtree(temp_folder + "watch/", ignore_errors=True)
+
+
+# watches the nanopore input folder of a running sequencing run: newly completed fast5 files are converted and mapped
+# in micro-batches of at most watch_batch_files files, the statistics are updated after every batch and the report is
+# regenerated every watch_report_seconds. Finishes after watch_idle_timeout seconds without new files (0: never) or on
+# SIGTERM/SIGINT, then merges the parts of every organism into its sorted bam file. Ctrl-C also reaches the running
+# tools, so a batch in flight may fail; it is repeated by a resumed run.
+def watch_nanopore_input():
+    global profile_report_start
+    fast5_folder = params["nanopore_input"]
+    if not os.path.isdir(fast5_folder):
+        abort("Watch mode requires a folder as nanopore input", 54)
+    if not use_native_extractor():
+        abort("Watch mode requires the native fast5 extractor (h5py)", 54)
+    if not use_native_stats():
+        warning("Watch mode computes the statistics natively, stats_engine is ignored")
+        params["software_settings"]["stats_engine"] = "native"
+    poll_seconds = float(get_setting("software_settings", "watch_poll_seconds", 30))
+    batch_files = max(1, int(get_setting("software_settings", "watch_batch_files", 4000)))
+    report_seconds = float(get_setting("software_settings", "watch_report_seconds", 300))
+    idle_timeout = float(get_setting("software_settings", "watch_idle_timeout", 0))
+
+    create_folder(get_reads_folder(), "Could not create the nanopore output folder folder!", 26)
+    if use_read_filter():
+        create_folder(get_filtered_reads_folder(), "Could not create the filtered reads folder!", 66)
+    create_folder(get_stats_folder(), "Could not create bwa index output folder!", 38)
+    watch_stats = {}
+    for prefix in get_prefixes():
+        create_folder(get_parts_folder(prefix), "Could not create the parts folder!", 55)
+        bam = project_path(get_alignment_file(prefix))
+        if os.path.isfile(bam):  # finalized by a previous run, continue with it as part
+            os.rename(bam, get_parts_folder(prefix) + "100_0" + alignment_extension())
+            if os.path.isfile(get_alignment_index(bam)):
+                os.remove(get_alignment_index(bam))
+        stats_file = get_stats_folder() + prefix + "/gru-stats.json"
+        watch_stats[prefix] = load_bam_stats(stats_file) if os.path.isfile(stats_file) else new_bam_stats()
+        write_watch_stats(prefix, watch_stats[prefix])
+    known = set()
+    if os.path.isfile(get_watch_log()):
+        with open(get_watch_log(), "r") as watch_log:
+            known.update(line.rstrip("\n") for line in watch_log)
+    processed = len(known)
+
+    def stop_watching(signum, frame):
+        debug("Finishing watch mode after the current micro-batch")
+        watch_stop.set()
+
+    signal.signal(signal.SIGTERM, stop_watching)
+    signal.signal(signal.SIGINT, stop_watching)
+
+    debug("Watching " + fast5_folder + " (" + str(processed) + " fast5 files processed before)")
+    backlog = collections.deque()
+    poll_state = {"mtime": None, "pending": {}}
+    last_arrival = time.time()
+    last_report = 0
+    compactor = None
+    while not watch_stop.is_set():
+        new_files = poll_fast5_files(fast5_folder, known, poll_state)
+        if len(new_files) > 0:
+            known.update(new_files)
+            backlog.extend(new_files)
+            last_arrival = time.time()
+        if len(backlog) == 0:
+            if idle_timeout > 0 and time.time() - last_arrival > idle_timeout:
+                debug("No new fast5 files for " + str(idle_timeout) + " seconds, finishing watch mode")
+                break
+            watch_stop.wait(poll_seconds)
+            continue
+
+        batch = [backlog.popleft() for i in range(min(batch_files, len(backlog)))]
+        with profile_lock:
+            profile_report_start = len(profile_records)  # the report shows the timings of the latest batch
+        profile_stage("batch:" + str(processed), lambda: process_watch_batch(processed, batch, watch_stats))
+        processed += len(batch)
+        debug("Processed " + str(processed) + " fast5 files, " + str(len(backlog)) + " waiting")
+        if compactor is None or not compactor.is_alive():
+            compactor = threading.Thread(target=profile_stage, args=("compact", compact_parts))
+            compactor.start()
+        if time.time() - last_report >= report_seconds:
+            render_output()
+            last_report = time.time()
+
+    if compactor is not None:
+        compactor.join()
+    profile_stage("finalize", finalize_watch)
+
+
+##########################################
+#    END SECTION  WATCH                  #
+##########################################
+
 
 ##########################################
 #    BEGIN SECTION  MAIN_ROUTINE         #
 ##########################################
-def main(argv):
+def main(argv, watch=False):
     read_config(argv[0])
-    run_prerequisites()
-    run_poretools()
-    run_bwa_index()
-    run_bwa_mapping()
-    process_mappingfile()
-    plot_bamstats()
-    # TODO more statistics. Compare assemblies!!!
+    # a job terminated by a scheduler unwinds like an abort, so the scratch folder is removed (watch mode installs
+    # its own handler which finishes after the current micro-batch)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        run_prerequisites()
+        load_manifest()
+        if get_setting("software_settings", "overlapped_mapping", False) and not use_overlapped_mapping():
+            warning("overlapped_mapping needs the native fast5 extractor, one mapping shard and no batch queue, the "
+                    "conversion and the mapping run one after another")
+        if not watch and not use_overlapped_mapping():
+            run_stage("poretools", run_poretools, [params["nanopore_input"]], [get_reads_folder()],
+                      [params["software_general"]["poretools"], get_setting("software_settings", "fast5_extractor", "native"),
+                       use_compressed_storage()],
+                      get_setting("software_settings", "extraction_processes", params["software_settings"]["mapping_threads"]))
+            if use_read_filter():
+                run_stage("read-filter", run_read_filter, [get_reads_file(".fastq")], [get_filtered_reads_folder()],
+                          [read_filter_settings(), use_compressed_storage()])
+        run_stage("bwa-index", run_bwa_index,
+                  [params["references"]["folder"] + params["file_mapping"][gen]["reference"] for gen in
+                   params["file_mapping"]], [get_index_folder()],
+                  [params["file_mapping"], params["references"], params["software_general"]["bwa"]])
+        if watch:
+            # convert and map the fast5 files in micro-batches while the sequencing run writes them
+            watch_nanopore_input()
+        else:
+            run_mapping_stages()
+            process_mappingfile()
+        if use_assembly():
+            run_assemblies()
+
+        run_stage("report", render_output, [get_stats_folder(), "template.html"] +
+                  ([project_folder + params["gru_settings"]["assembler_outputs_foldername"] + "/"] if use_assembly() else []),
+                  [params["project_settings"]["project_folder"] + "gru-output.html"], params)
+        finish_copy_back()
+    finally:
+        remove_scratch_folder()
+
+
+# SIGTERM handler: raises SystemExit in the main thread
+def terminate(signum, frame):
+    print(message_prefix() + "Terminated")
+    sys.exit(128 + signum)
+
+
+# returns the files written by the mapping stage
+def get_mapping_outputs():
+    if use_streaming_mapping():
+        return [get_alignment_file(prefix) for prefix in get_prefixes()] + [get_read_metrics_file()]
+    return [get_mapping_file()]
+
+
+# runs many jobs in one batch: all config files are checked up front, then every job runs in its own process (gru
+# keeps the state of a job in globals) while the stages of all jobs share one core budget. A job is started when its
+# job_memory_gb fits into the memory budget and less than max_jobs jobs are running. Jobs without index_cache_folder
+# share an index cache for the batch, so identical reference sets are indexed only once.
+def run_batch(arguments):
+    global core_budget, batch_index_cache_folder
+    options = {"--cores": multiprocessing.cpu_count(),
+               "--memory-gb": os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024.0 ** 3, "--jobs": None}
+    job_files = []
+    while len(arguments) > 0:
+        argument = arguments.pop(0)
+        if argument in options:
+            if len(arguments) == 0:
+                abort("Missing value of " + argument, 1, True)
+            options[argument] = float(arguments.pop(0))
+        else:
+            job_files.append(argument)
+    if len(job_files) == 0:
+        abort("No config files given.", 1, True)
+    cores = max(1, int(options["--cores"]))
+    memory_gb = float(options["--memory-gb"])
+    max_jobs = max(1, int(options["--jobs"] or cores))
+
+    # load and check all jobs before any of them starts
+    jobs = collections.deque()
+    project_folders = {}
+    for job_file in job_files:
+        read_config(job_file)
+        check_config()
+        check_software()
+        folder = os.path.abspath(params["project_settings"]["project_folder"])
+        if folder in project_folders:
+            abort(job_file + " and " + project_folders[folder] + " use the same project folder", 57)
+        project_folders[folder] = job_file
+        jobs.append((job_file, min(memory_gb, float(get_setting("software_settings", "job_memory_gb", 0)))))
+    print("Running " + str(len(jobs)) + " jobs on " + str(cores) + " cores and " + "%.1f" % memory_gb + " GB")
+
+    # next to the project folders, so the indexes of the projects are hardlinks (copies on other file systems) which
+    # survive the removal of the cache
+    batch_index_cache_folder = tempfile.mkdtemp(prefix=".gru_index_cache_", dir=os.path.dirname(sorted(project_folders)[0]))
+    core_budget = create_core_budget(cores, len(jobs), batch_index_cache_folder + "/cores.lock")
+    open(core_budget["lock_file"], "w").close()
+    running = {}
+    failed = []
+    try:
+        slot = 0
+        while len(jobs) > 0 or len(running) > 0:
+            reserved = sum(memory for process, memory, job_slot in running.values())
+            while len(jobs) > 0 and len(running) < max_jobs and reserved + jobs[0][1] <= memory_gb:
+                job_file, memory = jobs.popleft()
+                process = multiprocessing.Process(target=run_batch_job, args=(job_file, slot))
+                process.start()
+                running[job_file] = (process, memory, slot)
+                reserved += memory
+                slot += 1
+            time.sleep(1)
+            for job_file in list(running):
+                process, memory, job_slot = running[job_file]
+                if not process.is_alive():
+                    process.join()
+                    del running[job_file]
+                    if process.exitcode != 0:
+                        failed.append(job_file)
+                        # a killed job could not release its cores
+                        with open(core_budget["lock_file"], "r") as lock_file:
+                            fcntl.flock(lock_file, fcntl.LOCK_EX)
+                            core_budget["held"][job_slot] = 0
+                    print("Finished " + job_file + " (exit code " + str(process.exitcode) + ")")
+    finally:
+        for process, memory, job_slot in running.values():
+            process.terminate()
+        shutil.rmtree(batch_index_cache_folder, ignore_errors=True)
+    if len(failed) > 0:
+        abort("Failed jobs: " + ", ".join(failed), 58)
+
 
-    render_output()
+# runs one job of a batch in its worker process, slot is its entry in the core budget
+def run_batch_job(job_file, slot):
+    global job_name
+    job_name = os.path.basename(job_file)
+    core_budget["slot"] = slot
+    main([job_file])
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        run_batch(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "demultiplex":
+        run_demultiplex(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "coverage":
+        run_coverage_query(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "reads":
+        run_read_extraction(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "read-metrics":
+        run_read_metrics_query(sys.argv[2:])
+        sys.exit(0)
+    arguments = [argument for argument in sys.argv[1:] if argument != "--watch"]
+    if len(arguments) < 1:
         abort("No argumens given.", 1, True)
-    if len(sys.argv) > 2:
+    if len(arguments) > 1:
         abort("Too much argumens given.", 1, True)
-    main(sys.argv[1:])  # start main with arguments
+    main(arguments, "--watch" in sys.argv[1:])  # start main with arguments
 
     ##########################################
     #    END SECTION  MAIN_ROUTINE           #